@@ -0,0 +1,62 @@
+"""
+Benchmarks the artifact cache: obfuscates a generated project into fresh output directories sharing one cache, like CI
+pipelines would. The first run fills the cache, the second one takes everything from it, the third one has one module
+changed.
+
+Usage: python benchmarks/bench_cache.py [modules]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import tomlkit
+
+from bench_transitive import OBFUSCATOR, generate_project
+
+
+def configure(root: str):
+    subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True)  # creates the example config
+    with open(os.path.join(root, "config.toml"), "r", encoding="utf8") as f:
+        doc = tomlkit.loads(f.read())
+    doc["general"]["input_file"] = os.path.join(root, "main.py")
+    doc["general"]["output_file"] = os.path.join(root, "out")
+    doc["general"]["cache_dir"] = os.path.join(root, "cache")
+    for seg in doc.values():
+        if "enabled" in seg:
+            seg["enabled"] = True
+    with open(os.path.join(root, "config.toml"), "w", encoding="utf8") as f:
+        f.write(tomlkit.dumps(doc))
+
+
+def run(root: str) -> tuple[float, str]:
+    """
+    :return: Wall time, and the cache statistics of the run
+    """
+    shutil.rmtree(os.path.join(root, "out"), ignore_errors=True)  # a fresh checkout
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True, check=True, text=True,
+                       env={**os.environ, "COLUMNS": "300"})
+    took = time.perf_counter() - start
+    stats = next((x.strip() for x in p.stdout.splitlines() if "Cache:" in x), "")
+    return took, stats[stats.index("Cache:"):].split("  ")[0] if stats else "no statistics"
+
+
+def main():
+    modules = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    print(f"{modules} modules")
+    with tempfile.TemporaryDirectory() as root:
+        generate_project(root, modules)
+        configure(root)
+        for name in ["cold cache", "warm cache", "one module changed"]:
+            if name == "one module changed":
+                with open(os.path.join(root, f"mod_{modules - 1}.py"), "a", encoding="utf8") as f:
+                    f.write("\nchanged = True\n")
+            took, stats = run(root)
+            print(f"  {name:>18}: {took:8.2f} s, {stats}")
+
+
+if __name__ == '__main__':
+    main()
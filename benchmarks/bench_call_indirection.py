@@ -0,0 +1,57 @@
+"""
+Benchmarks the runtime overhead of the collector's call indirection modes on a hot loop, compared to the original code.
+
+Usage: python benchmarks/bench_call_indirection.py
+"""
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator"))
+
+import transformers  # noqa: E402
+from util import NonEscapingUnparser  # noqa: E402
+
+SOURCE = """
+def step(x):
+    return x + 1
+
+
+def hot(n):
+    total = 0
+    for i in range(n):
+        total += step(i) + abs(i) + len("ab")
+    return total
+"""
+
+ITERATIONS = 200_000
+
+
+def load(mode: str | None) -> dict:
+    tree = ast.parse(SOURCE)
+    if mode is not None:
+        collector = transformers.Collector()
+        collector.config["collect_consts"].value = False
+        collector.config["call_indirection"].value = mode
+        tree = collector.transform(tree, "bench.py", None, None)
+    src = NonEscapingUnparser().visit(ast.fix_missing_locations(tree))
+    glob = {}
+    exec(compile(src, "bench.py", "exec"), glob)
+    return glob
+
+
+def main():
+    base = None
+    for mode in [None, "slots", "eval"]:
+        hot = load(mode)["hot"]
+        start = time.perf_counter()
+        hot(ITERATIONS)
+        took = time.perf_counter() - start
+        if base is None:
+            base = took
+        print(f"{mode or 'original':>8}: {took * 1000:9.1f} ms ({took / base:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
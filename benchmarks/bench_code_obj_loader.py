@@ -0,0 +1,64 @@
+"""
+Benchmarks the dynamic code object launcher without encryption on modules with a lot of functions: how long generating
+the loader takes, how big the output gets, and how long importing the output takes, both without a cached .pyc (parse
+and compile included) and with one.
+
+Usage: python benchmarks/bench_code_obj_loader.py
+"""
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator"))
+
+import transformers  # noqa: E402
+from util import NonEscapingUnparser  # noqa: E402
+
+
+def generate_module(functions: int) -> str:
+    out = []
+    for i in range(functions):
+        out.extend([
+            f"class Handler{i}:",
+            f"    def __init__(self, name='handler {i}'):",
+            f"        self.name = name",
+            f"    def handle(self, items):",
+            f"        return [self.name + str(x * {i}) for x in items if x % 3 != {i % 3}]",
+            f"def helper_{i}(a, b={i}):",
+            f"    return Handler{i}().handle(range(a, a + b))",
+            "",
+        ])
+    out.append("RESULT = helper_1(2)")
+    return "\n".join(out)
+
+
+def main():
+    for classes in [250, 500, 1000]:
+        source = generate_module(classes)
+        launcher = transformers.ConstructDynamicCodeObject()
+        launcher.config["encrypt"].value = False
+        start = time.perf_counter()
+        tree = launcher.transform(ast.parse(source), "bench.py", None, None)
+        src = NonEscapingUnparser().visit(ast.fix_missing_locations(tree))
+        generate = time.perf_counter() - start
+        start = time.perf_counter()
+        code = compile(src, "bench.py", "exec")
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        glob = {"__name__": "bench"}
+        exec(code, glob)
+        warm = time.perf_counter() - start
+        assert glob["RESULT"] == generate_module_result()
+        print(f"{classes * 4:>5} functions: generate {generate * 1000:8.1f} ms, {len(src) / 1024:8.1f} KiB, "
+              f"import {(cold + warm) * 1000:8.1f} ms without .pyc, {warm * 1000:8.1f} ms with")
+
+
+def generate_module_result():
+    glob = {}
+    exec(generate_module(2), glob)
+    return glob["RESULT"]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Benchmarks the constant collection of the collector on constant heavy modules: a big lookup table, and a translation
+table like an i18n file would have. Collection should scale roughly linearly with the amount of constants.
+
+Usage: python benchmarks/bench_collector.py
+"""
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator"))
+
+import transformers  # noqa: E402
+
+
+def generate_lookup_table(entries: int) -> str:
+    out = ["TABLE = {"]
+    for i in range(entries):
+        out.append(f"    {i}: ({i * 7 % 256}, {i / 3!r}, {i % 2 == 0}),")
+    out.append("}")
+    return "\n".join(out)
+
+
+def generate_i18n(entries: int) -> str:
+    out = ["MESSAGES = {"]
+    for i in range(entries):
+        out.append(f"    'msg_{i}': {{'en': 'Message number {i}', 'de': 'Nachricht Nummer {i}', 'shared': 'OK'}},")
+    out.append("}")
+    return "\n".join(out)
+
+
+def bench(source: str) -> tuple[float, int]:
+    tree = ast.parse(source)
+    collector = transformers.Collector()
+    start = time.perf_counter()
+    collector.transform(tree, "bench.py", None, None)
+    return time.perf_counter() - start, len(collector.found)
+
+
+def main():
+    for name, gen in [("lookup table", generate_lookup_table), ("i18n", generate_i18n)]:
+        print(name)
+        for entries in [1000, 2000, 4000, 8000]:
+            took, pool_size = bench(gen(entries))
+            print(f"{entries:>6} entries: {took * 1000:9.1f} ms, {pool_size} pooled constants")
+
+
+if __name__ == '__main__':
+    main()
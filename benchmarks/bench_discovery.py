@@ -0,0 +1,90 @@
+"""
+Benchmarks dependency discovery in transitive mode on a generated monorepo: packages of small modules importing each
+other absolutely, relatively and as submodules, a namespace package, and one long chain of imports deeper than the
+recursion limit. Counts the calls asking the file system about paths, and compares parsing every file to reusing what
+a persisted store kept from the last run.
+
+Usage: python benchmarks/bench_discovery.py [packages] [modules per package] [chain length]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator"))
+
+from depgraph import ModuleIndex, crawl  # noqa: E402
+from sources import SourceStore  # noqa: E402
+
+fs_calls = 0
+
+
+def counting(f):
+    def wrapper(*args, **kwargs):
+        global fs_calls
+        fs_calls += 1
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+os.stat = counting(os.stat)
+os.scandir = counting(os.scandir)
+os.path.exists = counting(os.path.exists)
+os.path.isdir = counting(os.path.isdir)
+os.path.isfile = counting(os.path.isfile)
+
+
+def write(path: str, lines: list[str]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def generate_monorepo(root: str, packages: int, modules: int, chain: int):
+    for p in range(packages):
+        write(os.path.join(root, f"pkg_{p}", "__init__.py"), ["from .mod_0 import value_0 as value"])
+        for m in range(modules):
+            lines = [f"from . import mod_{m - 1}"] if m > 0 else []
+            if p > 0:
+                lines.append(f"from pkg_{p - 1} import mod_{m}")
+                lines.append(f"import pkg_{p - 1}.mod_{(m + 1) % modules}")
+            lines.append(f"def value_{m}():\n    return {m}")
+            write(os.path.join(root, f"pkg_{p}", f"mod_{m}.py"), lines)
+    write(os.path.join(root, "shared", "tools", "helpers.py"), ["def helper():\n    return 1"])  # namespace package
+    for i in range(chain):
+        write(os.path.join(root, "chain", f"link_{i}.py"), [f"from chain import link_{i + 1}"] if i + 1 < chain else [])
+    write(os.path.join(root, "main.py"), [
+        f"import pkg_{packages - 1}",
+        "from shared.tools import helpers",
+        "import chain.link_0",
+    ])
+
+
+def run(root: str, store: SourceStore) -> tuple[float, int, int]:
+    """
+    :return: Time spent, files found, file system calls
+    """
+    global fs_calls
+    fs_calls = 0
+    start = time.perf_counter()
+    graph = crawl(os.path.join(root, "main.py"), ModuleIndex([root]), store)
+    return time.perf_counter() - start, len(graph.files), fs_calls
+
+
+def main():
+    packages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    modules = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    chain = int(sys.argv[3]) if len(sys.argv) > 3 else sys.getrecursionlimit() * 2
+    with tempfile.TemporaryDirectory() as root:
+        generate_monorepo(root, packages, modules, chain)
+        kept = os.path.join(root, "sources.bin")
+        for name in ["parsing everything", "persisted store"]:
+            store = SourceStore(kept)  # the first run keeps what it parsed for the second
+            took, files, calls = run(root, store)
+            store.save()
+            print(f"{name:>18}: {took * 1000:8.1f} ms, {files} files, {calls} file system calls")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmarks running the fusible transformers in fused passes, compared to one pass per transformer, on a big module.
+Only the traversals are fused, the work done per node stays the same, so the gain is the overhead of the passes
+removed.
+
+Usage: python benchmarks/bench_fusion.py
+"""
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator"))
+
+import transformers  # noqa: E402
+from fusion import FusedPass, plan_passes  # noqa: E402
+
+RUNS = 3
+
+
+def generate_module(classes: int) -> str:
+    out = []
+    for i in range(classes):
+        out.extend([
+            f"class Model{i}:",
+            f"    def __init__(self, name, size={i}):",
+            f"        self.name = name",
+            f"        self.size = size",
+            f"    def describe(self, items):",
+            f"        total = 0",
+            f"        for x in items:",
+            f"            if x % {i % 5 + 2} == 0 and self.size > x:",
+            f"                total += len(str(x)) * {i}",
+            f"        return f'{{self.name}}: {{total}} ' + ', '.join(map(str, items))",
+            f"def build_{i}(n):",
+            f"    return [Model{i}('model', size=x).describe(range(x)) for x in range(n)]",
+            "",
+        ])
+    return "\n".join(out)
+
+
+def all_fusible():
+    r = []
+    for x in [transformers.FstringsToFormatSequence, transformers.IntObfuscator, transformers.EncodeStrings,
+              transformers.ReplaceAttribs, transformers.Collector]:
+        t = x()
+        t.config["enabled"].value = True
+        r.append(t)
+    return r
+
+
+def run(source: str, passes: list[list]) -> float:
+    best = None
+    for _ in range(RUNS):
+        tree = ast.parse(source)
+        start = time.perf_counter()
+        for p in passes:
+            instances = [t.for_file() for t in p]
+            tree = FusedPass(instances).run(tree, "bench.py")
+        took = time.perf_counter() - start
+        best = took if best is None else min(best, took)
+    return best
+
+
+def main():
+    ts = all_fusible()
+    fused = plan_passes(ts)
+    for classes in [250, 1000]:
+        source = generate_module(classes)
+        separate = run(source, [[t] for t in ts])
+        together = run(source, fused)
+        print(f"{classes * 3:>5} functions: {len(ts)} passes {separate * 1000:8.1f} ms, "
+              f"{len(fused)} fused passes {together * 1000:8.1f} ms, {separate / together:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmarks incremental transitive obfuscation of a generated project: a full build, a rebuild with nothing changed, and
+rebuilds after changing one module, either inside a function or by adding a new function to it.
+
+Usage: python benchmarks/bench_incremental.py [modules]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import tomlkit
+
+from bench_transitive import OBFUSCATOR, generate_project
+
+
+def configure(root: str):
+    subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True)  # creates the example config
+    with open(os.path.join(root, "config.toml"), "r", encoding="utf8") as f:
+        doc = tomlkit.loads(f.read())
+    doc["general"]["input_file"] = os.path.join(root, "main.py")
+    doc["general"]["output_file"] = os.path.join(root, "out")
+    doc["general"]["incremental"] = True
+    for seg in doc.values():
+        if "enabled" in seg:
+            seg["enabled"] = True
+    with open(os.path.join(root, "config.toml"), "w", encoding="utf8") as f:
+        f.write(tomlkit.dumps(doc))
+
+
+def run(root: str) -> tuple[float, int]:
+    """
+    :return: Wall time, and how many outputs were written
+    """
+    out = os.path.join(root, "out")
+    before = {x: os.stat(os.path.join(out, x)).st_mtime_ns for x in os.listdir(out)} if os.path.isdir(out) else {}
+    start = time.perf_counter()
+    subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True, check=True)
+    took = time.perf_counter() - start
+    written = sum(1 for x in os.listdir(out) if x.endswith(".py") and
+                  before.get(x) != os.stat(os.path.join(out, x)).st_mtime_ns)
+    return took, written
+
+
+def append(path: str, line: str):
+    with open(path, "a", encoding="utf8") as f:
+        f.write("\n" + line + "\n")
+
+
+def main():
+    modules = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    print(f"{modules} modules")
+    with tempfile.TemporaryDirectory() as root:
+        generate_project(root, modules)
+        configure(root)
+        middle = os.path.join(root, f"mod_{modules // 2}.py")
+        for name, change in [
+            ("full build", None),
+            ("nothing changed", None),
+            ("function body changed", lambda: append(middle, "    x = 1")),
+            ("function added", lambda: append(middle, "def added():\n    return 1")),
+        ]:
+            if change is not None:
+                change()
+            took, written = run(root)
+            print(f"  {name:>22}: {took:8.2f} s, {written:>4} files written")
+
+
+if __name__ == '__main__':
+    main()
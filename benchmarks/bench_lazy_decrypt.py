@@ -0,0 +1,109 @@
+"""
+Benchmarks the startup time of a module encrypted by the dynamic code object launcher, decrypting everything on startup
+compared to decrypting functions lazily. The module has a lot of functions, of which only a few get called, like a big
+CLI tool would. Checks first that both call functions sharing their code with their own closure.
+
+Usage: python benchmarks/bench_lazy_decrypt.py
+"""
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator"))
+
+import transformers  # noqa: E402
+from util import NonEscapingUnparser  # noqa: E402
+
+CALLED = 10
+RUNS = 5
+
+# methods of classes made in a loop share their code, and only differ in their closure (__class__ here)
+SHARED_CODE = """
+class A:
+    def hi(self):
+        return "A"
+class B:
+    def hi(self):
+        return "B"
+made = []
+for base in (A, B):
+    class C(base):
+        def hi(self):
+            return "C" + super().hi()
+    made.append(C)
+RESULTS = [made[0]().hi(), made[1]().hi(), made[0]().hi(), made[1]().hi()]
+"""
+
+
+def generate_module(functions: int) -> str:
+    out = []
+    for i in range(functions):
+        out.extend([
+            f"def command_{i}(args, verbose=False, output=None):",
+            f"    result = []",
+            f"    errors = {{}}",
+            f"    for a in args:",
+            f"        if verbose:",
+            f"            print('command {i}: processing', a)",
+            f"        try:",
+            f"            value = int(a) * {i % 7 + 1}",
+            f"        except ValueError as e:",
+            f"            errors[a] = 'invalid argument for command {i}: ' + str(e)",
+            f"            continue",
+            f"        if value > {i % 100 + 10}:",
+            f"            result.append(('large', value, str(value).rjust(8)))",
+            f"        elif value < 0:",
+            f"            result.append(('negative', -value, 'n/a'))",
+            f"        else:",
+            f"            result.append(('small', value, hex(value)))",
+            f"    summary = {{'name': 'command_{i}', 'count': len(result), 'errors': errors,",
+            f"               'total': sum(x[1] for x in result), 'kinds': sorted(set(x[0] for x in result))}}",
+            f"    if output is not None:",
+            f"        output.write(repr(summary))",
+            f"    return summary",
+            "",
+        ])
+    out.append(f"RESULTS = [globals()['command_' + str(i)]([1, 2]) for i in range({CALLED})]")
+    return "\n".join(out)
+
+
+def build(source: str, lazy: bool):
+    launcher = transformers.ConstructDynamicCodeObject()
+    launcher.config["lazy_decrypt"].value = lazy
+    tree = launcher.transform(ast.parse(source), "bench.py", None, None)
+    src = NonEscapingUnparser().visit(ast.fix_missing_locations(tree))
+    return compile(src, "bench.py", "exec"), len(src)  # compiled ahead of time, like a cached .pyc
+
+
+def bench(code) -> float:
+    best = None
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        exec(code, {"__name__": "bench"})
+        took = time.perf_counter() - start
+        best = took if best is None else min(best, took)
+    return best
+
+
+def check():
+    for lazy in [False, True]:
+        code, _ = build(SHARED_CODE, lazy)
+        g = {"__name__": "check"}
+        exec(code, g)
+        assert g["RESULTS"] == ["CA", "CB", "CA", "CB"], f"{'lazy' if lazy else 'eager'}: {g['RESULTS']}"
+
+
+def main():
+    check()
+    for functions in [250, 1000, 4000]:
+        source = generate_module(functions)
+        print(f"{functions} functions, {CALLED} called")
+        for lazy in [False, True]:
+            code, size = build(source, lazy)
+            took = bench(code)
+            print(f"  {'lazy' if lazy else 'eager':>5}: {took * 1000:8.1f} ms startup, {size / 1024:8.1f} KiB output")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmarks peak memory of transitive mode against the size of the project, with and without low_memory. Obfuscates
+generated projects of growing size with the renamer in one process, and reads the peak memory the obfuscator reports.
+Without low_memory it grows with the project, with it it should stay about the same, since the modules are all the
+same size.
+
+Usage: python benchmarks/bench_low_memory.py [modules...]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import tomlkit
+
+from bench_transitive import OBFUSCATOR, generate_project
+
+
+def configure(root: str, low_memory: bool):
+    config = os.path.join(root, "config.toml")
+    if not os.path.exists(config):
+        subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True)  # creates the example config
+    with open(config, "r", encoding="utf8") as f:
+        doc = tomlkit.loads(f.read())
+    doc["general"]["input_file"] = os.path.join(root, "main.py")
+    doc["general"]["output_file"] = os.path.join(root, "out")
+    doc["general"]["workers"] = 1  # workers in this process, so its peak covers them
+    doc["general"]["incremental"] = False
+    doc["general"]["low_memory"] = low_memory
+    for seg in doc.values():
+        if "enabled" in seg:
+            seg["enabled"] = False
+    doc["renamer"]["enabled"] = True
+    with open(config, "w", encoding="utf8") as f:
+        f.write(tomlkit.dumps(doc))
+
+
+def run(root: str) -> tuple[float, str]:
+    """
+    :return: Wall time, and the peak memory the run reported
+    """
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True, check=True, text=True,
+                       env={**os.environ, "COLUMNS": "300"})
+    took = time.perf_counter() - start
+    line = next((x.strip() for x in p.stdout.splitlines() if "Peak memory:" in x), "")
+    return took, line[line.index("Peak memory:"):].split("  ")[0] if line else "no peak memory reported"
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [20, 80]
+    for modules in sizes:
+        with tempfile.TemporaryDirectory() as root:
+            generate_project(root, modules)
+            for low_memory in [False, True]:
+                configure(root, low_memory)
+                took, peak = run(root)
+                print(f"{modules:4} modules, low_memory {'on ' if low_memory else 'off'}: {took:7.2f} s, {peak}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmarks writing .pyc files instead of source, with dynamicCodeObjLauncher: how long obfuscating a generated project
+takes, and how long importing the result takes. Source output is imported both without and with python caching the
+compiled files in __pycache__, since a deployment often can't write there, and the first import never can.
+
+Usage: python benchmarks/bench_pyc.py [modules] [imports]
+"""
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import tomlkit
+
+from bench_transitive import OBFUSCATOR, generate_project
+
+IMPORT = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+
+def configure(root: str, output_format: str):
+    config = os.path.join(root, "config.toml")
+    if not os.path.exists(config):
+        subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True)  # creates the example config
+    with open(config, "r", encoding="utf8") as f:
+        doc = tomlkit.loads(f.read())
+    doc["general"]["input_file"] = os.path.join(root, "main.py")
+    doc["general"]["output_file"] = os.path.join(root, "out")
+    doc["general"]["output_format"] = output_format
+    for seg in doc.values():
+        if "enabled" in seg:
+            seg["enabled"] = False
+    doc["dynamicCodeObjLauncher"]["enabled"] = True
+    with open(config, "w", encoding="utf8") as f:
+        f.write(tomlkit.dumps(doc))
+
+
+def obfuscate(root: str) -> float:
+    shutil.rmtree(os.path.join(root, "out"), ignore_errors=True)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def import_time(root: str, imports: int, write_bytecode: bool) -> float:
+    """
+    :return: Median time importing the obfuscated main module takes, in a fresh interpreter each time
+    """
+    out = os.path.join(root, "out")
+    shutil.rmtree(os.path.join(out, "__pycache__"), ignore_errors=True)
+    env = {**os.environ}
+    if write_bytecode:
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        subprocess.run([sys.executable, "-c", "import main"], cwd=out, check=True, capture_output=True, env=env)
+    else:
+        env["PYTHONDONTWRITEBYTECODE"] = "1"
+    times = []
+    for _ in range(imports):
+        p = subprocess.run([sys.executable, "-c", IMPORT], cwd=out, check=True, capture_output=True, text=True,
+                           env=env)
+        times.append(float(p.stdout.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def main():
+    modules = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    imports = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"{modules} modules")
+    with tempfile.TemporaryDirectory() as root:
+        generate_project(root, modules)
+        for output_format in ["source", "pyc"]:
+            configure(root, output_format)
+            took = obfuscate(root)
+            print(f"  {output_format:>6}: obfuscating {took:6.2f} s")
+            if output_format == "source":
+                print(f"          importing {import_time(root, imports, False) * 1000:8.1f} ms (not cached)")
+                print(f"          importing {import_time(root, imports, True) * 1000:8.1f} ms (cached in __pycache__)")
+            else:
+                print(f"          importing {import_time(root, imports, False) * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
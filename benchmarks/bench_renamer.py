@@ -0,0 +1,65 @@
+"""
+Benchmarks the renamer on generated modules of increasing size.
+Renaming should scale roughly linearly with the amount of lines in the module.
+Both renamer engines are measured, so they can be compared.
+
+Usage: python benchmarks/bench_renamer.py
+"""
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator"))
+
+import transformers  # noqa: E402
+
+
+def generate_module(lines: int) -> str:
+    out = []
+    i = 0
+    while len(out) < lines:
+        out.extend([
+            f"CONST_{i} = {i}",
+            f"class Thing{i}:",
+            f"    def __init__(self, a{i}, b{i}=2):",
+            f"        self.a = a{i}",
+            f"        self.b = b{i}",
+            f"    def total(self, extra):",
+            f"        local_{i} = self.a + self.b",
+            f"        return local_{i} + extra + CONST_{i}",
+            f"def func_{i}(n):",
+            f"    acc = []",
+            f"    for j in range(n):",
+            f"        acc.append(j * CONST_{i})",
+            f"    squares = [v * v for v in acc]",
+            f"    return Thing{i}(n, squares).total(len(acc))",
+            "",
+        ])
+        i += 1
+    return "\n".join(out)
+
+
+def bench(lines: int, engine: str) -> float:
+    tree = ast.parse(generate_module(lines))
+    renamer = transformers.MemberRenamer()
+    renamer.config["engine"].value = engine
+    start = time.perf_counter()
+    renamer.transform(tree, "bench.py", None, None)
+    return time.perf_counter() - start
+
+
+def main():
+    for engine in ["visitor", "singlepass"]:
+        print(f"Engine {engine}")
+        base = None
+        for lines in [2500, 5000, 10000, 20000]:
+            took = bench(lines, engine)
+            per_line = took / lines
+            if base is None:
+                base = per_line
+            print(f"{lines:>6} lines: {took * 1000:9.1f} ms, {per_line * 1e6:6.2f} us/line ({per_line / base:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmarks reading and parsing in transitive mode on a generated project: dependency discovery followed by taking
+every AST to transform it, like a build with one worker does. Counts the parses, which should be one per file with a
+fresh store, and none for discovery with a persisted one.
+
+Usage: python benchmarks/bench_sources.py [modules]
+"""
+import ast
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator"))
+
+from bench_transitive import generate_project  # noqa: E402
+from depgraph import ModuleIndex, crawl  # noqa: E402
+from sources import SourceStore  # noqa: E402
+
+parses = 0
+real_parse = ast.parse
+
+
+def counting_parse(*args, **kwargs):
+    global parses
+    parses += 1
+    return real_parse(*args, **kwargs)
+
+
+ast.parse = counting_parse
+
+
+def run(root: str, store: SourceStore, take: bool) -> tuple[float, float, int]:
+    """
+    :return: Time spent on discovery, time spent taking the ASTs, parses
+    """
+    global parses
+    parses = 0
+    start = time.perf_counter()
+    graph = crawl(os.path.join(root, "main.py"), ModuleIndex([root]), store)
+    discovered = time.perf_counter()
+    if take:
+        for f in graph.files:
+            store.get(f).take_tree()
+    return discovered - start, time.perf_counter() - discovered, parses
+
+
+def main():
+    modules = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as root:
+        generate_project(root, modules)
+        kept = os.path.join(root, "sources.bin")
+        for name, take in [("fresh store", True), ("persisted store", False)]:
+            store = SourceStore(kept)
+            discovery, taking, n = run(root, store, take)
+            store.save()
+            print(f"{modules} modules, {name:>15}: discovery {discovery * 1000:8.1f} ms, "
+                  f"taking ASTs {taking * 1000:8.1f} ms, {n} parses")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmarks transitive obfuscation of a generated project with a lot of modules importing each other, with different
+amounts of worker processes. Wall time should go down with workers, up to the amount of cores.
+
+Usage: python benchmarks/bench_transitive.py [modules]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import tomlkit
+
+OBFUSCATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator")
+
+
+def generate_project(root: str, modules: int):
+    for i in range(modules):
+        out = [f"import mod_{j}" for j in range(max(0, i - 3), i)]
+        for k in range(40):
+            out.extend([
+                f"class Model{k}:",
+                f"    def __init__(self, name='model {i}.{k}', size={k}):",
+                f"        self.name = name",
+                f"        self.size = size",
+                f"    def describe(self, extra):",
+                f"        return f'{{self.name}} ({{self.size}}): ' + ', '.join(str(x * {k}) for x in extra)",
+                f"def build_{k}(n):",
+                f"    return [Model{k}(size=x).describe(range(x)) for x in range(n) if x % {k % 5 + 2}]",
+                "",
+            ])
+        with open(os.path.join(root, f"mod_{i}.py"), "w", encoding="utf8") as f:
+            f.write("\n".join(out))
+    with open(os.path.join(root, "main.py"), "w", encoding="utf8") as f:
+        f.write("\n".join(f"import mod_{i}" for i in range(modules)))
+
+
+def run(root: str, workers: int) -> float:
+    subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True)  # creates the example config
+    with open(os.path.join(root, "config.toml"), "r", encoding="utf8") as f:
+        doc = tomlkit.loads(f.read())
+    doc["general"]["input_file"] = os.path.join(root, "main.py")
+    doc["general"]["output_file"] = os.path.join(root, "out")
+    doc["general"]["workers"] = workers
+    doc["general"]["incremental"] = False  # every run obfuscates everything
+    for seg in doc.values():
+        if "enabled" in seg:
+            seg["enabled"] = True
+    with open(os.path.join(root, "config.toml"), "w", encoding="utf8") as f:
+        f.write(tomlkit.dumps(doc))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, OBFUSCATOR], cwd=root, capture_output=True, check=True)
+    took = time.perf_counter() - start
+    os.remove(os.path.join(root, "config.toml"))
+    return took
+
+
+def main():
+    modules = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    print(f"{modules} modules, {os.cpu_count()} cores")
+    with tempfile.TemporaryDirectory() as root:
+        generate_project(root, modules)
+        base = None
+        for workers in [1, 2, 4, 8]:
+            took = run(root, workers)
+            base = base or took
+            print(f"  {workers} workers: {took:8.2f} s, {base / took:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+from ast import *
+from typing import Any
+
+from util import ScopeBindings
+
+
+class FunctionInfo:
+    """
+    What the analysis found out about a function or lambda
+    """
+
+    def __init__(self, qualname: str):
+        self.qualname = qualname  # as in __qualname__
+
+
+class FileAnalysis(ScopeBindings):
+    """
+    Facts about a file, collected in a single walk before transforming it: the names bound in each scope (see
+    ScopeBindings), the names it mentions and the functions with their qualified names. Transformers and the cost aware
+    features look these up instead of walking the file for them themselves. An analysis is only valid for the AST it
+    was made for, see get_analysis
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.functions: dict[AST, FunctionInfo] = {}  # in the order they appear in the file
+        self.referenced_names: set[str] = set()  # every name, attribute and imported name the file mentions
+        self._path: list[str] = []
+
+    def visit(self, node: AST) -> Any:
+        t = type(node)
+        if t is Name:
+            self.referenced_names.add(node.id)
+        elif t is Attribute:
+            self.referenced_names.add(node.attr)
+        elif t is Import or t is ImportFrom:
+            self.referenced_names.update(x.name for x in node.names)
+        return super().visit(node)
+
+    def _visit_function(self, node: FunctionDef | AsyncFunctionDef | Lambda):
+        name = "<lambda>" if isinstance(node, Lambda) else node.name
+        self.functions[node] = FunctionInfo(".".join([*self._path, name]))
+        self._path.extend([name, "<locals>"])
+        super()._visit_function(node)
+        del self._path[-2:]
+
+    def visit_ClassDef(self, node: ClassDef) -> Any:
+        self._path.append(node.name)
+        super().visit_ClassDef(node)
+        self._path.pop()
+
+
+def get_analysis(module: AST) -> FileAnalysis:
+    """
+    Gets the analysis of a file, analyzing it if that didn't happen since it last changed
+    :param module: The file
+    :return: The analysis
+    """
+    analysis = getattr(module, "analysis", None)
+    if analysis is None:
+        analysis = FileAnalysis()
+        analysis.visit(module)
+        module.analysis = analysis
+    return analysis
+
+
+def invalidate_analysis(module: AST):
+    """
+    Drops the analysis of a file, after it was transformed
+    """
+    if hasattr(module, "analysis"):
+        del module.analysis
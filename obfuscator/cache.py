@@ -0,0 +1,104 @@
+import json
+import os.path
+import sys
+from typing import Any
+
+from manifest import digest, digest_value
+
+
+def tool_digest() -> str:
+    """
+    Digests the obfuscator itself, so a different version of it doesn't reuse what this one produced
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    parts = [f"{sys.version_info[0]}.{sys.version_info[1]}"]  # the ast and unparsing change between versions
+    for name in sorted(os.listdir(here)):
+        if name.endswith(".py"):
+            with open(os.path.join(here, name), "rb") as f:
+                parts.append(name + ":" + digest(f.read()))
+    return digest_value(parts)
+
+
+class ArtifactCache:
+    """
+    A content addressed cache of obfuscated files in a plain directory, which any amount of runs can share. Entries
+    are keyed by everything the output of a file depends on, and hold its source and exports. Least recently used
+    entries are evicted once the cache grows past its size limit. Entries are written atomically, so concurrent runs
+    at worst obfuscate the same file twice
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.size = 0  # bytes in the cache, after the last eviction
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key: str) -> tuple[str, dict[str, Any]] | None:
+        """
+        Looks an entry up, and marks it as used
+        :return: The obfuscated source and the exports, or None if there is no entry, or it isn't one this wrote
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                d = json.load(f)
+        except (OSError, ValueError):
+            d = None
+        if not isinstance(d, dict) or not isinstance(d.get("output"), str) or not isinstance(d.get("exports"), dict):
+            self.misses += 1  # no entry, or one that's truncated or edited by hand. obfuscated again then
+            return None
+        try:
+            os.utime(path)  # modification time is the last use, for eviction
+        except OSError:  # evicted by someone else in the meantime, still got it though
+            pass
+        self.hits += 1
+        return d["output"], d["exports"]
+
+    def put(self, key: str, output: str, exports: dict[str, Any]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf8") as f:
+            json.dump({"output": output, "exports": exports}, f)
+        os.replace(tmp, path)
+        self.stores += 1
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits its size limit again
+        """
+        entries = []
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for x in os.scandir(shard.path):
+                if x.name.endswith(".json"):
+                    try:
+                        st = x.stat()
+                    except OSError:  # evicted by someone else in the meantime
+                        continue
+                    entries.append((st.st_mtime_ns, st.st_size, x.path))
+        self.size = sum(x[1] for x in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            self.size -= size
+
+    def summary(self) -> str:
+        looked_up = self.hits + self.misses
+        rate = f" ({self.hits / looked_up * 100:.0f}% hit rate)" if looked_up > 0 else ""
+        return (f"Cache: {self.hits} hits, {self.misses} misses{rate}, {self.stores} stored, {self.evictions} evicted, "
+                f"{self.size / 1024 / 1024:.1f} of {self.max_bytes / 1024 / 1024:.0f} MB used")
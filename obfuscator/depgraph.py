@@ -0,0 +1,188 @@
+import os.path
+
+from util import import_key
+
+# what each part of a dotted module name resolves to: (directory to look for its submodules in, file of the module).
+# plain modules have no directory, namespace packages no file
+Found = tuple[str | None, str | None]
+
+
+class ModuleIndex:
+    """
+    Resolves module names to local files. Each directory is listed once, the first time an import looks into it, so
+    resolving an import looks names up instead of asking the file system about every path it could be at
+    """
+
+    def __init__(self, roots: list[str]):
+        """
+        :param roots: The directories absolute imports are resolved from, in order, like sys.path. The first one should
+                      be the directory of the input file, since python puts that first when running it
+        """
+        self.roots = [os.path.abspath(x) for x in roots]
+        self.listings: dict[str, tuple[dict[str, str], dict[str, str]]] = {}
+
+    def _listing(self, directory: str) -> tuple[dict[str, str], dict[str, str]]:
+        """
+        :return: The modules (name -> file) and subdirectories (name -> path) of a directory that could be imported
+        """
+        r = self.listings.get(directory)
+        if r is not None:
+            return r
+        modules, dirs = {}, {}
+        try:
+            with os.scandir(directory) as it:
+                for x in it:
+                    if x.name.endswith(".py") and x.name[:-3].isidentifier() and x.is_file():
+                        modules[x.name[:-3]] = x.path
+                    elif x.name.isidentifier() and x.name != "__pycache__" and x.is_dir():
+                        dirs[x.name] = x.path
+        except OSError:  # not a directory, or gone
+            pass
+        r = self.listings[directory] = (modules, dirs)
+        return r
+
+    def _find_in(self, directory: str, name: str) -> Found | None:
+        modules, dirs = self._listing(directory)
+        sub = dirs.get(name)
+        if sub is not None:
+            init = self._listing(sub)[0].get("__init__")
+            if init is not None:  # regular packages win over modules of the same name, like python does it
+                return sub, init
+        if name in modules:
+            return None, modules[name]
+        if sub is not None:
+            return sub, None  # namespace package
+        return None
+
+    def find(self, directory: str, name: str) -> list[Found] | None:
+        """
+        Resolves a dotted module name inside a directory
+        :return: What each part of the name resolves to, None if it doesn't
+        """
+        chain = []
+        for part in name.split("."):
+            if directory is None:  # plain modules don't have submodules
+                return None
+            found = self._find_in(directory, part)
+            if found is None:
+                return None
+            chain.append(found)
+            directory = found[0]
+        return chain
+
+    def resolve_imports(self, file: str,
+                        imports: list[tuple[str | None, int, list[str] | None]]) -> tuple[dict[str, str], list[str]]:
+        """
+        Resolves the imports of a file, see SourceFile.imports
+        :return: Import key -> file it resolves to (see import_key), and all local files the imports load. The latter
+                 includes the packages an import loads on the way to the module, and submodules imported from packages
+        """
+        here = os.path.dirname(os.path.abspath(file))
+        resolved = {}
+        loaded = {}  # ordered set
+        for module, level, names in imports:
+            if level == 0:
+                chain = next((c for c in (self.find(x, module) for x in self.roots) if c is not None), None)
+                if chain is None and here not in self.roots:
+                    chain = self.find(here, module)  # implicit relative import, like python 2 did them
+            else:
+                base = here
+                for _ in range(level - 1):
+                    base = os.path.dirname(base)
+                chain = self.find(base, module) if module else [(base, self._listing(base)[0].get("__init__"))]
+            if chain is None:
+                continue  # not ours
+            for _, f in chain:
+                if f is not None:
+                    loaded[f] = None
+            directory, f = chain[-1]
+            if f is not None:
+                resolved[import_key(module, level)] = f
+            if names is None or directory is None:
+                continue
+            for name in names:  # "from package import submodule"
+                if name == "*":
+                    continue
+                found = self._find_in(directory, name)
+                if found is not None and found[1] is not None:
+                    resolved[import_key(module, level, name)] = found[1]
+                    loaded[found[1]] = None
+        return resolved, list(loaded)
+
+
+class ImportGraph:
+    """
+    The local files a program consists of, and which of them import which
+    """
+
+    def __init__(self, start: str):
+        self.start = start
+        self.files: list[str] = [start]  # the start file first, then the others breadth first
+        self.imports: dict[str, list[str]] = {}  # file -> files it loads
+        self.importers: dict[str, list[str]] = {}  # file -> files loading it
+        self.import_map: dict[str, dict[str, str]] = {}  # file -> {import key: file it resolves to}
+
+    def add(self, file: str, resolved: dict[str, str], loaded: list[str]):
+        self.import_map[file] = resolved
+        self.imports[file] = loaded
+        self.importers.setdefault(file, [])
+        for x in loaded:
+            self.importers.setdefault(x, []).append(file)
+
+    def dependents(self, files: list[str]) -> set[str]:
+        """
+        :return: The files, and every file loading one of them, directly or not
+        """
+        r = set(files)
+        work = list(files)
+        while len(work) > 0:
+            for x in self.importers.get(work.pop(), []):
+                if x not in r:
+                    r.add(x)
+                    work.append(x)
+        return r
+
+    def sort(self):
+        """
+        Orders the files breadth first from the start file, and the importers of each file the same way
+        """
+        self.files = [self.start]
+        position = {self.start: 0}
+        for f in self.files:  # grows while iterating
+            for x in self.imports[f]:
+                if x not in position:
+                    position[x] = len(self.files)
+                    self.files.append(x)
+        for f in self.importers.values():
+            f.sort(key=position.__getitem__)
+
+
+def crawl(start: str, index: ModuleIndex, store, keep_trees: bool = True) -> ImportGraph:
+    """
+    Finds all local files the start file loads, directly or not. Each file is read and parsed once, when it's found,
+    and its imports resolved right after. Parsing holds the GIL, so threads wouldn't make this any faster
+    :param start:      The file to start at
+    :param index:      The index to resolve imports with
+    :param store:      The SourceStore to read the files from, so they're read and parsed once for everything needing
+                       them
+    :param keep_trees: Keeps the parsed ASTs in the store, for whoever transforms the files next. If not, every fact
+                       about the files is found out right away instead, see SourceFile.learn
+    :return: The graph. Files are absolute paths
+    """
+    start = os.path.abspath(start)
+    graph = ImportGraph(start)
+    seen = {start}
+    todo = [start]
+    while len(todo) > 0:
+        file = todo.pop()
+        source = store.get(file)
+        if not keep_trees and not source.learned:  # otherwise known from the last run, no need to parse it
+            source.learn()
+        resolved, loaded = index.resolve_imports(file, source.imports)
+        graph.add(file, resolved, loaded)
+        for x in loaded:
+            if x not in seen:
+                seen.add(x)
+                todo.append(x)
+    graph.sort()  # the graph shouldn't depend on the order files are found in
+    return graph
@@ -0,0 +1,224 @@
+import ast as _ast
+import gc
+from ast import *
+from typing import Any, Callable
+
+from analysis import invalidate_analysis
+
+SKIP = object()  # returned by enter hooks, to not visit a node and its children with that transformer
+
+_HOOK_KINDS = ("replace", "enter", "rewrite", "leave")
+
+
+def node_hooks(t: Any) -> dict[type, tuple[Callable | None, ...]]:
+    """
+    Collects the hooks of a transformer, by the node types they handle. Hooks are methods named after the node type:
+    replace_X(node) replaces a node before visiting it, returning the replacement or None to keep it. The transformer
+    replacing a node doesn't visit the replacement, the transformers after it do.
+    enter_X(node) and leave_X(node) keep track of context, like loops or f-strings. enter_X returns SKIP to skip the
+    node and its children.
+    rewrite_X(node) rewrites a node after visiting its children, returning the node, a replacement, a list of nodes or
+    None, like NodeTransformer's visit methods
+    :return: Node type -> (replace, enter, rewrite, leave)
+    """
+    hooks: dict[type, list[Callable | None]] = {}
+    for name in dir(type(t)):
+        kind, _, type_name = name.partition("_")
+        if kind not in _HOOK_KINDS or not type_name[:1].isupper():
+            continue
+        node_type = getattr(_ast, type_name)
+        hooks.setdefault(node_type, [None] * len(_HOOK_KINDS))[_HOOK_KINDS.index(kind)] = getattr(t, name)
+    return {k: tuple(v) for k, v in hooks.items()}
+
+
+def can_fuse(t: Any) -> bool:
+    return getattr(t, "fusible", False)
+
+
+def plan_passes(transformers: list) -> list[list]:
+    """
+    Groups transformers into passes over the AST, keeping their order. Transformers that can't be fused get a pass of
+    their own. A transformer starts a new pass if it replaces nodes before visiting them, since it has to see them
+    before anyone else does, or if it keeps track of context in nodes a transformer before it in the pass rewrites
+    after visiting them, since those are already rewritten by the time it would leave them
+    :return: The passes, in order
+    """
+    passes = []
+    current = []
+    rewritten: set[type] = set()
+    for t in transformers:
+        if not can_fuse(t):
+            if len(current) > 0:
+                passes.append(current)
+            passes.append([t])
+            current, rewritten = [], set()
+            continue
+        hooks = node_hooks(t)
+        replaces = any(x[0] is not None for x in hooks.values())
+        context = {k for k, x in hooks.items() if x[1] is not None or x[3] is not None}
+        if len(current) > 0 and (replaces or len(context & rewritten) > 0):
+            passes.append(current)
+            current, rewritten = [], set()
+        current.append(t)
+        rewritten |= {k for k, x in hooks.items() if x[2] is not None}
+    if len(current) > 0:
+        passes.append(current)
+    return passes
+
+
+class WalkContext:
+    """
+    Where a traversal currently is, tracked once for all transformers of a pass instead of by each of them. Unlike the
+    analysis, this also covers nodes created during the pass
+    """
+
+    def __init__(self):
+        self.fstring_depth = 0  # f-strings the current node is in
+        self.fstring_literal = False  # is the current node a literal part of an f-string, outside of its {} fields?
+
+
+class FusedPass:
+    """
+    Runs several transformers in a single traversal of the AST, with the same result as running them one after another.
+    Whatever a transformer creates is visited by the transformers after it, but not by itself or the ones before it,
+    just like it would be if each of them made a pass of its own. Transformers get begin(ast, file) called before the
+    traversal, and finish(ast) after it, in order. begin sees the AST before any transformer of the pass changed it.
+    Every transformer gets the context of the pass as its context attribute
+    """
+
+    def __init__(self, transformers: list):
+        self.transformers = transformers
+        self.context = WalkContext()
+        for t in transformers:
+            t.context = self.context
+        self.hooks: dict[type, list[tuple[int, ...]]] = {}  # node type -> (bit of the transformer, *hooks)
+        for i, t in enumerate(transformers):
+            for node_type, hooks in node_hooks(t).items():
+                self.hooks.setdefault(node_type, []).append((1 << i, *hooks))
+        self.done: set[AST] = set()  # nodes all transformers are done with
+
+    def run(self, ast: AST, current_file_name) -> AST:
+        # the pass allocates lots of nodes, none of them in cycles. the cyclic gc would keep traversing the entire AST
+        # for nothing, which takes longer than the pass itself on big files
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for t in self.transformers:
+                t.begin(ast, current_file_name)
+            everyone = (1 << len(self.transformers)) - 1
+            ast = self.visit(ast, everyone)
+            for i, t in enumerate(self.transformers):
+                ast = self.visit_new(t.finish(ast), ast, everyone & ~((2 << i) - 1))
+            invalidate_analysis(ast)
+            return ast
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def visit(self, node: AST, mask: int) -> Any:
+        """
+        Visits a node with the transformers in mask
+        :return: What to replace the node with, like NodeTransformer.visit
+        """
+        if mask == 0:
+            # nothing to do in here. marking the node is enough for nobody to visit anything in it later, since
+            # visits never go past nodes that are done
+            self.done.add(node)
+            return node
+        hooks = self.hooks.get(type(node))
+        if hooks is None:
+            self.visit_children_in_context(node, mask)
+            self.done.add(node)
+            return node
+        entered = []
+        for bit, replace, enter, rewrite, leave in hooks:
+            if not mask & bit:
+                continue
+            if replace is not None:
+                r = replace(node)
+                if r is not None:
+                    self.done.add(node)
+                    return self.visit_new(r, node, mask & ~(2 * bit - 1))
+            if enter is not None and enter(node) is SKIP:
+                mask &= ~bit
+                continue
+            entered.append((bit, rewrite, leave))
+        self.visit_children_in_context(node, mask)
+        result = node
+        for bit, rewrite, _ in entered:
+            if rewrite is None or result is not node:  # replaced by a transformer before, which visited the replacement
+                continue
+            r = rewrite(node)
+            result = self.visit_new(r, node, mask & ~(2 * bit - 1))
+        for _, _, leave in reversed(entered):
+            if leave is not None:
+                leave(node)
+        self.done.add(node)
+        return result
+
+    def visit_new(self, new: Any, old: AST, mask: int) -> Any:
+        """
+        Visits what a transformer replaced a node with, with the transformers after it. Anything in there that's already
+        done, like children of the old node, is skipped
+        :return: What to replace the old node with
+        """
+        if new is None:
+            return None
+        if isinstance(new, list):
+            out = []
+            for x in new:
+                r = self.visit_new(x, old, mask)
+                if r is None:
+                    continue
+                if isinstance(r, list):
+                    out.extend(r)
+                else:
+                    out.append(r)
+            return out
+        if new is old:
+            if mask != 0:
+                self.visit_children(new, mask)
+            return new
+        if new in self.done:
+            return new
+        return self.visit(new, mask)
+
+    def visit_children_in_context(self, node: AST, mask: int):
+        t = type(node)
+        if t is not JoinedStr and t is not FormattedValue:
+            self.visit_children(node, mask)
+            return
+        ctx = self.context
+        prev = ctx.fstring_literal
+        if t is JoinedStr:
+            ctx.fstring_depth += 1
+            ctx.fstring_literal = True
+            self.visit_children(node, mask)
+            ctx.fstring_depth -= 1
+        else:
+            ctx.fstring_literal = False
+            self.visit_children(node, mask)
+        ctx.fstring_literal = prev
+
+    def visit_children(self, node: AST, mask: int):
+        done = self.done
+        for field in node._fields:
+            old = getattr(node, field, None)
+            if isinstance(old, list):
+                new = []
+                for x in old:
+                    if isinstance(x, AST) and x not in done:
+                        x = self.visit(x, mask)
+                        if x is None:
+                            continue
+                        if isinstance(x, list):
+                            new.extend(x)
+                            continue
+                    new.append(x)
+                old[:] = new
+            elif isinstance(old, AST) and old not in done:
+                r = self.visit(old, mask)
+                if r is None:
+                    delattr(node, field)
+                else:
+                    setattr(node, field, r)
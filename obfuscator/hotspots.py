@@ -0,0 +1,110 @@
+import json
+import os.path
+import pstats
+from ast import *
+
+from analysis import FileAnalysis
+
+
+class Profile:
+    """
+    Call counts of functions, out of a profile of the program under real load
+    """
+
+    def __init__(self):
+        self.by_location: dict[tuple[str, int, str], int] = {}  # (file name, first line, function name) -> calls
+        self.by_name: dict[str, int] = {}  # qualified name, and all of its shortened forms -> calls
+        self.by_exact_name: dict[str, int] = {}
+
+    def add_location(self, file: str, line: int, name: str, calls: int):
+        key = (os.path.basename(file), line, name)
+        self.by_location[key] = max(self.by_location.get(key, 0), calls)
+
+    def add_name(self, name: str, calls: int):
+        """
+        Adds a function by qualified name. The name can be shortened from the front, down to the module's own name,
+        so "pkg.util.Parser.parse" also matches "util.Parser.parse"
+        :param name:  module.qualname of the function
+        :param calls: How often it got called
+        """
+        self.by_exact_name[name] = max(self.by_exact_name.get(name, 0), calls)
+        parts = name.split(".")
+        for i in range(len(parts)):
+            k = ".".join(parts[i:])
+            self.by_name[k] = max(self.by_name.get(k, 0), calls)
+
+    def calls(self, file: str, node: FunctionDef | AsyncFunctionDef, qualname: str) -> int:
+        """
+        Gets how often a function got called
+        :param file:     The file the function is in
+        :param node:     The function
+        :param qualname: The qualified name of the function in its module, as in __qualname__
+        :return: The amount of calls, 0 if the function isn't in the profile
+        """
+        base = os.path.basename(file)
+        # the code object starts at the first decorator, the def comes after
+        first_line = min([node.lineno, *[x.lineno for x in node.decorator_list]])
+        module = os.path.splitext(base)[0]
+        if module == "__init__":
+            module = os.path.basename(os.path.dirname(file))
+        return max(
+            self.by_location.get((base, first_line, node.name), 0),
+            self.by_location.get((base, first_line, qualname), 0),
+            self.by_name.get(f"{module}.{qualname}", 0),
+            self.by_exact_name.get(qualname, 0)
+        )
+
+
+def load_profile(path: str) -> Profile:
+    """
+    Loads a profile. Either a json list of {"name": "module.Class.function", "calls": 123} objects, or a cProfile /
+    pstats dump
+    :param path: The profile
+    :return: The loaded profile
+    """
+    profile = Profile()
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf8") as f:
+            entries = json.load(f)
+        for x in entries:
+            profile.add_name(x["name"], int(x["calls"]))
+    else:
+        stats: dict[tuple[str, int, str], tuple] = getattr(pstats.Stats(path), "stats")
+        for (file, line, name), (_, calls, *_) in stats.items():
+            profile.add_location(file, line, name, calls)
+    return profile
+
+
+def get_hot(node: AST) -> tuple[str, int] | None:
+    """
+    :return: (qualified name, calls) if the node is a hot function, None otherwise
+    """
+    return getattr(node, "hot", None)
+
+
+def has_hot_functions(module: AST) -> bool:
+    return len(getattr(module, "hot_functions", [])) > 0
+
+
+def mark_hot_functions(module: Module, analysis: FileAnalysis, file: str, profile: Profile,
+                       threshold: int) -> list[tuple[str, int, int]]:
+    """
+    Marks all functions of a module called at least threshold times in the profile as hot. Transformers check the
+    marks, and either skip hot functions or use a cheaper variant in them
+    :param module:    The module
+    :param analysis:  The analysis of the module, for the qualified names of its functions
+    :param file:      The path of the module
+    :param profile:   The profile
+    :param threshold: How often a function has to be called to be hot
+    :return: (qualified name, line, calls) of every hot function
+    """
+    hot_functions = []
+    for node, info in analysis.functions.items():
+        if isinstance(node, Lambda):
+            continue
+        calls = profile.calls(file, node, info.qualname)
+        if calls >= threshold:
+            node.hot = (info.qualname, calls)
+            hot_functions.append((info.qualname, node.lineno, calls))
+    module.hot_functions = hot_functions
+    return hot_functions
@@ -1,7 +1,12 @@
 import ast
+import base64
+import contextlib
+import importlib.util
 import os.path
+import sys
 from ast import *
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Executor, FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any
 
 import colorama
 import rich.tree
@@ -11,9 +16,21 @@ from rich.progress import track
 from tomlkit import *
 import time as tme
 
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
 import transformers as transf
+from analysis import get_analysis, invalidate_analysis
+from cache import ArtifactCache, tool_digest
 from cfg import *
-from util import NonEscapingUnparser, get_dependency_tree
+from depgraph import ImportGraph, ModuleIndex, crawl
+from fusion import FusedPass, plan_passes
+from hotspots import Profile, load_profile, mark_hot_functions as mark_hot
+from manifest import FileEntry, Manifest, digest, digest_file, digest_value, imported_digest
+from sources import SourceStore
+from util import NonEscapingUnparser, dump_code, seed_rng
 
 colorama.init()
 
@@ -26,11 +43,65 @@ general_settings = ConfigSegment(
     "General settings for the obfuscator",
     input_file=ConfigValue("The input for the obfuscator", "input.py"),
     output_file=ConfigValue("The output for the obfuscator", "output.py"),
-    transitive=ConfigValue("Resolves local imports from the target file and obfuscates them aswell", True)
+    transitive=ConfigValue("Resolves local imports from the target file and obfuscates them aswell", True),
+    profile=ConfigValue("A profile of the program under real load, to find hot functions with. Either a cProfile / "
+                        "pstats dump, or a json list of {\"name\": \"module.Class.function\", \"calls\": 123} objects.\n"
+                        "Leave empty to not use a profile",
+                        ""),
+    hot_threshold=ConfigValue("Functions called at least this many times in the profile are hot. Transformers either "
+                              "skip hot functions, or use a cheaper variant in them",
+                              10000),
+    workers=ConfigValue("Amount of processes obfuscating files in parallel in transitive mode. 0 uses one per cpu "
+                        "core, 1 obfuscates everything in this process",
+                        0),
+    fuse_passes=ConfigValue("Runs transformers that can share a traversal of the AST in a single one, instead of one "
+                            "traversal each",
+                            True),
+    incremental=ConfigValue("Only obfuscates the files that changed since the last run into the same output directory "
+                            "in transitive mode, and the files using something that changed in the files they import. "
+                            "Outputs that didn't change are left alone. Keeps track of what it obfuscated in a "
+                            "manifest in the output directory",
+                            False),
+    cache_dir=ConfigValue("A directory to cache obfuscated files in, which any amount of runs can share. Files are "
+                          "looked up by their contents, the config and what they use from the files they import, and "
+                          "taken from the cache instead of obfuscating them again. Leave empty to not use a cache",
+                          ""),
+    cache_size=ConfigValue("Maximum size of the cache in megabytes. The least recently used files get evicted "
+                           "once it's bigger",
+                           1024),
+    seed=ConfigValue("Seed for everything random the transformers do. Every file gets its own random stream, derived "
+                     "from the seed and its path relative to the input file, so the same input and config give the "
+                     "same output, whether obfuscated in parallel or not. Leave empty for a different output every run",
+                     ""),
+    source_roots=ConfigValue("Directories to resolve absolute imports from in transitive mode, after the directory of "
+                             "the input file. Like entries of sys.path, e.g. the src directory of a package the input "
+                             "file uses",
+                             []),
+    output_format=ConfigValue("What to write the obfuscated files as. \"source\" writes python source. \"pyc\" compiles "
+                              "them (with optimize=2) to .pyc files where the source would go, skipping turning the "
+                              "AST back into source, and python parsing that again when importing it. Python imports "
+                              "and runs them like source files, but only the python version that obfuscated them can. "
+                              "Refuses to run if the output directory already has source files where .pyc files would "
+                              "go, since python would import those instead",
+                              "source"),
+    low_memory=ConfigValue("Keeps only what each file exports in memory in transitive mode, instead of the ASTs of "
+                           "every file. Every worker obfuscates one file at a time from start to finish, and drops it "
+                           "once it's written. Files imported by other files get transformed twice, once to find out "
+                           "what they export, so this is slower",
+                           False),
+    source_cache=ConfigValue("A file to keep what parsing the input files found out in between runs: their imports, "
+                             "digests and the names they mention. Files with the same modification time and size as "
+                             "last time don't have to be parsed for that again. Leave empty to not keep it",
+                             "")
 )
 
+profile: Profile | None = None
+cache_base: str | None = None  # the part of cache keys every file shares, see cache_key
+sources = SourceStore()  # forked workers inherit it, with the ASTs parsed so far
+
 all_config_segments = [general_settings]
 
+# configured once, and never run directly. every file gets its own instances of them, see Transformer.for_file
 all_transformers = [
     x()
     for x in [
@@ -40,6 +111,7 @@ all_transformers = [
         transf.MemberRenamer,
         transf.ReplaceAttribs,
         transf.Collector,
+        transf.LoopHoister,
         transf.ConstructDynamicCodeObject,
     ]
 ]
@@ -103,12 +175,54 @@ def main():
             "Please [red]remove[/red] your current configuration file and regenerate it."
         )
         exit(1)
+    if general_settings["output_format"].value not in ("source", "pyc"):
+        console.log(f"Unknown output format {general_settings['output_format'].value!r}, expected \"source\" or "
+                    f"\"pyc\"", style="red")
+        exit(1)
+    if general_settings["profile"].value != "":
+        global profile
+        profile = load_profile(general_settings["profile"].value)
     if general_settings["transitive"].value:
         go_transitive()
     else:
         go_single()
 
 
+def mark_hot_functions(c_ast: AST, file: str):
+    """
+    Marks the functions of a file that are hot in the profile, if there is one
+    """
+    if profile is None:
+        return
+    threshold = general_settings["hot_threshold"].value
+    for qualname, line, calls in mark_hot(c_ast, get_analysis(c_ast), file, profile, threshold):
+        console.log(f"Hot function {qualname} at {os.path.basename(file)}:{line}: {calls} calls (threshold {threshold})",
+                    style="yellow")
+
+
+def get_passes(transformers_to_run: list[transf.Transformer]) -> list[list[transf.Transformer]]:
+    """
+    Groups transformers into passes over the AST, fusing them if enabled
+    """
+    if general_settings["fuse_passes"].value:
+        return plan_passes(transformers_to_run)
+    return [[t] for t in transformers_to_run]
+
+
+def run_pass(c_ast: AST, current_file_path, transformers_to_run: list[transf.Transformer]) -> AST:
+    """
+    Runs one pass of transformers on a file, with fresh instances of them
+    :return: The transformed AST
+    """
+    instances = [t.for_file() for t in transformers_to_run]
+    if len(instances) == 1:
+        c_ast = instances[0].transform(c_ast, current_file_path, None, None)
+    else:
+        c_ast = FusedPass(instances).run(c_ast, current_file_path)
+    invalidate_analysis(c_ast)
+    return c_ast
+
+
 def transform_source(c_ast: AST, source_file_name: str) -> AST:
     transformers_to_run = list(
         filter(lambda x: x.config["enabled"].value, all_transformers)
@@ -116,50 +230,702 @@ def transform_source(c_ast: AST, source_file_name: str) -> AST:
     if len(transformers_to_run) == 0:
         console.log("Nothing to do, bailing out", style="red")
         exit(0)
-    for t in track(transformers_to_run, description="Obfuscating...", console=console):
-        c_ast = t.transform(c_ast, source_file_name, None, None)  # just this one
-        console.log(f"Executed transformer {t.name}", style="green")
+    for p in track(get_passes(transformers_to_run), description="Obfuscating...", console=console):
+        c_ast = run_pass(c_ast, source_file_name, p)  # just this one
+        console.log(f"Executed transformer{'s' if len(p) > 1 else ''} {', '.join(t.name for t in p)}", style="green")
     fix_missing_locations(c_ast)
     return c_ast
 
 
-def do_obf(task: rich.progress.TaskID, progress: rich.progress.Progress, current_file_path, preparsed: AST, other_asts,
-           other_file_paths):
+def do_obf(current_file_path, preparsed: AST, transformers_to_run: list[transf.Transformer]) -> AST:
+    """
+    Runs a list of transformers on a single file. A transformer failing fails the file, since its output would be
+    written, cached and recorded as obfuscated otherwise
+    :return: The transformed AST
+    """
+    compiled_ast: AST = preparsed
+    for p in get_passes(transformers_to_run):
+        compiled_ast = run_pass(compiled_ast, current_file_path, p)
+    fix_missing_locations(compiled_ast)
+    return compiled_ast
+
+
+def do_collect(current_file_path, preparsed: AST, t: transf.Transformer,
+               previous_exports: Any = None) -> tuple[AST, Any]:
+    """
+    Runs the first phase of a transformer that links files on a single file
+    :return: The transformed AST, and the exports of this file
+    """
+    c_ast, exports = t.for_file().transform_collect(preparsed, current_file_path, previous_exports)
+    invalidate_analysis(c_ast)
+    return c_ast, exports
+
+
+def do_link(current_file_path, preparsed: AST, t: transf.Transformer, imports: dict[str, Any]) -> AST:
+    """
+    Runs the second phase of a transformer that links files on a single file
+    :return: The transformed AST
+    """
+    c_ast = t.for_file().transform_link(preparsed, current_file_path, imports)
+    invalidate_analysis(c_ast)
+    return c_ast
+
+
+def config_values() -> dict[str, dict[str, Any]]:
+    """
+    :return: All config values as plain python values, segment name -> key -> value. Used to configure worker processes
+    """
+    return {
+        seg.name: {k: seg[k].value.unwrap() if hasattr(seg[k].value, "unwrap") else seg[k].value for k in seg}
+        for seg in all_config_segments
+    }
+
+
+def config_digest() -> str:
+    """
+    Digests everything in the config that affects how a file is obfuscated. The profile counts with its contents
+    """
+    values = config_values()
+    general = values["general"]
+    for k in ["input_file", "output_file", "workers", "fuse_passes", "incremental", "cache_dir", "cache_size",
+              "source_roots", "low_memory", "source_cache"]:
+        del general[k]
+    if general["profile"] != "":
+        general["profile"] = digest_file(general["profile"])
+    return digest_value(values)
+
+
+def seed() -> str:
+    return str(general_settings["seed"].value)
+
+
+def seed_file(file: str, step: str):
+    """
+    Seeds the randomness for a step of obfuscating a file, see seed_rng
+    :param file: The path of the file
+    """
+    root = os.path.dirname(os.path.abspath(general_settings["input_file"].value))
+    seed_rng(seed(), os.path.relpath(os.path.abspath(file), root).replace(os.sep, "/"), step)
+
+
+def open_cache() -> ArtifactCache | None:
+    cache_dir = general_settings["cache_dir"].value
+    if cache_dir == "":
+        return None
+    return ArtifactCache(cache_dir, general_settings["cache_size"].value * 1024 * 1024)
+
+
+def cache_key(source_digest: str, file: str, imports: dict[str, str], pinned: Any) -> str:
+    """
+    The key a file is cached under. Covers everything its output depends on
+    :param source_digest: Digest of the dumped AST of the file, so formatting and comments don't matter
+    :param file:          The path of the file, relative to the output. Only matters with a profile or a seed
+    :param imports:       Module name, as imported by the file -> imported_digest of what the file uses from it
+    :param pinned:        What the file exported before, which linking transformers keep exporting
+    """
+    global cache_base
+    if cache_base is None:
+        cache_base = digest_value([tool_digest(), config_digest()])
+    path_matters = profile is not None or seed() != ""
+    return digest_value([cache_base, source_digest, file if path_matters else None, imports, pinned])
+
+
+def init_worker(values: dict[str, dict[str, Any]]):
+    """
+    Configures a worker process the same way as the main process. Forked workers already are, spawned ones are not
+    """
+    for seg in all_config_segments:
+        for k in seg:
+            seg[k].value = values[seg.name][k]
+    global profile
+    if profile is None and general_settings["profile"].value != "":
+        profile = load_profile(general_settings["profile"].value)
+
+
+worker_asts: dict[str, AST] = {}  # the files this worker is working on, file path -> current AST
+
+
+def run_step(phase: str, transformer_names: list[str], current_file_path: str, data: Any) -> Any:
+    """
+    Runs one step of a file on a worker. The worker keeps the AST of the file between steps, so only file paths,
+    exports and the final source have to be sent between processes, never an AST. Transformers are passed by name,
+    since every worker has its own
+    :param phase: "parse" and "write" to start and finish the file, "obf" to run the transformers, "collect" or
+                  "link" for the phases of a transformer that links files
+    :param data:  For "collect", what the file exported the last time it was obfuscated. For "link", the exports of
+                  the files it imports. For "write", the path to write the file to and whether to keep it unchanged,
+                  see write_output
+    :return: The exports of the file for "collect", the digest of the written output for "write", None otherwise
+    """
+    seed_file(current_file_path, phase + ":" + ",".join(transformer_names))
+    if phase == "parse":
+        c_ast = sources.get(current_file_path).take_tree()  # already parsed, unless this is a spawned worker
+        mark_hot_functions(c_ast, current_file_path)
+        worker_asts[current_file_path] = c_ast
+        return None
+    if phase == "write":
+        full_path, keep_unchanged = data
+        c_ast = worker_asts.pop(current_file_path)
+        if general_settings["output_format"].value == "pyc":
+            return write_output(full_path, compile_pyc(c_ast, os.path.basename(current_file_path)), keep_unchanged)
+        return write_output(full_path, NonEscapingUnparser().visit(c_ast), keep_unchanged)
+    by_name = {t.name: t for t in all_transformers}
+    transformers_to_run = [by_name[x] for x in transformer_names]
+    c_ast = worker_asts[current_file_path]
+    exports = None
     try:
-        transformers_to_run = list(
-            filter(lambda x: x.config["enabled"].value, all_transformers)
-        )
-        completed = -1
-        progress.update(task, total=len(transformers_to_run) + 1)  # transform+1
-        progress.start_task(task)
-        compiled_ast: AST = preparsed
-        progress.update(task, completed=(completed := completed + 1), description="Running transformers")
-        if len(transformers_to_run) == 0:
-            console.log("Nothing to do, bailing out", style="red")
-            exit(0)
-        for t in transformers_to_run:
-            progress.update(task, completed=(completed := completed + 1), description="Transformer " + t.name)
-            compiled_ast = t.transform(compiled_ast, current_file_path, other_asts, other_file_paths)
-        fix_missing_locations(compiled_ast)
-        # progress.update(task, completed=(completed := completed + 1), description="Writing")
-        # try:
-        #     src = NonEscapingUnparser().visit(compiled_ast)
-        # except Exception as e:
-        #     console.print_exception(max_frames=3)
-        #     if str(e) == "Unable to avoid backslash in f-string expression part":
-        #         console.log(
-        #             "[red]An error occurred with re-parsing the python AST into source code.[/red] AST was not able to escape ASCII characters in an "
-        #             "F-String expression. Please check if you have any ASCII characters in F-Strings, and escape them manually. "
-        #         )
-        #     exit(1)
-        #     return
-
-        # with open(output_file_path, "w", encoding="utf8") as f:
-        #     f.write(src)
-        #     f.flush()
-        progress.update(task, completed=(completed := completed + 1), description="Done")
+        if phase == "collect":
+            c_ast, exports = do_collect(current_file_path, c_ast, transformers_to_run[0], data)
+        elif phase == "link":
+            c_ast = do_link(current_file_path, c_ast, transformers_to_run[0], data)
+        else:
+            c_ast = do_obf(current_file_path, c_ast, transformers_to_run)
     except Exception:
-        console.print_exception(show_locals=True)
+        worker_asts.pop(current_file_path)  # the file failed, no step comes after this one
+        raise
+    worker_asts[current_file_path] = c_ast
+    return exports
+
+
+def run_file(current_file_path: str, plan: list[tuple[str, list[str], Any]],
+             output: tuple[str, bool] | None) -> tuple[str | None, list[Any]]:
+    """
+    Runs every step of a file on a worker in one go. Nothing of the file stays on the worker afterwards
+    :param plan:   The steps between parsing and writing the file: (phase, transformer names, data), see run_step
+    :param output: The path to write the file to and whether to keep it unchanged (see write_output), None to not
+                   write it
+    :return: The digest of the written output, None if not written. What each "collect" step returned, in order
+    """
+    try:
+        run_step("parse", [], current_file_path, None)
+        collected = []
+        for phase, names, data in plan:
+            r = run_step(phase, names, current_file_path, data)
+            if phase == "collect":
+                collected.append(r)
+        if output is None:
+            return None, collected
+        return run_step("write", [], current_file_path, output), collected
+    finally:
+        worker_asts.pop(current_file_path, None)
+
+
+def split_stages(transformers_to_run: list[transf.Transformer]) -> list[list[transf.Transformer]]:
+    """
+    Splits the transformers into stages that can run on each file independently. Transformers linking files each
+    get their own stage, since all files need to finish their first phase before any file can be linked
+    """
+    stages = []
+    current = []
+    for t in transformers_to_run:
+        if t.links_files:
+            if len(current) > 0:
+                stages.append(current)
+                current = []
+            stages.append([t])
+        else:
+            current.append(t)
+    if len(current) > 0:
+        stages.append(current)
+    return stages
+
+
+def dependency_order(all_files: list[str], import_map: dict[str, dict[str, str]]) -> list[int]:
+    """
+    Orders files so that files come after the files they import, as far as import cycles allow
+    :return: Indices into all_files
+    """
+    index = {f: i for i, f in enumerate(all_files)}
+    order = []
+    seen = set()
+    for root in range(len(all_files)):
+        if root in seen:
+            continue
+        seen.add(root)
+        stack = [(root, iter(import_map.get(all_files[root], {}).values()))]
+        while len(stack) > 0:
+            i, deps = stack[-1]
+            for dep in deps:
+                j = index.get(dep)
+                if j is not None and j not in seen:
+                    seen.add(j)
+                    stack.append((j, iter(import_map.get(dep, {}).values())))
+                    break
+            else:
+                stack.pop()
+                order.append(i)
+    return order
+
+
+def assign_workers(all_files: list[str], workers: int) -> list[int]:
+    """
+    Spreads files over workers by size, biggest first onto the least busy worker. Every step of a file runs on the
+    worker it got assigned
+    :return: The worker of each file
+    """
+    load = [0] * workers
+    owner = [0] * len(all_files)
+    sizes = [os.path.getsize(x) for x in all_files]
+    for i in sorted(range(len(all_files)), key=lambda x: -sizes[x]):
+        w = load.index(min(load))
+        owner[i] = w
+        load[w] += sizes[i]
+    return owner
+
+
+def run_stages(pools: list[Executor], progress: rich.progress.Progress, tasks: list[rich.progress.TaskID],
+               all_files: list[str], import_map: dict[str, dict[str, str]],
+               stages: list[list[transf.Transformer]], outputs: dict[str, str], keep_unchanged: bool = False,
+               known_exports: dict[str, dict[str, Any]] | None = None,
+               previous_exports: dict[str, dict[str, Any]] | None = None
+               ) -> tuple[list[Future], list[dict[str, Any] | None]]:
+    """
+    Runs all stages on all files, and writes them. Every file goes through the stages on its own worker, as fast as
+    that worker gets to it, and is written by it as soon as it's through, so neither the ASTs nor the sources pile up.
+    The only thing a file ever waits for is the first phase of a linking transformer on the files it imports, before
+    it can be linked against them. Files get started in dependency order, so the files imported the most are ready
+    first
+    :param pools:            The workers, each running one step at a time
+    :param outputs:          File -> path to write it to
+    :param keep_unchanged:   Leaves outputs alone that already have exactly the source they would get
+    :param known_exports:    Exports of files that are imported, but not obfuscated this time. File -> transformer
+                             name -> exports
+    :param previous_exports: What the files exported the last time they were obfuscated, in the same format
+    :return: For each file in the order of all_files: the future of the digest of its output, failed files re-raise
+             the exception when getting their result. What it exported by transformer name, None if it failed
+    """
+    index = {f: i for i, f in enumerate(all_files)}
+    deps = [[index[v] for v in import_map.get(f, {}).values() if v in index] for f in all_files]
+    owner = assign_workers(all_files, len(pools))
+    stage_of = [-1] * len(all_files)  # -1 while parsing, len(stages) while writing
+    exports: list[dict[int, Any]] = [{} for _ in stages]  # stage -> file index -> exports of that file
+    waiting: list[set[int]] = [set() for _ in stages]  # stage -> files waiting for their imports to be collected
+    running: dict[Future, tuple[int, str]] = {}
+    results: list[Future | None] = [None] * len(all_files)
+    known_exports = known_exports or {}
+
+    def submit(i: int):
+        s = stage_of[i]
+        file = all_files[i]
+        names = []
+        data = None
+        if s == -1:
+            phase = "parse"
+        elif s == len(stages):
+            phase = "write"
+            data = (outputs[file], keep_unchanged)
+        else:
+            names = [t.name for t in stages[s]]
+            if not stages[s][0].links_files:
+                phase = "obf"
+            elif i not in exports[s]:
+                phase = "collect"
+                if previous_exports is not None:
+                    data = previous_exports.get(file, {}).get(names[0])
+            elif all(d in exports[s] for d in deps[i]):
+                phase = "link"
+                data = {}
+                for k, v in import_map.get(file, {}).items():
+                    e = exports[s][index[v]] if v in index else known_exports.get(v, {}).get(names[0])
+                    if e is not None:
+                        data[k] = e
+            else:
+                waiting[s].add(i)
+                progress.update(tasks[i], description="Waiting for imports")
+                return
+        progress.start_task(tasks[i])
+        progress.update(tasks[i], description={
+            "parse": "Parsing", "write": "Writing", "link": "Linking " + ", ".join(names)
+        }.get(phase, "Transformer " + ", ".join(names)))
+        fut = pools[owner[i]].submit(run_step, phase, names, file, data)
+        running[fut] = (i, phase)
+        if phase == "write":
+            results[i] = fut
+
+    def wake(s: int):
+        for j in sorted(waiting[s]):
+            if all(d in exports[s] for d in deps[j]):
+                waiting[s].discard(j)
+                submit(j)
+
+    for i in dependency_order(all_files, import_map):
+        submit(i)
+    while len(running) > 0:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for fut in sorted(done, key=lambda x: running[x][0]):
+            i, phase = running.pop(fut)
+            s = stage_of[i]
+            if fut.exception() is not None:
+                # a transformer failed, the file can't be written or the worker died. stop here, it gets reported
+                # once everything is done. files importing this one link without it
+                results[i] = fut
+                progress.update(tasks[i], description="Failed")
+                stage_of[i] = len(stages) + 1
+                for x in range(max(s, 0), len(stages)):
+                    exports[x].setdefault(i, None)
+                    wake(x)
+            elif phase == "write":
+                progress.update(tasks[i], description="Done")
+            elif phase == "collect":
+                exports[s][i] = fut.result()
+                progress.advance(tasks[i])
+                submit(i)
+                wake(s)
+            else:
+                if phase != "parse":
+                    progress.advance(tasks[i], 1 if phase == "link" else len(stages[s]))
+                stage_of[i] += 1
+                submit(i)
+    file_exports = [
+        None if stage_of[i] > len(stages) else {
+            stages[s][0].name: exports[s][i] for s in range(len(stages)) if stages[s][0].links_files
+        }
+        for i in range(len(all_files))
+    ]
+    return results, file_exports
+
+
+def run_files_low_memory(pools: list[Executor], progress: rich.progress.Progress,
+                         tasks: list[rich.progress.TaskID], all_files: list[str],
+                         import_map: dict[str, dict[str, str]], stages: list[list[transf.Transformer]],
+                         outputs: dict[str, str], keep_unchanged: bool = False,
+                         known_exports: dict[str, dict[str, Any]] | None = None,
+                         previous_exports: dict[str, dict[str, Any]] | None = None
+                         ) -> tuple[list[Future], list[dict[str, Any] | None]]:
+    """
+    Like run_stages, but keeps only what the files export in memory instead of their ASTs. Every worker obfuscates one
+    file at a time from start to finish, and drops it once it's written, so memory is bounded by the largest files
+    rather than the whole project. Files imported by other files are run up to collecting their exports first, since
+    the files importing them need those to be linked
+    """
+    index = {f: i for i, f in enumerate(all_files)}
+    deps = [sorted({index[v] for v in import_map.get(f, {}).values() if v in index}) for f in all_files]
+    owner = assign_workers(all_files, len(pools))
+    linking = [s for s in range(len(stages)) if stages[s][0].links_files]
+    names = [[t.name for t in x] for x in stages]
+    total_steps = sum(2 if x[0].links_files else len(x) for x in stages)
+    known_exports = known_exports or {}
+    previous_exports = previous_exports or {}
+    order = dependency_order(all_files, import_map)
+    position = {i: p for p, i in enumerate(order)}
+    needed = {d for x in deps for d in x} if len(linking) > 0 else set()  # files others need the exports of
+    importers: list[list[int]] = [[] for _ in all_files]
+    for i, x in enumerate(deps):
+        for d in x:
+            importers[d].append(i)
+    unknown = [len(x) for x in deps]  # imports whose exports aren't known yet
+    unknown_before = [sum(1 for d in x if position[d] < position[i]) for i, x in enumerate(deps)]
+    state = [0] * len(all_files)  # 0 waiting, 1 collecting exports, 2 exports known, 3 obfuscating, 4 done or failed
+    summaries: list[dict[str, Any] | None] = [None] * len(all_files)  # transformer name -> exports
+    file_exports: list[dict[str, Any] | None] = [None] * len(all_files)
+    results = [Future() for _ in all_files]
+    running: dict[Future, tuple[int, bool]] = {}
+
+    def link_data(i: int, s: int) -> dict[str, Any]:
+        data = {}
+        for k, v in import_map.get(all_files[i], {}).items():
+            e = summaries[index[v]] if v in index else known_exports.get(v)
+            if e is not None and e.get(names[s][0]) is not None:
+                data[k] = e[names[s][0]]
+        return data
+
+    def plan(i: int, summarize: bool) -> list[tuple[str, list[str], Any]]:
+        file = all_files[i]
+        steps = []
+        for s in range(len(stages)):
+            if s not in linking:
+                steps.append(("obf", names[s], None))
+                continue
+            pinned = previous_exports.get(file, {}).get(names[s][0])
+            if not summarize and summaries[i] is not None and seed() == "":
+                # keep exporting what the files importing this one were linked against. with a seed, running the
+                # file again collects exactly the same anyway
+                pinned = summaries[i][names[s][0]]
+            steps.append(("collect", names[s], pinned))
+            if summarize and s == linking[-1]:
+                break
+            steps.append(("link", names[s], link_data(i, s)))
+        return steps
+
+    def submit(i: int, summarize: bool):
+        progress.start_task(tasks[i])
+        progress.update(tasks[i], description="Collecting exports" if summarize else "Obfuscating")
+        output = None if summarize else (outputs[all_files[i]], keep_unchanged)
+        fut = pools[owner[i]].submit(run_file, all_files[i], plan(i, summarize), output)
+        running[fut] = (i, summarize)
+        state[i] = 1 if summarize else 3
+
+    def advance(i: int):
+        if state[i] == 0 and i in needed:
+            # with more than one linking transformer, collecting the later ones needs the earlier ones linked
+            if len(linking) < 2 or unknown_before[i] == 0:
+                submit(i, True)
+        elif state[i] == (2 if i in needed else 0) and unknown[i] == 0:
+            submit(i, False)
+
+    def exports_known(i: int):
+        for j in importers[i]:
+            unknown[j] -= 1
+            if position[i] < position[j]:
+                unknown_before[j] -= 1
+            advance(j)
+
+    for i in order:
+        if len(linking) == 0:
+            unknown[i] = 0  # nothing to link, nothing to wait for
+        advance(i)
+    while len(running) > 0:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for fut in sorted(done, key=lambda x: running[x][0]):
+            i, summarize = running.pop(fut)
+            if fut.exception() is not None:
+                # reported once everything is done. files importing this one link without it
+                results[i].set_exception(fut.exception())
+                progress.update(tasks[i], description="Failed")
+                state[i] = 4
+                if summarize:
+                    exports_known(i)
+                continue
+            output, collected = fut.result()
+            exports = {names[s][0]: collected[j] for j, s in enumerate(linking)}
+            if summarize:
+                summaries[i] = exports
+                state[i] = 2
+                advance(i)
+                exports_known(i)
+            else:
+                file_exports[i] = exports
+                results[i].set_result(output)
+                progress.update(tasks[i], description="Done", completed=total_steps)
+                state[i] = 4
+    return results, file_exports
+
+
+def compile_pyc(c_ast: AST, filename: str) -> bytes:
+    """
+    Compiles an obfuscated file to the contents of a .pyc file. Python only checks the header of .pyc files without a
+    source next to them for the version, so the rest of it is left empty
+    :param filename: The name tracebacks show for the file
+    """
+    code = compile(fix_missing_locations(c_ast), filename, "exec", optimize=2)
+    return importlib.util.MAGIC_NUMBER + bytes(12) + dump_code(code)
+
+
+def output_name(path: str) -> str:
+    """
+    :return: The path an obfuscated file gets in the output, given the path of its source
+    """
+    if general_settings["output_format"].value == "pyc":
+        return os.path.splitext(path)[0] + ".pyc"
+    return path
+
+
+def write_output(full_path: str, output: str | bytes, keep_unchanged: bool = False) -> str:
+    """
+    Writes an obfuscated file
+    :param output:         The source, or the contents of a .pyc file
+    :param keep_unchanged: Leaves the output alone if it already has exactly that content
+    :return: Digest of the output
+    """
+    text = isinstance(output, str)
+    output_digest = digest(output.encode("utf8") if text else output)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    if keep_unchanged and digest_file(full_path, text) == output_digest:
+        return output_digest
+    if text:
+        with open(full_path, "w", encoding="utf8") as f:
+            f.write(output)
+    else:
+        with open(full_path, "wb") as f:
+            f.write(output)
+    return output_digest
+
+
+def to_cache(output: str | bytes) -> str:
+    """
+    :return: An output the way the cache keeps it: the source, or the base64 of a .pyc file. See from_cache
+    """
+    return output if isinstance(output, str) else base64.b64encode(output).decode("ascii")
+
+
+def read_output(full_path: str) -> str:
+    """
+    :return: A written output the way the cache keeps it, see to_cache
+    """
+    if full_path.endswith(".pyc"):
+        with open(full_path, "rb") as f:
+            return to_cache(f.read())
+    with open(full_path, "r", encoding="utf8") as f:
+        return f.read()
+
+
+def from_cache(full_path: str, cached: str) -> str | bytes:
+    return base64.b64decode(cached) if full_path.endswith(".pyc") else cached
+
+
+def check_output(file: str, result: Future) -> str | None:
+    """
+    Reports a file that failed to obfuscate or write
+    :param file:   The path of the file, relative to the output
+    :param result: The future of the digest of its output
+    :return: The digest, or None if the file failed
+    """
+    try:
+        return result.result()
+    except Exception as e:
+        console.log(f"Failed to obfuscate {file}", style="red")
+        console.print_exception(max_frames=3)
+        if str(e) == "Unable to avoid backslash in f-string expression part":
+            console.log(
+                "[red]An error occurred with re-parsing the python AST into source code.[/red] AST was not able to escape ASCII characters in an "
+                "F-String expression. Please check if you have any ASCII characters in F-Strings, and escape them manually. "
+            )
+        return None
+
+
+def obfuscate_files(pools: list[Executor], progress: rich.progress.Progress, files: list[str],
+                    import_map: dict[str, dict[str, str]], stages: list[list[transf.Transformer]], steps: int,
+                    rel: dict[str, str], outputs: dict[str, str], cache: ArtifactCache | None,
+                    keep_unchanged: bool = False,
+                    known_exports: dict[str, dict[str, Any]] | None = None,
+                    previous_exports: dict[str, dict[str, Any]] | None = None
+                    ) -> tuple[list[Future], list[dict[str, Any] | None]]:
+    """
+    Obfuscates and writes files, taking what it can from the cache. A file can only be looked up once the exports of
+    the files it imports are known, so files importing a file that isn't cached get obfuscated along with it, and are
+    cached after
+    :param rel: File -> path relative to the output
+    :return: Like run_stages. Files from the cache get written by the workers as well, while the others obfuscate
+    """
+    known_exports = known_exports or {}
+    runner = run_files_low_memory if general_settings["low_memory"].value else run_stages
+    if cache is None:
+        tasks = [progress.add_task("Waiting", start=False, total=steps, filename=rel[f]) for f in files]
+        return runner(pools, progress, tasks, files, import_map, stages, outputs, keep_unchanged, known_exports,
+                      previous_exports)
+    index = {f: i for i, f in enumerate(files)}
+    results: list[Future | None] = [None] * len(files)
+    exports: list[dict[str, Any] | None] = [None] * len(files)
+    available = dict(known_exports)  # file -> exports, for all files they are known of
+
+    def key_of(i: int) -> str:
+        f = files[i]
+        source = sources.get(f)
+        mentioned = set(source.names)
+        imports = {
+            k: imported_digest(available[v], mentioned) for k, v in import_map.get(f, {}).items() if v in available
+        }
+        return cache_key(source.ast_digest, rel[f], imports, (previous_exports or {}).get(f))
+
+    missing = []
+    for i in dependency_order(files, import_map):
+        f = files[i]
+        if any(v in index and v not in available for v in import_map.get(f, {}).values()):
+            cache.misses += 1  # imports something that has to be obfuscated first, can't be looked up
+            missing.append(i)
+            continue
+        hit = cache.get(key_of(i))
+        if hit is None:
+            missing.append(i)
+            continue
+        results[i] = pools[i % len(pools)].submit(write_output, outputs[f], from_cache(outputs[f], hit[0]),
+                                                  keep_unchanged)
+        exports[i] = available[f] = hit[1]
+    if len(missing) < len(files):
+        console.log(f"{len(files) - len(missing)} of {len(files)} files taken from the cache", style="#4f4f4f")
+    if len(missing) == 0:
+        return results, exports
+    missing.sort()
+    todo = [files[i] for i in missing]
+    tasks = [progress.add_task("Waiting", start=False, total=steps, filename=rel[f]) for f in todo]
+    built, built_exports = runner(pools, progress, tasks, todo, import_map, stages, outputs, keep_unchanged, available,
+                                  previous_exports)
+    for j, i in enumerate(missing):
+        results[i] = built[j]
+        exports[i] = built_exports[j]
+        if exports[i] is not None:
+            available[files[i]] = exports[i]
+    for i in missing:
+        if exports[i] is not None and results[i].exception() is None:
+            # only files that obfuscated without an error, anything else would be handed to every later run. the
+            # workers don't send the outputs back
+            cache.put(key_of(i), read_output(outputs[files[i]]), exports[i])
+    return results, exports
+
+
+def build_incremental(pools: list[Executor], progress: rich.progress.Progress, all_files: list[str],
+                      import_map: dict[str, dict[str, str]], stages: list[list[transf.Transformer]], output_dir: str,
+                      common_prefix_l: int, steps: int, cache: ArtifactCache | None) -> list[str]:
+    """
+    Obfuscates the files that changed since the last run into the output directory, and the files using something
+    that changed in the files they import. Goes in rounds: the first one obfuscates the changed files, each one after
+    it the files importing something that changed in the round before, until nothing changes anymore. Linking
+    transformers get what a file exported last time, to keep exporting the same, so this usually takes one round.
+    Files that fail are left out of the manifest, so they're obfuscated again next time. The files importing them are
+    left as they are until then
+    :return: The files that failed
+    """
+    manifest = Manifest.load(output_dir)
+    config = config_digest()
+    rel = {f: f[common_prefix_l:] for f in all_files}
+    outputs = {f: os.path.join(output_dir, output_name(rel[f])) for f in all_files}
+    deps = {f: sorted({v for v in import_map.get(f, {}).values() if v in rel}) for f in all_files}
+    failed: list[str] = []
+    entries: dict[str, FileEntry] = {}
+    previous: dict[str, dict[str, Any]] = {}
+    source_digests = {f: sources.get(f).digest for f in all_files}
+    for f in all_files:
+        e = manifest.files.get(rel[f])
+        if e is None or e.config != config:
+            continue
+        previous[f] = e.exports
+        if e.source == source_digests[f] and digest_file(outputs[f], not outputs[f].endswith(".pyc")) == e.output:
+            entries[f] = e
+
+    def stale(f: str) -> bool:
+        # linked against something else than what the files it imports export now?
+        if f not in entries or any(d in failed for d in deps[f]):
+            return False  # failed, or imports a file that did. obfuscated again once that's fixed
+        e = entries[f]
+        if set(e.imports) != {rel[d] for d in deps[f]}:
+            return True
+        names = set(e.names)
+        return any(e.imports[rel[d]] != imported_digest(entries[d].exports, names) for d in deps[f])
+
+    dirty = [f for f in all_files if f not in entries]
+    if len(dirty) < len(all_files):
+        console.log(f"{len(all_files) - len(dirty)} of {len(all_files)} files unchanged since the last run",
+                    style="#4f4f4f")
+    rounds = 0
+    while len(dirty) > 0 or rounds == 0:
+        if len(dirty) > 0:
+            if rounds > 0:
+                console.log(f"Obfuscating {len(dirty)} file{'s' if len(dirty) > 1 else ''} again, something "
+                            f"{'they import' if len(dirty) > 1 else 'it imports'} changed", style="yellow")
+            building = set(dirty)
+            known = {f: e.exports for f, e in entries.items() if f not in building}
+            results, exports = obfuscate_files(pools, progress, dirty, import_map, stages, steps, rel, outputs, cache,
+                                               True, known, previous)
+            for i, f in enumerate(dirty):
+                output = check_output(rel[f], results[i])
+                if output is None:
+                    entries.pop(f, None)
+                    failed.append(f)
+                    continue
+                entries[f] = FileEntry(source_digests[f], config, output, exports[i], sources.get(f).names, {})
+                previous[f] = exports[i]
+            for f in dirty:
+                if f not in entries:
+                    continue
+                names = set(entries[f].names)
+                entries[f].imports = {
+                    rel[d]: imported_digest(entries[d].exports, names) for d in deps[f] if d in entries
+                }
+        rounds += 1
+        dirty = [f for f in all_files if stale(f)]
+    manifest.files = {rel[f]: entries[f] for f in all_files if f in entries}
+    manifest.save()
+    return failed
 
 
 def go_transitive():
@@ -179,22 +945,26 @@ def go_transitive():
         console.log("Transitive obfuscation requires the output to be a directory", style="red")
         exit(1)
     console.log("Parsing inheritance tree...", style="#4f4f4f")
-    deptree = get_dependency_tree(input_file)
-    common_prefix_l = len(os.path.commonpath(list(map(lambda x: os.path.dirname(x)+"/", deptree.keys()))))+1
-    tree = rich.tree.Tree(
-        os.path.abspath(input_file)[common_prefix_l:],
-        style="green"
-    )
-    recurse_tree_inner(deptree, deptree[os.path.abspath(input_file)], common_prefix_l, tree)
-    console.log(tree)
-    all_files = []
-    for x in deptree.keys():
-        if x not in all_files:
-            all_files.append(x)
-        for y in deptree[x]:
-            if y not in all_files:
-                all_files.append(y)
+    global sources
+    sources = SourceStore(general_settings["source_cache"].value or None)
+    roots = [os.path.dirname(os.path.abspath(input_file)), *general_settings["source_roots"].value]
+    # the ASTs are kept for the workers to take, unless memory matters more
+    graph = crawl(input_file, ModuleIndex(roots), sources, keep_trees=not general_settings["low_memory"].value)
+    import_map = graph.import_map
+    all_files = graph.files
     common_prefix_l = len(os.path.commonpath(list(map(lambda x: os.path.dirname(x)+"/", all_files))))+1
+    console.log(dependency_tree(graph, common_prefix_l))
+    if general_settings["output_format"].value == "pyc":
+        # python imports a source over a .pyc next to it, so outputs written as source before would shadow them
+        shadowing = [os.path.join(output_file, x[common_prefix_l:]) for x in all_files]
+        shadowing = [x for x in shadowing if os.path.isfile(x) and os.path.abspath(x) not in graph.imports]
+        if len(shadowing) > 0:
+            console.log(f"The output directory has {len(shadowing)} source file{'s' if len(shadowing) > 1 else ''} that "
+                        f"python would import instead of the .pyc files. Remove them, or write to another directory:",
+                        style="red")
+            for x in shadowing:
+                console.log("  " + x, style="red")
+            exit(1)
     progress = rich.progress.Progress(
         rich.progress.TextColumn("[bold blue]{task.fields[filename]}", justify="right"),
         rich.progress.BarColumn(bar_width=None),
@@ -203,56 +973,87 @@ def go_transitive():
         rich.progress.TextColumn("[#4f4f4f]{task.description:>32}", justify="right"),
         console=console
     )
-    all_asts = []
-    for x in all_files:
-        with open(x, "r", encoding="utf8") as f:
-            inp_source = f.read()
-        all_asts.append(ast.parse(inp_source))
-    with progress:
-        with ThreadPoolExecutor(max_workers=2) as pool:
-            index = 0
-            for file in all_files:
-                preparsed_ast = all_asts[index]
-                index += 1
-                task = progress.add_task("Waiting", start=False, filename=file[common_prefix_l:])
-                pool.submit(do_obf, task, progress, file, preparsed_ast, all_asts, all_files)
-    console.log("Writing")
-    for i in range(len(all_files)):
-        file = all_files[i]
-        out_ast = all_asts[i]
-        full_path = os.path.join(output_file, file[common_prefix_l:])
-        dname = os.path.dirname(full_path)
-        if not os.path.exists(dname):
-            os.makedirs(dname)
-        try:
-            src = NonEscapingUnparser().visit(out_ast)
-        except Exception as e:
-            console.print_exception(max_frames=3)
-            if str(e) == "Unable to avoid backslash in f-string expression part":
-                console.log(
-                    "[red]An error occurred with re-parsing the python AST into source code.[/red] AST was not able to escape ASCII characters in an "
-                    "F-String expression. Please check if you have any ASCII characters in F-Strings, and escape them manually. "
-                )
-            exit(1)
-            return
-
-        with open(full_path, "w", encoding="utf8") as f:
-            f.write(src)
-            f.flush()
+    transformers_to_run = list(
+        filter(lambda x: x.config["enabled"].value, all_transformers)
+    )
+    if len(transformers_to_run) == 0:
+        console.log("Nothing to do, bailing out", style="red")
+        exit(0)
+    steps = sum(2 if t.links_files else 1 for t in transformers_to_run)
+    workers = general_settings["workers"].value
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(all_files))
+    stages = split_stages(transformers_to_run)
+    cache = open_cache()
+    with progress, contextlib.ExitStack() as stack:
+        if workers == 1:
+            pools = [ThreadPoolExecutor(max_workers=1)]  # no need to start processes for one worker
+        else:
+            pools = [
+                ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(config_values(),))
+                for _ in range(workers)
+            ]
+        for pool in pools:
+            stack.enter_context(pool)
+        if general_settings["incremental"].value:
+            failed = build_incremental(pools, progress, all_files, import_map, stages, output_file, common_prefix_l,
+                                       steps, cache)
+        else:
+            rel = {f: f[common_prefix_l:] for f in all_files}
+            outputs = {f: os.path.join(output_file, output_name(rel[f])) for f in all_files}
+            results, _ = obfuscate_files(pools, progress, all_files, import_map, stages, steps, rel, outputs, cache)
+            failed = [f for i, f in enumerate(all_files) if check_output(rel[f], results[i]) is None]
+    sources.save()
+    if cache is not None:
+        cache.evict()
+        console.log(cache.summary(), style="#4f4f4f")
+    memory = peak_memory(workers > 1)
+    if memory is not None:
+        console.log(memory, style="#4f4f4f")
+    if len(failed) > 0:
+        console.log(f"{len(failed)} of {len(all_files)} files failed: {', '.join(f[common_prefix_l:] for f in failed)}",
+                    style="red")
+        exit(1)
     console.log("Done", style="green")
 
 
-def recurse_tree_inner(orig, m, common_prefix_len: int, tree: rich.tree.Tree):
-    for x in m:
-        el = tree.add(x[common_prefix_len:])
-        if x in orig:
-            recurse_tree_inner(orig, orig[x], common_prefix_len, el)
+def peak_memory(worker_processes: bool) -> str | None:
+    """
+    :param worker_processes: If the workers were processes. The largest child process is one of them then, other
+                             children (like the ones libraries start on import) are tiny
+    :return: The peak resident memory of this process and of the largest worker process, None if unknown
+    """
+    if resource is None:
+        return None
+    unit = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macos, kilobytes elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1024 / 1024
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1024 / 1024
+    r = f"Peak memory: {own:.0f} MB"
+    if worker_processes:
+        r += f", {workers:.0f} MB in the largest worker"
+    return r
 
 
-# def recurse_tree(m, common_prefix_len: int, tree: rich.tree.Tree):
-#     for x in m.keys():
-#         el = tree.add(x[common_prefix_len:])
-#         recurse_tree_inner(m, m[x], common_prefix_len, el)
+def dependency_tree(graph: ImportGraph, common_prefix_len: int) -> rich.tree.Tree:
+    """
+    Renders the import graph as a tree. The imports of a file are shown where it first appears, later appearances
+    only name it, so files imported from many places (or in a cycle) don't make the tree explode
+    """
+    tree = rich.tree.Tree(graph.start[common_prefix_len:], style="green")
+    expanded = {graph.start}
+    stack = [(tree, iter(graph.imports[graph.start]))]
+    while len(stack) > 0:
+        el, it = stack[-1]
+        x = next(it, None)
+        if x is None:
+            stack.pop()
+        elif x in expanded:
+            el.add(x[common_prefix_len:], style="#4f4f4f")
+        else:
+            expanded.add(x)
+            stack.append((el.add(x[common_prefix_len:]), iter(graph.imports[x])))
+    return tree
 
 
 def go_single():
@@ -271,6 +1072,7 @@ def go_single():
     ):  # output "file" is a dir
         base = os.path.basename(input_file)  # so append the input file name to it
         output_file = os.path.join(output_file, base)
+    output_file = output_name(output_file)
     if os.path.exists(output_file):
         console.log(
             "The output path at",
@@ -282,31 +1084,52 @@ def go_single():
         base1 = ".".join(base1.split(".")[0:-1])
         attempts = 0
         while os.path.exists(output_file):
-            output_file = os.path.join(
+            output_file = output_name(os.path.join(
                 os.path.dirname(output_file), f"{base1}_{attempts}.py"
-            )
+            ))
             attempts += 1
         console.log("Found one:", output_file, style="green")
-    with open(input_file, "r", encoding="utf8") as f:
-        inp_source = f.read()
+    global sources
+    sources = SourceStore(general_settings["source_cache"].value or None)
+    source = sources.get(input_file)
     console.log("Parsing AST...", style="#4f4f4f")
-    compiled_ast: AST = ast.parse(inp_source)
-    compiled_ast = transform_source(compiled_ast, os.path.abspath(input_file))
-    console.log("Re-structuring source...", style="#4f4f4f")
-    try:
-        src = NonEscapingUnparser().visit(compiled_ast)
-    except Exception as e:
-        console.print_exception(max_frames=3)
-        if str(e) == "Unable to avoid backslash in f-string expression part":
-            console.log(
-                "[red]An error occurred with re-parsing the python AST into source code.[/red] AST was not "
-                "able to escape ASCII"
-                "characters in an F-String expression. Please check if you have any "
-                "ASCII characters in F-Strings, and escape them manually."
-            )
-        exit(1)
-        return
+    cache = open_cache()
+    key = None
+    src = None
+    if cache is not None:
+        key = cache_key(source.ast_digest, os.path.basename(input_file), {}, None)
+        hit = cache.get(key)
+        if hit is not None:
+            console.log("Taken from the cache", style="#4f4f4f")
+            src = from_cache(output_file, hit[0])
+    if src is None:
+        compiled_ast: AST = source.take_tree()
+        seed_file(input_file, "single")
+        mark_hot_functions(compiled_ast, os.path.abspath(input_file))
+        compiled_ast = transform_source(compiled_ast, os.path.abspath(input_file))
+        console.log("Re-structuring source...", style="#4f4f4f")
+        try:
+            if general_settings["output_format"].value == "pyc":
+                src = compile_pyc(compiled_ast, os.path.basename(input_file))
+            else:
+                src = NonEscapingUnparser().visit(compiled_ast)
+        except Exception as e:
+            console.print_exception(max_frames=3)
+            if str(e) == "Unable to avoid backslash in f-string expression part":
+                console.log(
+                    "[red]An error occurred with re-parsing the python AST into source code.[/red] AST was not "
+                    "able to escape ASCII"
+                    "characters in an F-String expression. Please check if you have any "
+                    "ASCII characters in F-Strings, and escape them manually."
+                )
+            exit(1)
+            return
+        if cache is not None:
+            cache.put(key, to_cache(src), {})
     console.log("Writing...", style="#4f4f4f")
-    with open(output_file, "w", encoding="utf8") as f:
-        f.write(src)
+    write_output(output_file, src)
+    sources.save()
+    if cache is not None:
+        cache.evict()
+        console.log(cache.summary(), style="#4f4f4f")
     console.log("Done", style="green")
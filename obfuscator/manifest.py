@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os.path
+from typing import Any
+
+MANIFEST_FILE = ".pyobf-manifest.json"
+MANIFEST_VERSION = 1
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_value(value: Any) -> str:
+    """
+    Digests a json serializable value. Dicts digest the same regardless of their order
+    """
+    return digest(json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf8"))
+
+
+def digest_file(path: str, text: bool = False) -> str | None:
+    """
+    Digests the contents of a file
+    :param path: The file
+    :param text: Read the file as utf8 text, with universal newlines. Digests the same as the encoded source it was
+                 written from
+    :return: The digest, or None if the file doesn't exist
+    """
+    if not os.path.isfile(path):
+        return None
+    if text:
+        with open(path, "r", encoding="utf8") as f:
+            return digest(f.read().encode("utf8"))
+    with open(path, "rb") as f:
+        return digest(f.read())
+
+
+def imported_digest(exports: dict[str, Any] | None, names: set[str]) -> str:
+    """
+    Digests the part of a file's exports another file can see. Exports that are dicts, like the renamer's mappings,
+    only count with the names the other file mentions, so adding something to a file doesn't affect files not using it
+    :param exports: The exports of the imported file, transformer name -> exports. None if it failed
+    :param names:   The names the importing file mentions
+    :return: The digest
+    """
+    if exports is None:
+        return digest_value(None)
+    picked = {}
+    for k, v in exports.items():
+        if isinstance(v, dict):
+            v = {n: x for n, x in v.items() if n in names}
+        picked[k] = v
+    return digest_value(picked)
+
+
+class FileEntry:
+    """
+    What the manifest knows about a file from when it was last obfuscated
+    """
+
+    def __init__(self, source: str, config: str, output: str, exports: dict[str, Any], names: list[str],
+                 imports: dict[str, str]):
+        self.source = source  # digest of the source
+        self.config = config  # digest of the config it was obfuscated with
+        self.output = output  # digest of the output written
+        self.exports = exports  # transformer name -> exports, of the transformers linking files
+        self.names = names  # names the source mentions, see imported_digest
+        self.imports = imports  # imported file -> imported_digest of what it exported, when this file was linked
+
+    def to_json(self) -> dict[str, Any]:
+        return dict(self.__dict__)
+
+    @staticmethod
+    def from_json(d: dict[str, Any]) -> "FileEntry":
+        return FileEntry(d["source"], d["config"], d["output"], d["exports"], d["names"], d["imports"])
+
+
+class Manifest:
+    """
+    Records what was obfuscated into an output directory, so the next run only has to obfuscate what changed. Files
+    are keyed by their path relative to the output directory
+    """
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, MANIFEST_FILE)
+        self.files: dict[str, FileEntry] = {}
+
+    @staticmethod
+    def load(output_dir: str) -> "Manifest":
+        """
+        Loads the manifest of an output directory. A missing, broken or outdated manifest loads empty, which makes
+        everything get obfuscated again
+        """
+        m = Manifest(output_dir)
+        if not os.path.isfile(m.path):
+            return m
+        try:
+            with open(m.path, "r", encoding="utf8") as f:
+                d = json.load(f)
+            if d.get("version") == MANIFEST_VERSION:
+                m.files = {k: FileEntry.from_json(v) for k, v in d["files"].items()}
+        except (ValueError, KeyError, TypeError, AttributeError):
+            m.files = {}
+        return m
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf8") as f:
+            json.dump({
+                "version": MANIFEST_VERSION,
+                "files": {k: v.to_json() for k, v in sorted(self.files.items())}
+            }, f, indent=1)
+        os.replace(tmp, self.path)  # never leave a half written manifest behind
@@ -1,79 +1,176 @@
+import abc
 import ast
+import functools
 from ast import *
+from types import CodeType
 from typing import Any, List
 
+from util import import_key, rng
 
-class MappingGenerator(NodeVisitor):
+
+@functools.lru_cache(maxsize=None)
+def compile_rename_format(fmt: str) -> CodeType:
     """
-    A generator for mappings
+    Compiles a rename format to a code object, so it only has to be parsed once per run
+    :param fmt: The rename format
+    :return: The compiled expression
     """
+    return compile(fmt, "<rename_format>", "eval")
 
-    def remap_name_if_needed(self, old):
+
+class NameGenerator(abc.ABC):
+    """
+    Generates new names for the renamer
+    """
+
+    def __init__(self):
+        self.counters = {}
+
+    def get_counter(self, name: str) -> int:
         """
-        Remaps the given name to a new one, if the mappings contain a name for it
-        :param old: The old name
-        :return:    The remapped name or old if no mapping was found
+        Increments the counter behind name
+        :param name: The name of the counter
+        :return: The current value of the counter, starting at 0
         """
-        sorted_names = list(self.mappings.keys())
-        # Sort by longest (most specific) path first
-        sorted_names.sort(key=lambda v: grade_name_order(v.split(".")[1]), reverse=True)
-        for x in sorted_names:
-            s_loc = x.split(".")[1]
-            location_split = s_loc.split("|")
-            if len(location_split) == 1 and location_split[0] == '':
-                location_split = []
-            loc_matches = True
-            if len(self.location_stack) >= len(location_split):
-                for i in range(len(location_split)):
-                    current_loc_pos = self.location_stack[i]
-                    existing_loc_pos = location_split[i]
-                    if current_loc_pos != existing_loc_pos:
-                        loc_matches = False
-                        break
-            else:
-                loc_matches = False
-            if loc_matches and x.split(".")[2] == old:
-                return self.mappings[x]
-        return old
-
-    def counter_shit(self, name: str):
         if name not in self.counters:
             self.counters[name] = 0
             return 0
         self.counters[name] += 1
         return self.counters[name]
 
-    def mapping_name(self, for_type: str):
-        fmt = self.fmt
-        generated_name = eval(fmt, {
-            "counter": self.counter_shit("cnt"),
-            "kind": for_type,
-            "get_counter": self.counter_shit
+    @abc.abstractmethod
+    def generate(self, kind: str) -> str:
+        """
+        :param kind: The kind of name, like "var" or "method"
+        :return: A new name
+        """
+
+
+class FormatNameGenerator(NameGenerator):
+    """
+    Evaluates the user supplied rename format for every name
+    """
+
+    def __init__(self, fmt: str):
+        super().__init__()
+        self.code = compile_rename_format(fmt)
+
+    def generate(self, kind: str) -> str:
+        generated_name = eval(self.code, {
+            "counter": self.get_counter("cnt"),
+            "kind": kind,
+            "get_counter": self.get_counter
         })
         if type(generated_name) != str:
             generated_name = str(generated_name)
         return generated_name
 
-    def __init__(self, fmt):
-        self.fmt = fmt
-        self.counters = {}
-        self.mappings = {}
+
+class CounterNameGenerator(NameGenerator):
+    """
+    Generates "{kind}{counter}" names with a counter per kind. Same output as the default rename format, without eval
+    """
+
+    def generate(self, kind: str) -> str:
+        return kind + str(self.get_counter(kind))
+
+
+class RandomNameGenerator(NameGenerator):
+    """
+    Generates random, unique names from a small alphabet of similar looking characters
+    """
+
+    def __init__(self, alphabet: str = "lIMN", length: int = 32):
+        super().__init__()
+        self.alphabet = alphabet
+        self.length = length
+        self.used = set()
+
+    def generate(self, kind: str) -> str:
+        while True:
+            n = "".join(rng.choices(self.alphabet, k=self.length))
+            if n not in self.used:
+                self.used.add(n)
+                return n
+
+
+class ReservingNameGenerator(NameGenerator):
+    """
+    Wraps another generator, skipping the names it generates that are reserved for something else
+    """
+
+    def __init__(self, inner: NameGenerator, reserved: set[str]):
+        super().__init__()
+        self.inner = inner
+        self.reserved = reserved
+
+    def generate(self, kind: str) -> str:
+        while True:
+            n = self.inner.generate(kind)
+            if n not in self.reserved:
+                return n
+
+
+name_generators = {
+    "format": FormatNameGenerator,
+    "counter": lambda _: CounterNameGenerator(),
+    "random": lambda _: RandomNameGenerator()
+}
+
+
+def create_name_generator(kind: str, fmt: str) -> NameGenerator:
+    """
+    Creates the name generator selected in the config
+    :param kind: The kind of generator, one of name_generators
+    :param fmt:  The rename format, used by the "format" generator
+    :return: The name generator
+    """
+    if kind not in name_generators:
+        raise ValueError(f"Unknown name generator {kind!r}, expected one of {', '.join(name_generators.keys())}")
+    return name_generators[kind](fmt)
+
+
+class MappingGenerator(NodeVisitor):
+    """
+    A generator for mappings
+    """
+
+    def remap_name_if_needed(self, old):
+        """
+        Remaps the given name to a new one, if the mappings contain a name for it
+        :param old: The old name
+        :return:    The remapped name or old if no mapping was found
+        """
+        remapped = self.current_scope.resolve(old)
+        return remapped if remapped is not None else old
+
+    def mapping_name(self, for_type: str):
+        return self.name_generator.generate(for_type)
+
+    def __init__(self, name_generator: NameGenerator, pinned: dict[str, str] | None = None):
+        """
+        :param name_generator: Generates the new names
+        :param pinned:         Module level names that keep a name they got before, old name -> new name. The
+                               name generator must not generate the pinned names
+        """
+        self.name_generator = name_generator
+        self.pinned = pinned or {}
+        self.mappings = Scope("")
+        self.current_scope = self.mappings
         self.location_stack = []
 
     def visit_Global(self, node: Global) -> Any:
         for i in range(len(node.names)):
             x = node.names[i]
             remapped_name = self.remap_name_if_needed(x)
-            if remapped_name is not x:  # we have a mapping for this one? good
-                self.put_name_if_absent(x, remapped_name)
-                node.names[i] = remapped_name
-            else:
+            if remapped_name is x:
                 # this global statement defines a var at module level
                 # this is straight up evil coding practise but some fucked up people do it so it has to be supported
-                remapped_name = self.mapping_name("var")
-                self.put_name_at_module_level(x, remapped_name)
-                self.put_name_if_absent(x, remapped_name)
-                node.names[i] = remapped_name
+                remapped_name = self.put_name_at_module_level(x, "var")
+            names = self.current_scope.names
+            if x not in names:
+                names[x] = remapped_name
+            node.names[i] = remapped_name
 
         self.generic_visit(node)
 
@@ -83,7 +180,7 @@ class MappingGenerator(NodeVisitor):
                 continue
             if x.asname is None:
                 x.asname = x.name
-            self.put_name_if_absent(x.asname, self.mapping_name("var"))
+            self.put_name_if_absent(x.asname, "var")
         self.generic_visit(node)
 
     def print_mappings(self):
@@ -91,46 +188,53 @@ class MappingGenerator(NodeVisitor):
         Prints all mappings
         :return: Nothing
         """
-        for x in self.mappings.keys():
-            print(f"{x} to {self.mappings[x]}")
+        for loc, old, new in self.mappings.walk():
+            print(f"{loc}.{old} to {new}")
 
-    def put_name_at_module_level(self, old, new):
-        full = f".{old}"
-        if full not in self.mappings:
-            self.mappings[full] = new
+    def put_name_at_module_level(self, old, kind):
+        return self._put_name_in(self.mappings, old, kind)
 
-    def put_name_if_absent(self, old, new):
+    def put_name_if_absent(self, old, kind):
         """
-        Puts a new name if it doesn't already exist
+        Puts a new name if it doesn't already exist. The name is only generated if it's actually stored
         :param old:  The old name
-        :param new:  The new name
-        :return: Nothing
+        :param kind: The kind of name to generate
+        :return: The name old is mapped to in the current scope
         """
         if old is None:
             raise ValueError("none")
-        loc = "|".join(self.location_stack)
-        full = f"{loc}.{old}"
-        if full not in self.mappings:
-            self.mappings[full] = new
+        return self._put_name_in(self.current_scope, old, kind)
+
+    def _put_name_in(self, scope: "Scope", old, kind):
+        names = scope.names
+        r = names.get(old)
+        if r is None:
+            r = self.pinned.get(old) if scope is self.mappings else None
+            if r is None:
+                r = self.mapping_name(kind)
+            names[old] = r
+        return r
 
     def start_visit(self, name):
         self.location_stack.append(name)
+        self.current_scope = self.current_scope.child(name)
 
     def end_visit(self):
         self.location_stack.pop()
+        self.current_scope = self.current_scope.parent
 
     def visit_FunctionDef(self, node: FunctionDef) -> Any:
         name = node.name
         # methods need to be enabled and none of the location elements need to be of a class
         if not any(x.startswith("cl_") for x in self.location_stack):
-            self.put_name_if_absent(name, self.mapping_name("method"))
+            self.put_name_if_absent(name, "method")
         self.start_visit("mt_" + name)
         self.generic_visit(node)
         self.end_visit()
 
     def visit_AsyncFunctionDef(self, node: AsyncFunctionDef) -> Any:
         name = node.name
-        self.put_name_if_absent(name, self.mapping_name("method"))
+        self.put_name_if_absent(name, "method")
         self.start_visit("mt_" + name)
         self.generic_visit(node)
         self.end_visit()
@@ -138,8 +242,7 @@ class MappingGenerator(NodeVisitor):
     def visit_arg(self, node: arg) -> Any:
         name = node.arg
         if name != "self":  # maybe dont remap this one
-            nn = self.mapping_name("arg")
-            self.put_name_if_absent(name, nn)
+            self.put_name_if_absent(name, "arg")
         # self.generic_visit(node)
 
     def visit_Lambda(self, node: Lambda) -> Any:
@@ -149,7 +252,7 @@ class MappingGenerator(NodeVisitor):
 
     def visit_ClassDef(self, node: ClassDef) -> Any:
         if not any(x.startswith("cl_") for x in self.location_stack):
-            self.put_name_if_absent(node.name, self.mapping_name("class"))
+            self.put_name_if_absent(node.name, "class")
         self.start_visit("cl_" + node.name)
         self.generic_visit(node)
         self.end_visit()
@@ -168,22 +271,73 @@ class MappingGenerator(NodeVisitor):
         if isinstance(node.ctx, Store):
             if node.id != "self":
                 if len(self.location_stack) == 0 or not self.location_stack[len(self.location_stack)-1].startswith("cl_"):
-                    self.put_name_if_absent(node.id, self.mapping_name("var"))
+                    self.put_name_if_absent(node.id, "var")
         self.generic_visit(node)
 
 
-def grade_name_order(name: str):
-    if len(name) == 0:
-        return 0
-    return len(name.split("|")) + 1
+class Scope:
+    """
+    A node in the scope tree built by the MappingGenerator. Each scope holds the names defined directly in it, and
+    its child scopes by location name ("mt_func", "cl_Class", ...). Resolving a name walks up the parent chain,
+    so a lookup costs one dict probe per nesting level
+    """
+
+    def __init__(self, name: str, parent: "Scope | None" = None):
+        self.name = name
+        self.parent = parent
+        self.children: dict[str, Scope] = {}
+        self.names: dict[str, str] = {}
+
+    def child(self, name: str) -> "Scope":
+        """
+        Gets the child scope with the given name, creating it if it doesn't exist yet
+        :param name: The location name of the child
+        :return: The child scope
+        """
+        c = self.children.get(name)
+        if c is None:
+            c = Scope(name, self)
+            self.children[name] = c
+        return c
+
+    def resolve(self, name: str) -> str | None:
+        """
+        Resolves a name from this scope, going up to the parent scopes if this one doesn't define it
+        :param name: The old name
+        :return: The new name, or None if no scope on the way up defines a mapping for it
+        """
+        s = self
+        while s is not None:
+            r = s.names.get(name)
+            if r is not None:
+                return r
+            s = s.parent
+        return None
+
+    def walk(self, prefix: str = ""):
+        """
+        Walks this scope and all of its children
+        :param prefix: The location of this scope, "|" separated
+        :return: (location, old name, new name) for every mapping
+        """
+        for k, v in self.names.items():
+            yield prefix, k, v
+        for c in self.children.values():
+            yield from c.walk(f"{prefix}|{c.name}" if prefix else c.name)
 
 
 class OtherFileMappingApplicator(NodeVisitor):
-    def __init__(self, mappings: dict[str, str], owning_module, all_els_in_other_file: list[str]):
-        self.mappings = mappings
-        self.all_els = all_els_in_other_file
-        self.owning_module = owning_module
-        self.names_containing_module = []
+    """
+    Applies the module level mappings of other files to the references this file makes to them, in a single pass
+    """
+
+    def __init__(self, modules: dict[str, dict[str, str]]):
+        """
+        :param modules: Import key of a module this file imports (see import_key) -> module level mappings of the file
+                        it resolves to
+        """
+        self.modules = modules
+        self.names_containing_module: dict[str, dict[str, str]] = {}
 
     def _resolve_attr(self, node: Attribute) -> str | None:
         first_part = self._resolve_attr(node.value) if isinstance(node.value, Attribute) else (
@@ -193,6 +347,10 @@ class OtherFileMappingApplicator(NodeVisitor):
             return None
         return first_part + "." + second_part
 
+    def _resolve_name(self, node: AST) -> str | None:
+        return self._resolve_attr(node) if isinstance(node, Attribute) else (
+            node.id if isinstance(node, Name) else None)
+
     def _get_attr_parts(self, node: Attribute) -> list[str] | None:
         parts = []
         s = node.value
@@ -209,54 +367,51 @@ class OtherFileMappingApplicator(NodeVisitor):
             return None
         return parts
 
-    def _map_name(self, m: str) -> str:
-        return self.mappings[m] if m in self.mappings else m
-
     def visit_ImportFrom(self, node: ImportFrom) -> Any:
-        if self._import_matches(node.module):
+        submodules = set()
+        for x in node.names:  # "from package import submodule" binds the submodule, not something the package defines
+            sub_mappings = self.modules.get(import_key(node.module, node.level, x.name))
+            if sub_mappings is not None:
+                self.names_containing_module[x.asname if x.asname is not None else x.name] = sub_mappings
+                submodules.add(x.name)
+        mappings = self.modules.get(import_key(node.module, node.level))
+        if mappings is not None:
             if len(node.names) == 1 and node.names[0].name == "*":  # why the fuck
                 node.names = [
-                    alias(name=self._map_name(x), asname=x) for x in self.all_els
+                    alias(name=mappings[x], asname=x) for x in mappings.keys()
                 ]
             for x in node.names:
+                if x.name in submodules:
+                    continue
                 if x.asname is None:
                     x.asname = x.name
-                x.name = self._map_name(x.name)
-
-    def _import_matches(self, import_name: str) -> bool:
-        if import_name.startswith(".") and not import_name.startswith(".."):
-            import_name = import_name[1:]
-        return import_name == self.owning_module
+                x.name = mappings.get(x.name, x.name)
 
     def visit_Import(self, node: Import) -> Any:
         for x in node.names:
-            if self._import_matches(x.name):
+            mappings = self.modules.get(x.name)
+            if mappings is not None:
                 target_name = x.asname if x.asname is not None else x.name
-                if target_name not in self.names_containing_module:
-                    self.names_containing_module.append(target_name)
+                self.names_containing_module[target_name] = mappings
         self.generic_visit(node)
 
     def visit_Attribute(self, node: Attribute) -> Any:
         attr_parts = self._get_attr_parts(node)
-        # print(attr_parts)
         if attr_parts is None:
-            # self.generic_visit(node)
+            self.generic_visit(node)
             return
         matched_name = []
-        for n in self.names_containing_module:
+        mappings = None
+        for n in self.names_containing_module.keys():
             attr_res = n.split(".")
-            matches_verdict = True
-            if len(attr_res) < len(attr_parts):
-                for i in range(len(attr_res)):
-                    if attr_res[i] != attr_parts[i]:
-                        matches_verdict = False
-            if matches_verdict:
+            if len(attr_res) < len(attr_parts) and attr_parts[:len(attr_res)] == attr_res:
                 matched_name = attr_res
+                mappings = self.names_containing_module[n]
                 attr_parts = attr_parts[len(attr_res):]
                 break
 
         if len(matched_name) > 0 and len(attr_parts) > 0:
-            remapped_names = [*matched_name, self._map_name(attr_parts[0])]
+            remapped_names = [*matched_name, mappings.get(attr_parts[0], attr_parts[0])]
             remapped_names.extend(attr_parts[1:])
             built_attribute = Attribute(
                 value=Name(remapped_names[0], Load()),
@@ -272,42 +427,40 @@ class OtherFileMappingApplicator(NodeVisitor):
                     )
             node.value = built_attribute.value
             node.attr = built_attribute.attr
-        # self.generic_visit(node)
 
     def visit_Assign(self, node: Assign) -> Any:
         """
         jesus fucking christ
         """
         if isinstance(node.value, Call) and isinstance(node.value.func, Name) and node.value.func.id == "__import__" and len(node.value.args) > 0 \
-                and isinstance(node.value.args[0], Constant) and node.value.args[0].value == self.owning_module:  # aka __import__("our module name")
+                and isinstance(node.value.args[0], Constant) and node.value.args[0].value in self.modules:  # aka __import__("a module we know")
+            mappings = self.modules[node.value.args[0].value]
             for x in node.targets:
-                name = self._resolve_attr(x) if isinstance(x, Attribute) else (x.id if isinstance(x, Name) else None)
+                name = self._resolve_name(x)
                 if name is None:
                     continue
-                if name not in self.names_containing_module:
-                    self.names_containing_module.append(name)
-        elif (isinstance(node.value, Attribute) or isinstance(node.value, Name)) and \
-            (self._resolve_attr(node.value) if isinstance(node.value, Attribute) else (node.value.id if isinstance(node.value, Name) else None)) \
-                in self.names_containing_module:  # aka something = something_that_we_know_is_our_module
+                self.names_containing_module[name] = mappings
+        elif self._resolve_name(node.value) in self.names_containing_module:  # aka something = something_that_we_know_is_a_module
+            mappings = self.names_containing_module[self._resolve_name(node.value)]
             for x in node.targets:
-                name2 = self._resolve_attr(x) if isinstance(x, Attribute) else (x.id if isinstance(x, Name) else None)
+                name2 = self._resolve_name(x)
                 if name2 is None:
                     continue
-                if name2 not in self.names_containing_module:
-                    self.names_containing_module.append(name2)
+                self.names_containing_module[name2] = mappings
         else:
-            for x in node.targets:  # we know these are being assigned something else, so remove them from the names we know are the module
-                name2 = self._resolve_attr(x) if isinstance(x, Attribute) else (x.id if isinstance(x, Name) else None)
+            for x in node.targets:  # we know these are being assigned something else, so remove them from the names we know are modules
+                name2 = self._resolve_name(x)
                 if name2 is None:
                     continue
                 if name2 in self.names_containing_module:
-                    self.names_containing_module.remove(name2)
+                    del self.names_containing_module[name2]
         self.generic_visit(node)
 
 
 class MappingApplicator(NodeVisitor):
-    def __init__(self, mappings):
+    def __init__(self, mappings: Scope):
         self.mappings = mappings
+        self.current_scope = mappings
         self.location_stack = []
 
     def visit_Import(self, node: Import) -> Any:
@@ -321,33 +474,16 @@ class MappingApplicator(NodeVisitor):
         self.generic_visit(node)
 
     def remap_name_if_needed(self, old):
-        sorted_names = list(self.mappings.keys())
-        # Sort by longest (most specific) path first
-        sorted_names.sort(key=lambda v: grade_name_order(v.split(".")[0]), reverse=True)
-        for x in sorted_names:
-            s_loc = x.split(".")[0]
-            location_split = s_loc.split("|")
-            if len(location_split) == 1 and location_split[0] == '':
-                location_split = []
-            loc_matches = True
-            if len(self.location_stack) >= len(location_split):
-                for i in range(len(location_split)):
-                    current_loc_pos = self.location_stack[i]
-                    existing_loc_pos = location_split[i]
-                    if current_loc_pos != existing_loc_pos:
-                        loc_matches = False
-                        break
-            else:
-                loc_matches = False
-            if loc_matches and x.split(".")[1] == old:
-                return self.mappings[x]
-        return old
+        remapped = self.current_scope.resolve(old)
+        return remapped if remapped is not None else old
 
     def start_visit(self, name):
         self.location_stack.append(name)
+        self.current_scope = self.current_scope.child(name)
 
     def end_visit(self):
         self.location_stack.pop()
+        self.current_scope = self.current_scope.parent
 
     def visit_FunctionDef(self, node: FunctionDef) -> Any:
         name = node.name
@@ -386,3 +522,279 @@ class MappingApplicator(NodeVisitor):
     def visit_Name(self, node: Name) -> Any:
         node.id = self.remap_name_if_needed(node.id)
         self.generic_visit(node)
+
+
+class SymbolScope(Scope):
+    """
+    A scope of the SinglePassRenamer. On top of the mappings, it tracks the kind of block it belongs to and the
+    declarations python's scoping rules depend on
+    """
+
+    def __init__(self, name: str, kind: str, parent: "SymbolScope | None" = None):
+        super().__init__(name, parent)
+        self.kind = kind  # "module", "function", "class" or "comprehension"
+        self.root = self if parent is None else parent.root
+        self.kept = set()  # names bound in this scope that must not be renamed
+        self.global_names = set()
+        self.nonlocal_names = set()
+        if parent is not None:
+            key = name
+            i = 0
+            while key in parent.children:  # comprehensions and lambdas can share a name, keep them apart
+                i += 1
+                key = f"{name}{i}"
+            parent.children[key] = self
+
+    def resolve(self, name: str) -> str | None:
+        """
+        Resolves a name like python would: local scope first, then the enclosing function scopes, then the module.
+        Class scopes are only visible to code directly in the class body
+        :param name: The old name
+        :return: The new name, or None if the name is not renamed
+        """
+        s = self
+        while s is not None:
+            if name in s.global_names:
+                return s.root.names.get(name)
+            if name not in s.nonlocal_names:
+                r = s.names.get(name)
+                if r is not None:
+                    return r
+                if name in s.kept:
+                    return None
+            s = s.parent
+            while s is not None and s.kind == "class":
+                s = s.parent
+        return None
+
+
+class SinglePassRenamer(NodeVisitor):
+    """
+    Renames a module in a single traversal. The traversal records every binding in the scope it belongs to, and every
+    place a name occurs in. Once the entire module has been seen, all occurrences are resolved against their scope and
+    patched in place, without walking the tree again.
+
+    Unlike the MappingGenerator and MappingApplicator, every comprehension gets its own scope, and names declared
+    global or nonlocal, as well as names bound in class bodies, resolve like they do in python
+    """
+
+    _comp_names = {
+        "ListComp": "sp_lc",
+        "SetComp": "sp_sc",
+        "DictComp": "sp_dc",
+        "GeneratorExp": "sp_ge"
+    }
+
+    def __init__(self, name_generator: NameGenerator, pinned: dict[str, str] | None = None):
+        """
+        :param name_generator: Generates the new names
+        :param pinned:         Module level names that keep a name they got before, old name -> new name. The
+                               name generator must not generate the pinned names
+        """
+        self.name_generator = name_generator
+        self.pinned = pinned or {}
+        self.mappings = SymbolScope("", "module")
+        self.scope = self.mappings
+        self.occurrences = []
+
+    def push(self, name: str, kind: str):
+        self.scope = SymbolScope(name, kind, self.scope)
+
+    def pop(self):
+        self.scope = self.scope.parent
+
+    def bind(self, name: str, kind: str, scope: SymbolScope = None):
+        """
+        Binds a name in the given scope, generating a new name for it if it can be renamed
+        :param name:  The old name
+        :param kind:  The kind of name to generate
+        :param scope: The scope to bind in, defaults to the current one
+        :return: Nothing
+        """
+        s = scope or self.scope
+        if name in s.global_names:
+            s = s.root
+        elif name in s.nonlocal_names:
+            return
+        if name in s.names:
+            return
+        if s.kind == "class" or name == "self":
+            s.kept.add(name)
+        elif name not in s.kept:
+            r = self.pinned.get(name) if s is self.mappings else None
+            s.names[name] = r if r is not None else self.name_generator.generate(kind)
+
+    def record(self, owner, field, old: str):
+        """
+        Records an occurrence of a name, to be remapped once all bindings are known
+        :param owner: The node (or list) holding the name
+        :param field: The attribute (or index) the name is stored under
+        :param old:   The name
+        :return: Nothing
+        """
+        self.occurrences.append((self.scope, owner, field, old))
+
+    def apply(self):
+        """
+        Resolves and patches all recorded occurrences
+        :return: Nothing
+        """
+        for scope, owner, field, old in self.occurrences:
+            new = scope.resolve(old)
+            if new is None:
+                continue
+            if type(field) == int:
+                owner[field] = new
+            else:
+                setattr(owner, field, new)
+        self.occurrences = []
+
+    def _visit_all(self, nodes):
+        for x in nodes:
+            if x is not None:
+                self.visit(x)
+
+    def _visit_arg_defaults(self, args: arguments):
+        self._visit_all(args.defaults)
+        self._visit_all(args.kw_defaults)
+
+    def _bind_args(self, args: arguments):
+        all_args = [*args.posonlyargs, *args.args, *args.kwonlyargs]
+        if args.vararg is not None:
+            all_args.append(args.vararg)
+        if args.kwarg is not None:
+            all_args.append(args.kwarg)
+        for x in all_args:
+            self.bind(x.arg, "arg")
+            self.record(x, "arg", x.arg)
+        return all_args
+
+    def _visit_function(self, node: FunctionDef | AsyncFunctionDef):
+        self.bind(node.name, "method")
+        self.record(node, "name", node.name)
+        self._visit_all(node.decorator_list)
+        self._visit_arg_defaults(node.args)
+        all_args = [*node.args.posonlyargs, *node.args.args, *node.args.kwonlyargs, node.args.vararg,
+                    node.args.kwarg]
+        self._visit_all([x.annotation for x in all_args if x is not None])
+        if node.returns is not None:
+            self.visit(node.returns)
+        self.push("mt_" + node.name, "function")
+        self._bind_args(node.args)
+        self._visit_all(node.body)
+        self.pop()
+
+    def visit_FunctionDef(self, node: FunctionDef) -> Any:
+        self._visit_function(node)
+
+    def visit_AsyncFunctionDef(self, node: AsyncFunctionDef) -> Any:
+        self._visit_function(node)
+
+    def visit_Lambda(self, node: Lambda) -> Any:
+        self._visit_arg_defaults(node.args)
+        self.push("mt_<lambda>", "function")
+        self._bind_args(node.args)
+        self.visit(node.body)
+        self.pop()
+
+    def visit_ClassDef(self, node: ClassDef) -> Any:
+        self.bind(node.name, "class")
+        self.record(node, "name", node.name)
+        self._visit_all(node.decorator_list)
+        self._visit_all(node.bases)
+        self._visit_all(node.keywords)
+        self.push("cl_" + node.name, "class")
+        self._visit_all(node.body)
+        self.pop()
+
+    def _visit_comprehension(self, node: ListComp | SetComp | DictComp | GeneratorExp, *elts: AST):
+        generators = node.generators
+        self.visit(generators[0].iter)  # the first iterator is evaluated outside the comprehension
+        self.push(self._comp_names[type(node).__name__], "comprehension")
+        for i in range(len(generators)):
+            g = generators[i]
+            self.visit(g.target)
+            if i > 0:
+                self.visit(g.iter)
+            self._visit_all(g.ifs)
+        self._visit_all(elts)
+        self.pop()
+
+    def visit_ListComp(self, node: ListComp) -> Any:
+        self._visit_comprehension(node, node.elt)
+
+    def visit_SetComp(self, node: SetComp) -> Any:
+        self._visit_comprehension(node, node.elt)
+
+    def visit_GeneratorExp(self, node: GeneratorExp) -> Any:
+        self._visit_comprehension(node, node.elt)
+
+    def visit_DictComp(self, node: DictComp) -> Any:
+        self._visit_comprehension(node, node.key, node.value)
+
+    def visit_NamedExpr(self, node: NamedExpr) -> Any:
+        self.visit(node.value)
+        s = self.scope
+        while s.kind == "comprehension":  # walrus targets in comprehensions bind in the enclosing scope
+            s = s.parent
+        self.bind(node.target.id, "var", s)
+        self.occurrences.append((s, node.target, "id", node.target.id))
+
+    def visit_Global(self, node: Global) -> Any:
+        for i in range(len(node.names)):
+            x = node.names[i]
+            self.scope.global_names.add(x)
+            # a global statement can define a var at module level, make sure it has a name there
+            self.bind(x, "var", self.scope.root)
+            self.record(node.names, i, x)
+
+    def visit_Nonlocal(self, node: Nonlocal) -> Any:
+        for i in range(len(node.names)):
+            self.scope.nonlocal_names.add(node.names[i])
+            self.record(node.names, i, node.names[i])
+
+    def visit_Import(self, node: Import) -> Any:
+        for x in node.names:
+            if "." in x.name:  # BIG TODO
+                continue
+            bound = x.asname if x.asname is not None else x.name
+            self.bind(bound, "var")
+            x.asname = bound
+            self.record(x, "asname", bound)
+
+    def visit_ImportFrom(self, node: ImportFrom) -> Any:
+        # names imported from other modules keep their name, unless something else renames them in this scope
+        for x in node.names:
+            if x.name == "*":
+                continue
+            bound = x.asname if x.asname is not None else x.name
+            self.record(x, "asname", bound)
+
+    def visit_ExceptHandler(self, node: ExceptHandler) -> Any:
+        if node.type is not None:
+            self.visit(node.type)
+        if node.name is not None:
+            self.bind(node.name, "var")
+            self.record(node, "name", node.name)
+        self._visit_all(node.body)
+
+    def _visit_capture(self, node: MatchAs | MatchStar | MatchMapping, field: str):
+        name = getattr(node, field)
+        if name is not None:
+            self.bind(name, "var")
+            self.record(node, field, name)
+        self.generic_visit(node)
+
+    def visit_MatchAs(self, node: MatchAs) -> Any:
+        self._visit_capture(node, "name")
+
+    def visit_MatchStar(self, node: MatchStar) -> Any:
+        self._visit_capture(node, "name")
+
+    def visit_MatchMapping(self, node: MatchMapping) -> Any:
+        self._visit_capture(node, "rest")
+
+    def visit_Name(self, node: Name) -> Any:
+        if isinstance(node.ctx, Store):
+            self.bind(node.id, "var")
+        self.record(node, "id", node.id)
@@ -0,0 +1,161 @@
+import ast
+import marshal
+import os.path
+from ast import *
+from typing import Any
+
+from analysis import get_analysis
+from manifest import digest
+
+STORE_VERSION = 2
+FACTS = ("digest", "ast_digest", "imports", "names")
+
+
+class SourceFile:
+    """
+    A source file, as it was when the store first saw it. The source and its AST are loaded when first needed. Facts
+    about them (digests, imports, names) are computed once, and kept between runs if the store is persisted, so
+    files that didn't change don't have to be read or parsed for them
+    """
+
+    def __init__(self, path: str, stat: tuple[int, int], facts: dict[str, Any] | None = None):
+        self.path = path
+        self.stat = stat  # (mtime in ns, size)
+        self.facts: dict[str, Any] = facts if facts is not None else {}
+        self._raw: bytes | None = None
+        self._tree: Module | None = None
+
+    @property
+    def source(self) -> str:
+        if self._raw is None:
+            with open(self.path, "rb") as f:
+                self._raw = f.read()
+        return self._raw.decode("utf8")
+
+    @property
+    def tree(self) -> Module:
+        """
+        The AST of the file. Shared by everyone asking for it, so it must not be changed. See take_tree
+        """
+        if self._tree is None:
+            self._tree = ast.parse(self.source)
+        return self._tree
+
+    def take_tree(self) -> Module:
+        """
+        Takes the AST of the file, to transform it. The file forgets it, so the next one asking for it gets a freshly
+        parsed one
+        """
+        tree = self.tree
+        self._tree = None
+        self._raw = None
+        return tree
+
+    def learn(self):
+        """
+        Finds out every fact about the file, then forgets its source and AST, so only the facts stay in memory
+        """
+        for x in FACTS:
+            getattr(self, x)
+        self._tree = None
+        self._raw = None
+
+    @property
+    def learned(self) -> bool:
+        return all(x in self.facts for x in FACTS)
+
+    def _fact(self, name: str, compute) -> Any:
+        r = self.facts.get(name)
+        if r is None:
+            r = self.facts[name] = compute()
+        return r
+
+    @property
+    def digest(self) -> str:
+        """
+        Digest of the source
+        """
+        return self._fact("digest", lambda: digest(self.source.encode("utf8")))
+
+    @property
+    def ast_digest(self) -> str:
+        """
+        Digest of the dumped AST. Stays the same if only formatting and comments change
+        """
+        return self._fact("ast_digest", lambda: digest(ast.dump(self.tree).encode("utf8")))
+
+    @property
+    def imports(self) -> list[tuple[str | None, int, list[str] | None]]:
+        """
+        The imports of the file, in the order ast.walk finds them: (module, level of a relative import, imported
+        names). "import a.b" is ("a.b", 0, None), "from ..a import b, c" is ("a", 2, ["b", "c"]), and relative imports
+        without a module name have None as the module
+        """
+        def compute():
+            r = []
+            for node in ast.walk(self.tree):
+                if isinstance(node, Import):
+                    r.extend((x.name, 0, None) for x in node.names)
+                elif isinstance(node, ImportFrom):
+                    r.append((node.module, node.level, [x.name for x in node.names]))
+            return r
+
+        return self._fact("imports", compute)
+
+    @property
+    def names(self) -> list[str]:
+        """
+        The names the file mentions, sorted. See FileAnalysis.referenced_names
+        """
+        return self._fact("names", lambda: sorted(get_analysis(self.tree).referenced_names))
+
+
+class SourceStore:
+    """
+    Reads and parses each source file once per run, for everyone needing it: dependency discovery, the cache and the
+    manifest, and the transformers. Files are keyed by their absolute path, and count as changed when their
+    modification time or size do. If persisted, the facts about each file are kept in between runs. ASTs aren't,
+    since loading one is about as slow as parsing the source again
+    """
+
+    def __init__(self, path: str | None = None):
+        """
+        :param path: The file to keep the facts in between runs, None to not keep them
+        """
+        self.path = path
+        self.files: dict[str, SourceFile] = {}
+        self.persisted: dict[str, tuple[tuple[int, int], dict[str, Any]]] = {}
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path, "rb") as f:
+                    version, persisted = marshal.load(f)
+                if version == STORE_VERSION:
+                    self.persisted = persisted
+            except (OSError, ValueError, EOFError, TypeError):
+                pass
+
+    def get(self, path: str) -> SourceFile:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stat = (st.st_mtime_ns, st.st_size)
+        f = self.files.get(path)
+        if f is not None and f.stat == stat:
+            return f
+        facts = None
+        kept = self.persisted.get(path)
+        if kept is not None and tuple(kept[0]) == stat:
+            facts = kept[1]
+        f = self.files[path] = SourceFile(path, stat, facts)
+        return f
+
+    def save(self):
+        """
+        Keeps the facts about the files this run saw, if persisted
+        """
+        if self.path is None:
+            return
+        out = {k: (v.stat, v.facts) for k, v in self.files.items()}
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            marshal.dump((STORE_VERSION, out), f)
+        os.replace(tmp, self.path)
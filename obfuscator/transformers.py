@@ -1,9 +1,8 @@
 import base64
 import hashlib
-import marshal
+import inspect
 import math
 import os.path
-import random
 import sys
 import zlib
 from _ast import Module, Call
@@ -13,55 +12,148 @@ from typing import Callable, Any
 import rich
 from Crypto.Cipher import AES
 
+from analysis import get_analysis
 from cfg import ConfigSegment, ConfigValue
 from ast import *
 
-from renamer import MappingGenerator, MappingApplicator, OtherFileMappingApplicator
+from fusion import SKIP, FusedPass, WalkContext
+from hotspots import get_hot, has_hot_functions
+
+from renamer import MappingGenerator, MappingApplicator, OtherFileMappingApplicator, SinglePassRenamer, \
+    create_name_generator, ReservingNameGenerator
 from util import ast_import_full
-from util import randomize_cache, ast_import_from
+from util import rng, randomize_cache, dump_code, ast_import_from, ScopeBindings, with_prelude, mark_loop_invariant, is_loop_invariant
 
 
 class Transformer(object):
+    # Transformers that link files together run in two phases in transitive mode: transform_collect on every file,
+    # then transform_link on every file, once the exports of all files are known
+    links_files = False
+
     def __init__(self, name: str, desc: str, **add_config: ConfigValue):
         self.name = name
         self.config = ConfigSegment(self.name, desc,
                                     enabled=ConfigValue("Enables this transformer", False),
                                     **add_config)
         self.console: rich.Console = None
+        self.hot = False  # currently in a hot function?
+        self.hot_function: FunctionDef | AsyncFunctionDef | None = None  # the hot function self.hot was set by
+
+    def for_file(self) -> "Transformer":
+        """
+        Creates an instance of this transformer to transform one file with. It shares the configuration and console of
+        this one, but has its own state, so instances for different files can run concurrently. The configuration is
+        only ever read while transforming. Anything a file needs from its first phase in transform_link goes through
+        the AST or the exports, since both phases get their own instance
+        :return: The new instance
+        """
+        inst = type(self)()
+        inst.config = self.config
+        inst.console = self.console
+        return inst
 
     def transform(self, ast: AST, current_file_name, all_asts, all_file_names) -> AST:
         return ast
 
+    def transform_collect(self, ast: AST, current_file_name, previous_exports: Any = None) -> tuple[AST, Any]:
+        """
+        First phase of a transformer that links files. Transforms the file on its own
+        :param ast:               The file
+        :param current_file_name: The path of the file
+        :param previous_exports:  What the file exported when it was obfuscated before, if it was. Exports should stay
+                                  the same where the file didn't change, since files importing it are only obfuscated
+                                  again if what they use from it changed
+        :return: The transformed file, and what it exports to files importing it. Has to be json serializable
+        """
+        return self.transform(ast, current_file_name, None, None), None
+
+    def transform_link(self, ast: AST, current_file_name, imports: dict[str, Any]) -> AST:
+        """
+        Second phase of a transformer that links files. Applies what the imported files exported to this file
+        :param ast:               The file
+        :param current_file_name: The path of the file
+        :param imports:           Import key of a module this file imports (see import_key) -> exports of the file it
+                                  resolves to
+        :return: The transformed file
+        """
+        return ast
+
+    def enter_function(self, node: FunctionDef | AsyncFunctionDef, lighten: str | None = None) -> Any:
+        """
+        Enters a function, minding if it's hot. Transformers without a cheaper variant skip hot functions entirely,
+        the others get self.hot set until leave_function is called with the same function
+        :param node:    The function
+        :param lighten: What the transformer does differently in hot functions, None if it skips them
+        :return: SKIP if the function is skipped, None otherwise
+        """
+        hot = get_hot(node)
+        if hot is None or self.hot:  # nested functions of a hot function are treated as part of it
+            return None
+        qualname, calls = hot
+        if lighten is None:
+            self.log_hot(f"skipped hot function {qualname} ({calls} calls)")
+            return SKIP
+        self.log_hot(f"{lighten} in hot function {qualname} ({calls} calls)")
+        self.hot = True
+        self.hot_function = node
+        return None
+
+    def leave_function(self, node: FunctionDef | AsyncFunctionDef):
+        if self.hot_function is node:
+            self.hot = False
+            self.hot_function = None
 
-def compute_import_path(from_path: str, to_path: str):
-    common_prefix = len(os.path.commonpath(
-        [
-            os.path.dirname(from_path),
-            os.path.dirname(to_path)
-        ]
-    ))
-    from_path = from_path[common_prefix+1:].split(os.path.sep)
-    to_path = to_path[common_prefix+1:].split(os.path.sep)
+    def log_hot(self, msg: str):
+        if self.console is not None:
+            self.console.log(f"{self.name}: {msg}", style="yellow")
 
-    full_imp = ""
-    while len(from_path) > 1:
-        full_imp += ".."
-        from_path.pop(0)
-    if to_path[len(to_path)-1] == "__init__.py":
-        to_path.pop()
 
-    for x in to_path:
-        full_imp += x + "."
-    full_imp = full_imp[:-1]
-    if full_imp.endswith(".py"):
-        full_imp = full_imp[:-3]
-    return full_imp
+class FusibleTransformer(Transformer):
+    """
+    A transformer made of hooks on the node types it handles, see fusion.node_hooks. Can run in one traversal of the
+    AST together with other fusible transformers
+    """
+    fusible = True
+
+    def __init__(self, name: str, desc: str, **add_config: ConfigValue):
+        super().__init__(name, desc, **add_config)
+        self.context: WalkContext | None = None  # set by the pass running this transformer
+
+    def begin(self, ast: AST, current_file_name):
+        """
+        Sets up the state for transforming a file, before the traversal
+        """
+        pass
+
+    def finish(self, ast: AST) -> AST:
+        """
+        Finishes transforming a file after the traversal, adding preludes or similar
+        :return: The transformed file
+        """
+        return ast
+
+    def transform(self, ast: AST, current_file_name, all_asts, all_file_names) -> AST:
+        return FusedPass([self]).run(ast, current_file_name)
 
 
 class MemberRenamer(Transformer):
+    links_files = True
+
     def __init__(self):
         super().__init__("renamer", "Renames all members (methods, classes, fields, args)",
-                         rename_format=ConfigValue("Format for the renamer. Will be queried using eval().\n"
+                         engine=ConfigValue("Renamer engine to use.\n"
+                                            "'visitor' generates all mappings in one pass, and applies them in another\n"
+                                            "'singlepass' analyzes scopes and renames in a single pass, following "
+                                            "python's scoping rules for comprehensions, globals and class bodies",
+                                            "visitor"),
+                         name_generator=ConfigValue("Generator for new names.\n"
+                                                    "'format' evaluates rename_format for each name\n"
+                                                    "'counter' generates '{kind}{n}' names with a counter per kind, without "
+                                                    "eval. Same output as the default rename_format, but faster\n"
+                                                    "'random' generates random names out of similar looking characters",
+                                                    "format"),
+                         rename_format=ConfigValue("Format for the renamer, if name_generator is 'format'. Will be "
+                                                   "compiled once, and evaluated for each name generated.\n"
                                                    "'counter' is a variable incrementing with each name generated\n"
                                                    "'kind' is either 'method', 'var', 'arg' or 'class', depending on the current element\n"
                                                    "'get_counter(name)' is a method that increments a counter behind 'name', and returns its current "
@@ -69,29 +161,38 @@ class MemberRenamer(Transformer):
                                                    "f'{kind}{get_counter(kind)}'"))
 
     def transform(self, ast: AST, current_file_name, all_asts, all_file_names) -> AST:
-        generator = MappingGenerator(self.config["rename_format"].value)
-        generator.visit(ast)
-        MappingApplicator(generator.mappings).visit(ast)
-        if all_asts is not None:
-            mappings1 = {}
-            this_file_name = os.path.abspath(current_file_name)
-            for x in generator.mappings.keys():
-                n = x.split(".")
-                if n[0] == "":
-                    # self.console.log(current_file_name, n)
-                    mappings1[n[1]] = generator.mappings[x]
-            for i in range(len(all_asts)):
-                that_ast = all_asts[i]
-                if that_ast == ast:
-                    continue
-                that_file_name = os.path.abspath(all_file_names[i])
-                required_import = compute_import_path(that_file_name, this_file_name)
-                # self.console.log(required_import)
-                OtherFileMappingApplicator(mappings1, required_import, list(mappings1.keys())).visit(that_ast)
+        return self.transform_collect(ast, current_file_name)[0]
+
+    def transform_collect(self, ast: AST, current_file_name,
+                          previous_exports: dict[str, str] | None = None) -> tuple[AST, dict[str, str]]:
+        name_generator = create_name_generator(self.config["name_generator"].value,
+                                               self.config["rename_format"].value)
+        # module level names keep what they were renamed to last time, so files importing them stay valid
+        pinned = previous_exports or {}
+        if len(pinned) > 0:
+            name_generator = ReservingNameGenerator(name_generator, set(pinned.values()))
+        engine = self.config["engine"].value
+        if engine == "singlepass":
+            renamer = SinglePassRenamer(name_generator, pinned)
+            renamer.visit(ast)
+            renamer.apply()
+            mappings = renamer.mappings
+        elif engine == "visitor":
+            generator = MappingGenerator(name_generator, pinned)
+            generator.visit(ast)
+            MappingApplicator(generator.mappings).visit(ast)
+            mappings = generator.mappings
+        else:
+            raise ValueError(f"Unknown renamer engine {engine!r}, expected 'visitor' or 'singlepass'")
+        return ast, dict(mappings.names)  # module level names only
+
+    def transform_link(self, ast: AST, current_file_name, imports: dict[str, dict[str, str]]) -> AST:
+        if len(imports) > 0:
+            OtherFileMappingApplicator(imports).visit(ast)
         return ast
 
 
-class Collector(Transformer, NodeTransformer):
+class Collector(FusibleTransformer):
     class _const:
         def to_ast_loader(self):
             return Constant(self.b)
@@ -99,8 +200,18 @@ class Collector(Transformer, NodeTransformer):
         def __init__(self, b):
             self.b = b
 
+        def key(self):
+            """
+            The key this constant is interned under. Includes the type, so 1, True and 1.0 don't collide, and the repr
+            of floats, so 0.0 and -0.0 don't either
+            """
+            return type(self.b), repr(self.b) if isinstance(self.b, (float, complex)) else self.b
+
         def __eq__(self, other):
-            return hasattr(other, "b") and other.b == self.b
+            return isinstance(other, Collector._const) and other.key() == self.key()
+
+        def __hash__(self):
+            return hash(self.key())
 
     class _resfunc(_const):
         def to_ast_loader(self):
@@ -115,62 +226,121 @@ class Collector(Transformer, NodeTransformer):
             self.name = name
             super().__init__(f"{owner}.{name}")
 
+        def key(self):
+            return Collector._resfunc, self.owner, self.name
+
     def __init__(self):
-        self.in_formatted_str = False
         # self.collect_consts = config["collect_consts"].value
         self.found = []
+        self.found_index = {}
+        self.bindings: ScopeBindings | None = None
+        self.scope_stack: list[set[str]] = []
+        self.call_slots: dict[int, int] = {}  # names index -> slot
+        self.slot_table_name = None
+        self.globals_name = None
+        self.builtins_name = None
+        self.slots_mode = False
         super().__init__("collector", "Collects method calls and constants",
-                         collect_consts=ConfigValue("Collects constants", True))
+                         collect_consts=ConfigValue("Collects constants", True),
+                         call_indirection=ConfigValue("How calls to plain names are replaced.\n"
+                                                      "'eval' looks the callable up with eval(names[i]) on every call\n"
+                                                      "'slots' looks the callable up in the module's globals and "
+                                                      "the builtins directly, which is much faster than eval. It's "
+                                                      "still looked up on every call, so reassigning or patching it "
+                                                      "works like before. Calls to names local to a function or "
+                                                      "class are left alone",
+                                                      "eval"))
 
-    def visit_JoinedStr(self, node: JoinedStr) -> Any:
-        self.in_formatted_str = True
-        r = self.generic_visit(node)
-        self.in_formatted_str = False
-        return r
+    def intern(self, ref: _const) -> int:
+        """
+        Gets the index of a constant in the pool, adding it if it's not in there yet
+        :param ref: The constant
+        :return: Its index in the names list
+        """
+        key = ref.key()
+        idx = self.found_index.get(key)
+        if idx is None:
+            idx = len(self.found)
+            self.found.append(ref)
+            self.found_index[key] = idx
+        return idx
 
-    def visit_FormattedValue(self, node: FormattedValue) -> Any:
-        prev = self.in_formatted_str
-        self.in_formatted_str = False
-        r = self.generic_visit(node)
-        self.in_formatted_str = prev
-        return r
+    def call_slot(self, idx: int) -> int:
+        """
+        Gets the slot of the callable at names[idx], allocating one if needed
+        :param idx: The index of the name of the callable
+        :return: The slot index
+        """
+        slot = self.call_slots.get(idx)
+        if slot is None:
+            slot = len(self.call_slots)
+            self.call_slots[idx] = slot
+        return slot
+
+    def _enter_scope(self, node: AST) -> Any:
+        if self.bindings is None:
+            return None
+        self.scope_stack.append(self.bindings.scope_names.get(node, set()))
+        if isinstance(node, (FunctionDef, AsyncFunctionDef)) and not self.slots_mode:
+            return self.enter_function(node, "resolved calls through slots instead of eval")
+        return None
+
+    def _leave_scope(self, node: AST):
+        if self.bindings is None:
+            return
+        self.scope_stack.pop()
+        self.leave_function(node)
 
-    def visit_Constant(self, node: Constant) -> Any:
+    enter_FunctionDef = enter_AsyncFunctionDef = enter_Lambda = enter_ClassDef = _enter_scope
+    enter_ListComp = enter_SetComp = enter_DictComp = enter_GeneratorExp = _enter_scope
+    leave_FunctionDef = leave_AsyncFunctionDef = leave_Lambda = leave_ClassDef = _leave_scope
+    leave_ListComp = leave_SetComp = leave_DictComp = leave_GeneratorExp = _leave_scope
+
+    def rewrite_Constant(self, node: Constant) -> Any:
         if self.config["collect_consts"].value:
-            val = node.value
-            ref = self._const(val)
-            if ref in self.found:
-                idx = self.found.index(ref)
-            else:
-                idx = len(self.found)
-                self.found.append(ref)
-            if self.in_formatted_str:
+            idx = self.intern(self._const(node.value))
+            if self.context.fstring_literal:
                 return FormattedValue(
-                    value=Subscript(
+                    value=mark_loop_invariant(Subscript(
                         value=Name('names', Load()),
                         slice=Constant(idx),
                         ctx=Load()
-                    ),
+                    )),
                     conversion=-1
                 )
             else:
-                return Subscript(
+                return mark_loop_invariant(Subscript(
                     value=Name('names', Load()),
                     slice=Constant(idx),
                     ctx=Load()
-                )
-        return self.generic_visit(node)
+                ))
+        return node
 
-    def visit_Call(self, node: Call) -> Any:
-        r = self.generic_visit(node)
+    def rewrite_Call(self, node: Call) -> Any:
+        r = node
         if isinstance(node.func, Name) and isinstance(node.func.ctx, Load):
             strified_name = node.func.id
-            ref = self._const(strified_name)
-            if ref in self.found:  # Already in list, use present index
-                idx = self.found.index(ref)
-            else:
-                idx = len(self.found)
-                self.found.append(ref)
+            if self.slots_mode or self.hot:
+                if any(strified_name in x for x in self.scope_stack):
+                    return r  # local names can't be resolved through the globals, leave the call alone
+                idx = self.intern(self._const(strified_name))
+                node.func = Call(  # -> g.get(names[idx], b.get(names[idx], slots[slot]))
+                    func=Attribute(Name(self.globals_name, Load()), "get", Load()),
+                    args=[
+                        Subscript(Name('names', Load()), Constant(idx), Load()),
+                        Call(
+                            func=Attribute(Name(self.builtins_name, Load()), "get", Load()),
+                            args=[
+                                Subscript(Name('names', Load()), Constant(idx), Load()),
+                                Subscript(Name(self.slot_table_name, Load()), Constant(self.call_slot(idx)), Load())
+                            ],
+                            keywords=[]
+                        )
+                    ],
+                    keywords=[]
+                )
+                return r
+            idx = self.intern(self._const(strified_name))
             node.func = Call(  # -> eval(names[idx])
                 func=Name('eval', Load()),
                 args=[
@@ -190,25 +360,32 @@ class Collector(Transformer, NodeTransformer):
             if isinstance(attrib_owner, Constant):
                 const_value = attrib_owner.value
                 the_type = type(const_value).__name__
-                ref = self._resfunc(the_type, node.func.attr)
-                if ref in self.found:
-                    idx = self.found.index(ref)
-                else:
-                    idx = len(self.found)
-                    self.found.append(ref)
-                node.func = Subscript(
+                idx = self.intern(self._resfunc(the_type, node.func.attr))
+                node.func = mark_loop_invariant(Subscript(
                     value=Name('names', Load()),
                     slice=Constant(idx),
                     ctx=Load()
-                )
+                ))
                 node.args.insert(0, attrib_owner)
         return r
 
-    def transform(self, ast: AST, current_file_name, all_asts, all_file_names) -> AST:
+    def begin(self, ast: AST, current_file_name):
         self.found = []
-        ast = self.visit(ast)
+        self.found_index = {}
+        self.call_slots = {}
+        self.scope_stack = []
+        self.slots_mode = self.config["call_indirection"].value == "slots"
+        if self.slots_mode or has_hot_functions(ast):  # hot functions use slots, even in eval mode
+            self.bindings = get_analysis(ast)
+            self.slot_table_name = rnd_name()
+            self.globals_name = rnd_name()
+            self.builtins_name = rnd_name()
+        else:
+            self.bindings = None
+
+    def finish(self, ast: AST) -> AST:
         new_ast: Module = Module(
-            body=[
+            body=with_prelude(ast.body, [  # copy old body over
                 Assign(  # names = [x for x in t.found]
                     targets=[
                         Name('names', Store())
@@ -218,27 +395,75 @@ class Collector(Transformer, NodeTransformer):
                         ctx=Load()
                     )
                 ),
-                *ast.body  # copy old body over
-            ],
+                *(self.slot_table_loader() if len(self.call_slots) > 0 else []),
+            ]),
             type_ignores=[]
         )
         return new_ast
 
+    def slot_table_loader(self) -> list[stmt]:
+        """
+        Creates the dicts calls look their callables up in, and the slot table with what they fall back to when a name
+        is in neither, which raises the NameError the original call would have raised
+        :return: The statements creating them
+        """
+        slot_names = [0] * len(self.call_slots)
+        for idx, slot in self.call_slots.items():
+            slot_names[slot] = idx
+        undefined = rnd_name()
+        return parse(
+            f"{self.globals_name} = globals()\n"
+            f"{self.builtins_name} = __import__('builtins').__dict__\n"
+            f"def {undefined}(n):\n"
+            f"    def slot(*a, **k):\n"
+            f"        raise NameError(\"name '\" + n + \"' is not defined\")\n"
+            f"    return slot\n"
+            f"{self.slot_table_name} = [{undefined}(names[i]) for i in {tuple(slot_names)!r}]\n"
+        ).body
+
 
-class IntObfuscator(Transformer, NodeTransformer):
+class IntObfuscator(FusibleTransformer):
     def __init__(self):
-        super().__init__("intObfuscator", "Obscures int constants")
+        self.table: dict[int, int] = {}  # value -> index in the table
+        self.table_name = None
+        self.table_mode = False
+        super().__init__("intObfuscator", "Obscures int constants",
+                         mode=ConfigValue("How ints are obscured.\n"
+                                          "'inline' replaces every int with an expression decoding it, which runs "
+                                          "every time the int is used\n"
+                                          "'table' encodes all ints of a file into one blob, which is decoded once when "
+                                          "the file is imported. Every int is replaced with a lookup into the decoded "
+                                          "table",
+                                          "inline"))
+
+    def enter_FunctionDef(self, node: FunctionDef) -> Any:
+        if self.table_mode:
+            return None
+        return self.enter_function(node, "looked ints up in a table")
 
-    def visit_Constant(self, node: Constant) -> Any:
-        s = self.generic_visit(node)
+    def leave_FunctionDef(self, node: FunctionDef):
+        self.leave_function(node)
+
+    enter_AsyncFunctionDef = enter_FunctionDef
+    leave_AsyncFunctionDef = leave_FunctionDef
+
+    def rewrite_Constant(self, node: Constant) -> Any:
+        s = node
+        if type(node.value) == int and (self.table_mode or self.hot):
+            idx = self.table.setdefault(node.value, len(self.table))
+            return mark_loop_invariant(Subscript(  # -> table[idx]
+                value=Name(self.table_name, Load()),
+                slice=Constant(idx),
+                ctx=Load()
+            ))
         if type(node.value) == int:
             ic: int = node.value
             is_signed = ic < 0  # signed bit needs to be set only if ic is negative
             rdx = math.ceil((ic.bit_length() + (1 if is_signed else 0)) / 8)  # add said sign bit if the int is signed
             int_bytes = ic.to_bytes(rdx, "little", signed=is_signed)
-            off = random.randint(255 + rdx, 999)  # need to keep at least rdx indexes free
+            off = rng.randint(255 + rdx, 999)  # need to keep at least rdx indexes free
             encoded = "".join([format(off - (x + i), "03d") for (x, i) in zip(int_bytes, range(len(int_bytes)))])
-            return Call(  # int.from_bytes(..., "little", signed=is_signed)
+            return mark_loop_invariant(Call(  # int.from_bytes(..., "little", signed=is_signed)
                 func=Attribute(Name('int', Load()), 'from_bytes', Load()),  # int.from_bytes
                 args=[
                     Call(  # map(lambda O: 255-int(O), map(''.join, zip(*[iter(encoded)]*3)))
@@ -308,18 +533,57 @@ class IntObfuscator(Transformer, NodeTransformer):
                         arg='signed',
                         value=Constant(is_signed)
                     )
-                ])
+                ]))
         return s
 
-    def transform(self, ast: AST, current_file_name, all_asts, all_file_names) -> AST:
-        return self.visit(ast)
+    def table_loader(self) -> list[stmt]:
+        """
+        Creates the loader for the int table. Every int is stored as a 2 byte length and its signed little endian
+        bytes, and the entire blob is xor'd with a running key
+        :return: The statements decoding the table
+        """
+        raw = bytearray()
+        for v in self.table.keys():
+            b = v.to_bytes(max(1, math.ceil((v.bit_length() + 1) / 8)), "little", signed=True)
+            raw.extend(len(b).to_bytes(2, "little"))
+            raw.extend(b)
+        key = rng.randint(0, 255)
+        blob = bytes([(x ^ (key + i)) & 255 for (x, i) in zip(raw, range(len(raw)))])
+        decoder = rnd_name()
+        return parse(
+            f"def {decoder}(b, k):\n"
+            f"    b = bytes([(x ^ (k + i)) & 255 for (i, x) in enumerate(b)])\n"
+            f"    t = []\n"
+            f"    p = 0\n"
+            f"    while p < len(b):\n"
+            f"        n = b[p] | b[p + 1] << 8\n"
+            f"        t.append(int.from_bytes(b[p + 2:p + 2 + n], 'little', signed=True))\n"
+            f"        p += n + 2\n"
+            f"    return t\n"
+            f"{self.table_name} = {decoder}({blob!r}, {key})\n"
+        ).body
+
+    def begin(self, ast: AST, current_file_name):
+        self.table_mode = self.config["mode"].value == "table"
+        self.table = {}
+        self.table_name = rnd_name()
+
+    def finish(self, ast: AST) -> AST:
+        if len(self.table) > 0:
+            ast.body = with_prelude(ast.body, self.table_loader())
+        return ast
 
 
-class ReplaceAttribs(Transformer, NodeTransformer):
+class ReplaceAttribs(FusibleTransformer):
     def __init__(self):
         super().__init__("replaceAttribSet", "Replaces direct attribute sets with setattr")
 
-    def visit_Assign(self, node: Assign) -> Any:
+    def enter_FunctionDef(self, node: FunctionDef) -> Any:
+        return self.enter_function(node)
+
+    enter_AsyncFunctionDef = enter_FunctionDef
+
+    def rewrite_Assign(self, node: Assign) -> Any:
         if len(node.targets) == 1:
             attrib = node.targets[0]
             if isinstance(attrib, Attribute):
@@ -335,14 +599,11 @@ class ReplaceAttribs(Transformer, NodeTransformer):
                     ],
                     keywords=[]
                 ))
-        return self.generic_visit(node)
-
-    def transform(self, ast: AST, current_file_name, all_asts, all_file_names) -> AST:
-        return self.visit(ast)
+        return node
 
 
 def rnd_name():
-    return "".join(random.choices(["l", "I", "M", "N"], k=32))
+    return "".join(rng.choices(["l", "I", "M", "N"], k=32))
 
 
 class ConstructDynamicCodeObject(Transformer):
@@ -352,7 +613,7 @@ class ConstructDynamicCodeObject(Transformer):
         "co_kwonlyargcount",
         "co_nlocals",
         "co_stacksize",
-        ("co_flags", 0),
+        "co_flags",
         "co_code",
         "co_consts",
         "co_names",
@@ -368,21 +629,31 @@ class ConstructDynamicCodeObject(Transformer):
     ]
 
     def __init__(self):
-        self.code_obj_dict = dict()
         super().__init__("dynamicCodeObjLauncher",
                          "Launches the program by constructing it from the ground up with dynamic code objects. This REQUIRES PYTHON 3.11",
-                         encrypt=ConfigValue("Encrypts the bytecode with a dynamically generated AES key", True))
-
-    def get_all_code_objects(self, args):
-        # args = self.args_from_co(code)
-        all_cos = []
-        for x in args:
-            if isinstance(x, list) or isinstance(x, tuple):
-                all_cos = [*self.get_all_code_objects(x), *all_cos]
-            elif isinstance(x, CodeType):
-                all_cos.append(x)
-                all_cos = [*self.get_all_code_objects(self.args_from_co(x)), *all_cos]
-        return all_cos
+                         encrypt=ConfigValue("Encrypts the bytecode with a dynamically generated AES key", True),
+                         lazy_decrypt=ConfigValue("If encrypt is on, encrypts every function separately, and only "
+                                                  "decrypts it the first time it's called, instead of decrypting "
+                                                  "all of the code on startup. Startup time then scales with the code "
+                                                  "that actually runs. The output gets about 60% larger, like "
+                                                  "5.7 MiB instead of 3.5 MiB for 1000 functions",
+                                                  False))
+
+    def get_all_code_objects(self, code: CodeType, found: dict[CodeType, None] | None = None) -> list[CodeType]:
+        """
+        Collects all code objects nested in a code object, recursively. Those are always constants of the code
+        object they're nested in
+        :param code:  The code object
+        :param found: Code objects found so far, used when recursing
+        :return: The code objects, each one after all code objects nested in it
+        """
+        if found is None:
+            found = {}
+        for x in code.co_consts:
+            if isinstance(x, CodeType) and x not in found:
+                self.get_all_code_objects(x, found)
+                found[x] = None
+        return list(found)
 
     def args_from_co(self, code: CodeType):
         return [getattr(code, x) if not isinstance(x, tuple) else x[1] for x in self._ctype_arg_names]
@@ -398,32 +669,25 @@ class ConstructDynamicCodeObject(Transformer):
                 elts=[self._parse_const(x, ctx) for x in el],
                 ctx=ctx
             )
-        elif isinstance(el, CodeType):
-            if el in self.code_obj_dict:  # we have a generator for this, use it
-                return Call(
-                    func=Name(self.code_obj_dict[el], Load()),
-                    args=[],
-                    keywords=[]
-                )
-            else:  # we dont have a generator? alright then, just marshal it
-                b = marshal.dumps(el)
-                return Call(
-                    func=Attribute(
-                        value=Call(
-                            func=Name('__import__', Load()),
-                            args=[
-                                Constant("marshal")
-                            ],
-                            keywords=[]
-                        ),
-                        attr="loads",
-                        ctx=Load()
+        elif isinstance(el, CodeType):  # just marshal it
+            b = dump_code(el)
+            return Call(
+                func=Attribute(
+                    value=Call(
+                        func=Name('__import__', Load()),
+                        args=[
+                            Constant("marshal")
+                        ],
+                        keywords=[]
                     ),
-                    args=[
-                        Constant(b)
-                    ],
-                    keywords=[]
-                )
+                    attr="loads",
+                    ctx=Load()
+                ),
+                args=[
+                    Constant(b)
+                ],
+                keywords=[]
+            )
         else:
             # if type(el) == bytes:
             #     from util import randomize_cache
@@ -432,47 +696,31 @@ class ConstructDynamicCodeObject(Transformer):
             return Constant(el)
 
     def create_code_obj_loader(self, func_name: str, compiled_code_obj: CodeType,
-                               process_bytecode: Callable[[list], None] = lambda x: randomize_cache(x)) -> FunctionDef:
+                               process_bytecode: Callable[[bytearray], None] = lambda x: randomize_cache(x)) -> FunctionDef:
         collected_args = self.args_from_co(compiled_code_obj)
         co_code_index = self._ctype_arg_names.index("co_code")
         co_code = collected_args[co_code_index]
-        co_code_l = list(co_code)
+        co_code_b = bytearray(co_code)
 
-        process_bytecode(co_code_l)
+        process_bytecode(co_code_b)
 
-        collected_args[co_code_index] = bytes(co_code_l)
+        collected_args[co_code_index] = bytes(co_code_b)
         loader_asm = []
-        # value_to_append = dict()
         for i in range(len(collected_args)):  # go over each code object arg
             v = collected_args[i]
+            target = Subscript(
+                value=Name('a', Load()),
+                slice=Constant(i),
+                ctx=Store()
+            )
             if i > 0 and collected_args[i - 1] == collected_args[i]:  # is the one below us the same as this one?
-                elm: list = loader_asm[
-                    len(loader_asm) - 1].value.elts  # then expand the assignment to include us aswell
-                elm.insert(2, self._parse_const(v, Load()))
-                elm[len(elm) - 1].value.slice.lower.value += 1
+                loader_asm[len(loader_asm) - 1].targets.append(target)  # then assign us in the same statement
             else:  # if not, make the assignment
-                ass_statement = Assign(  # a = [*a[:i], <arg>, *a[i+1:]] -> insert us at i
-                    targets=[Name('a', Store())],
-                    value=List(
-                        elts=[
-                            Starred(Subscript(
-                                value=Name('a', Load()),
-                                slice=Slice(upper=Constant(i)),
-                                ctx=Load()
-                            ), Load()),
-                            self._parse_const(v, Load()),
-                            Starred(Subscript(
-                                value=Name('a', Load()),
-                                slice=Slice(lower=Constant(i + 1)),
-                                ctx=Load()
-                            ), Load())
-                        ],
-                        ctx=Load()
-                    )
-                )
-                # value_to_append[v] = ass_statement
-                loader_asm.append(ass_statement)
-        random.shuffle(loader_asm)
+                loader_asm.append(Assign(  # a[i] = <arg>
+                    targets=[target],
+                    value=self._parse_const(v, Load())
+                ))
+        rng.shuffle(loader_asm)
         finished_asm = FunctionDef(
             name=func_name,
             args=arguments(posonlyargs=[],
@@ -521,12 +769,197 @@ class ConstructDynamicCodeObject(Transformer):
         )
         return finished_asm
 
+    @staticmethod
+    def _trampoline(code: CodeType, idx: int, loader: str) -> CodeType:
+        """
+        Creates a trampoline for a lazily decrypted function. It has the same signature as the function, and has the
+        loader decrypt the function and swap it in on the first call, then forwards the call to it
+        :param code:   The code of the function
+        :param idx:    The index of the encrypted function
+        :param loader: Name of the loader function
+        :return: The code of the trampoline
+        """
+        names = code.co_varnames
+        pos = list(names[:code.co_argcount])
+        kw = list(names[code.co_argcount:code.co_argcount + code.co_kwonlyargcount])
+        i = code.co_argcount + code.co_kwonlyargcount
+        params = [*pos]
+        if code.co_posonlyargcount > 0:
+            params.insert(code.co_posonlyargcount, "/")
+        args = [*pos]
+        if code.co_flags & inspect.CO_VARARGS:
+            params.append("*" + names[i])
+            args.append("*" + names[i])
+            i += 1
+        elif len(kw) > 0:
+            params.append("*")
+        params.extend(kw)
+        args.extend(f"{x}={x}" for x in kw)
+        if code.co_flags & inspect.CO_VARKEYWORDS:
+            params.append("**" + names[i])
+            args.append("**" + names[i])
+        free = code.co_freevars
+        # functions sharing the code (like methods of classes made in a loop) only differ in their closure. a lambda
+        # gets the very cells of the trampoline, so the loader can tell which function called it
+        cells = f", (lambda: ({', '.join(free)},)).__closure__" if len(free) > 0 else ""
+        call = f"{loader}({idx}{cells})({', '.join(args)})"
+        if code.co_flags & inspect.CO_COROUTINE:
+            header, body = f"async def t({', '.join(params)}):", f"return await {call}"
+        elif code.co_flags & inspect.CO_GENERATOR:
+            header, body = f"def t({', '.join(params)}):", f"return (yield from {call})"
+        else:
+            header, body = f"def t({', '.join(params)}):", f"return {call}"
+        if len(free) > 0:
+            # the trampoline needs the same free variables (usually __class__), or the closure won't fit the function
+            # once it's swapped in. the lambda uses them
+            src = (f"def o():\n"
+                   f"    {' = '.join(free)} = None\n"
+                   f"    {header}\n"
+                   f"        {body}\n")
+        else:
+            src = f"{header}\n    {body}\n"
+        outer = compile(src, "", "exec")
+        while outer.co_name != "t":
+            outer = [x for x in outer.co_consts if isinstance(x, CodeType)][0]
+        return outer.replace(co_name=code.co_name, co_qualname=code.co_qualname, co_filename=code.co_filename,
+                             co_firstlineno=code.co_firstlineno, co_linetable=b"")
+
+    def _encrypt_functions(self, code: CodeType, key: bytes, loader: str, blobs: list[tuple[bytes, bytes]]) -> CodeType:
+        """
+        Encrypts all functions defined on the module level or in classes separately, and replaces them with
+        trampolines. Nested functions are encrypted along with the function they're in
+        :param code:   The code of the module, or of a class body
+        :param key:    The AES key
+        :param loader: Name of the loader function
+        :param blobs:  Gets filled with the (nonce, encrypted function) of each function
+        :return: The code, with its functions replaced
+        """
+        consts = []
+        for x in code.co_consts:
+            if isinstance(x, CodeType) and not x.co_name.startswith("<"):  # skip lambdas and comprehensions
+                if x.co_flags & inspect.CO_NEWLOCALS == 0:  # class body
+                    x = self._encrypt_functions(x, key, loader, blobs)
+                elif x.co_flags & inspect.CO_ASYNC_GENERATOR == 0:  # can't forward to those properly, leave them
+                    aes = AES.new(key, AES.MODE_EAX, nonce=rng.randbytes(16))
+                    blobs.append((aes.nonce, aes.encrypt(dump_code(x))))
+                    x = self._trampoline(x, len(blobs) - 1, loader)
+            consts.append(x)
+        return code.replace(co_consts=tuple(consts))
+
+    def lazy_loader(self, blobs: list[tuple[bytes, bytes]], loader: str) -> list[stmt]:
+        """
+        Creates the loader for lazily decrypted functions. When a trampoline first runs, the loader decrypts its
+        function and swaps the decrypted code into all functions using the trampoline, then forwards the call to the
+        function that called it. Those are found through an index of the functions reachable from the module
+        (including methods and decorated functions), which is only rebuilt when a trampoline isn't in it yet, so
+        defining functions stays free. If the calling function isn't in the index, every function using the trampoline
+        is searched for on the heap. Trampolines with a closure pass their cells, to tell the calling function apart
+        from others using the same trampoline. If it can't be found at all, the call goes to a new function made from
+        the decrypted code and those cells
+        :param blobs:  (nonce, encrypted function) of each function
+        :param loader: Name of the loader function
+        :return: The statements creating the loader
+        """
+        index = rnd_name()
+        indexer = rnd_name()
+        return parse(
+            f"{index} = {{}}\n"
+            f"def {indexer}(g, x):\n"
+            f"    x.clear()\n"
+            f"    seen = set()\n"
+            f"    todo = list(g.values())\n"
+            f"    while len(todo) > 0:\n"
+            f"        v = todo.pop()\n"
+            f"        if id(v) in seen:\n"
+            f"            continue\n"
+            f"        seen.add(id(v))\n"
+            f"        if type(v) is type({indexer}):\n"
+            f"            x.setdefault(v.__code__, []).append(v)\n"
+            f"        elif isinstance(v, type):\n"
+            f"            if v.__module__ == g.get('__name__'):\n"
+            f"                todo.extend(v.__dict__.values())\n"
+            f"            continue\n"
+            f"        elif isinstance(v, (staticmethod, classmethod)):\n"
+            f"            todo.append(v.__func__)\n"
+            f"        elif isinstance(v, property):\n"
+            f"            todo.extend([v.fget, v.fset, v.fdel])\n"
+            f"        try:  # functools.wraps, lru_cache and friends\n"
+            f"            todo.append(object.__getattribute__(v, '__dict__').get('__wrapped__'))\n"
+            f"        except Exception:\n"
+            f"            pass\n"
+            f"def {loader}(i, e=None, x={index}, n={tuple(x[0] for x in blobs)!r}, d={tuple(x[1] for x in blobs)!r}, "
+            f"k=__import__('hashlib').md5(''.join(map(repr, [b.__code__.co_code, *b.__code__.co_consts, "
+            f"*b.__code__.co_names, *b.__code__.co_varnames])).encode('utf8')).digest()):\n"
+            f"    from Crypto.Cipher import AES\n"
+            f"    t = __import__('sys')._getframe(1)\n"
+            f"    c = t.f_code\n"
+            f"    if c not in x:  # defined since the index got built\n"
+            f"        {indexer}(t.f_globals, x)\n"
+            f"    x[c] = [y for y in x.get(c, []) if y.__code__ is c]\n"
+            f"    f = [y for y in x[c] if e is None or all(a is b for a, b in zip(y.__closure__, e))]\n"
+            f"    if len(f) == 0:  # not reachable from the module, look for it the slow way\n"
+            f"        x[c] = [y for y in __import__('gc').get_referrers(c) if type(y) is type({loader}) "
+            f"and y.__code__ is c]\n"
+            f"        f = [y for y in x[c] if e is None or all(a is b for a, b in zip(y.__closure__, e))]\n"
+            f"    v = __import__('marshal').loads(AES.new(k, 9, n[i]).decrypt(d[i]))\n"
+            f"    for y in x[c]:\n"
+            f"        y.__code__ = v\n"
+            f"    if len(f) == 0:  # nowhere to be found, run the decrypted code for this call. the trampoline passes every "
+            f"argument\n"
+            f"        return type({loader})(v, t.f_globals, c.co_name, None, e)\n"
+            f"    return f[0]\n"
+        ).body
+
+    def create_code_obj_table_loader(self, func_name: str, code_objs: list[CodeType]) -> FunctionDef:
+        """
+        Creates one loader for a list of code objects. Each code object is stored in a table as the arguments to
+        construct it with, and the (index in co_consts, index in the table) of each code object nested in it, which are
+        left out of its co_consts. Since code objects come after the ones nested in them, the loader constructs all of
+        them in one pass
+        :param func_name: Name of the loader
+        :param code_objs: The code objects, each one after all code objects nested in it
+        :return: The loader, returning the last code object
+        """
+        co_code_index = self._ctype_arg_names.index("co_code")
+        co_consts_index = self._ctype_arg_names.index("co_consts")
+        table_index = {}
+        table = []
+        for x in code_objs:
+            collected_args = self.args_from_co(x)
+            co_code_b = bytearray(collected_args[co_code_index])
+            randomize_cache(co_code_b)
+            collected_args[co_code_index] = bytes(co_code_b)
+            consts = list(x.co_consts)
+            nested = []
+            for i in range(len(consts)):
+                if isinstance(consts[i], CodeType):
+                    nested.append((i, table_index[consts[i]]))
+                    consts[i] = None
+            collected_args[co_consts_index] = tuple(consts)
+            table_index[x] = len(table)
+            table.append((tuple(collected_args), tuple(nested)))
+        loader: FunctionDef = parse(
+            f"def {func_name}(t=None):\n"
+            f"    c = []\n"
+            f"    for a, n in t:\n"
+            f"        if len(n) > 0:\n"
+            f"            a = list(a)\n"
+            f"            k = list(a[{co_consts_index}])\n"
+            f"            for i, j in n:\n"
+            f"                k[i] = c[j]\n"
+            f"            a[{co_consts_index}] = tuple(k)\n"
+            f"        c.append(type(b.__code__)(*a))\n"
+            f"    return c[-1]\n"
+        ).body[0]
+        loader.args.defaults = [self._parse_const(tuple(table), Load())]
+        return loader
+
     def do_enc_pass(self, ast_mod: AST) -> Module:
         """
         forgive me
         """
+        lazy = self.config["lazy_decrypt"].value
         compiled_code_obj: CodeType = compile(ast_mod, "", "exec", optimize=2)
-        dumped = marshal.dumps(compiled_code_obj)
         orig_fnc = FunctionDef(
             name="b",
             args=arguments(posonlyargs=[],
@@ -546,9 +979,9 @@ class ConstructDynamicCodeObject(Transformer):
                     )
                 ),
                 *[Assign(
-                    targets=[Name(rnd_name(), Store()) for _ in range(random.randint(3, 5))],
-                    value=Constant(random.randint(0, 65535))
-                ) for _ in range(random.randint(3, 5))]
+                    targets=[Name(rnd_name(), Store()) for _ in range(rng.randint(3, 5))],
+                    value=Constant(rng.randint(0, 65535))
+                ) for _ in range(rng.randint(3, 5))]
             ],
             type_ignores=[]
         )
@@ -561,7 +994,14 @@ class ConstructDynamicCodeObject(Transformer):
             "".join(map(repr, [p.co_consts[0].co_code, *p.co_consts[0].co_consts, *p.co_consts[0].co_names,
                                *p.co_consts[0].co_varnames])).encode(
                 "utf8")).digest()
-        aes = AES.new(key, AES.MODE_EAX)
+        lazy_loader = []
+        if lazy:
+            loader_name = rnd_name()
+            blobs = []
+            compiled_code_obj = self._encrypt_functions(compiled_code_obj, key, loader_name, blobs)
+            lazy_loader = self.lazy_loader(blobs, loader_name)
+        dumped = dump_code(compiled_code_obj)
+        aes = AES.new(key, AES.MODE_EAX, nonce=rng.randbytes(16))
         encrypted = aes.encrypt_and_digest(dumped)
         nonce = aes.nonce
         loader = Module(
@@ -701,6 +1141,7 @@ class ConstructDynamicCodeObject(Transformer):
             type_ignores=[],
             body=[
                 orig_fnc,
+                *lazy_loader,
                 main_loader,
                 Expr(Call(
                     func=Name('exec', Load()),
@@ -725,14 +1166,7 @@ class ConstructDynamicCodeObject(Transformer):
             return self.do_enc_pass(ast_mod)
         else:
             compiled_code_obj: CodeType = compile(ast_mod, bytes([0xDA, 0xAF, 0x1A, 0x87, 0xFF]), "exec", optimize=2)
-            all_code_objs = self.get_all_code_objects(self.args_from_co(compiled_code_obj))
-
-            loaders = []
-            for x in all_code_objs:  # create names first...
-                name = rnd_name()
-                self.code_obj_dict[x] = name
-            for x in all_code_objs:  # ... then use them
-                loaders.append(self.create_code_obj_loader(self.code_obj_dict[x], x))
+            all_code_objs = self.get_all_code_objects(compiled_code_obj)
             main = rnd_name()
             return Module(
                 type_ignores=[],
@@ -747,8 +1181,7 @@ class ConstructDynamicCodeObject(Transformer):
                             defaults=[]),
                         body=[Pass()],
                         decorator_list=[]),
-                    *loaders,
-                    self.create_code_obj_loader(main, compiled_code_obj),
+                    self.create_code_obj_table_loader(main, [*all_code_objs, compiled_code_obj]),
                     Expr(Call(
                         func=Name('exec', Load()),
                         args=[
@@ -764,40 +1197,58 @@ class ConstructDynamicCodeObject(Transformer):
             )
 
 
-class EncodeStrings(Transformer, NodeTransformer):
+class EncodeStrings(FusibleTransformer):
     def __init__(self):
-        self.in_formatted_str = False
-        self.no_lzma = False
-        super().__init__("encodeStrings", "Encodes strings with base64 and (if not in a fstring) lzma")
+        self.pool: dict[tuple[type, str | bytes], int] = {}  # (type, value) -> index in the pool
+        self.pool_name = None
+        self.pool_mode = False
+        super().__init__("encodeStrings", "Encodes strings with base64 and (if not in a fstring) lzma",
+                         mode=ConfigValue("How strings are encoded.\n"
+                                          "'inline' replaces every string with an expression decoding it, which runs "
+                                          "every time the string is used\n"
+                                          "'pool' compresses all strings of a file together into one blob. Each string "
+                                          "is decoded the first time it's used, and remembered afterwards",
+                                          "inline"))
 
-    def visit_JoinedStr(self, node: JoinedStr) -> Any:
-        self.in_formatted_str = True
-        self.no_lzma = True
-        r = self.generic_visit(node)
-        self.no_lzma = False
-        self.in_formatted_str = False
-        return r
+    def enter_FunctionDef(self, node: FunctionDef) -> Any:
+        if self.pool_mode:
+            return None
+        return self.enter_function(node, "decoded strings once through a pool")
 
-    def visit_FormattedValue(self, node: FormattedValue) -> Any:
-        prev = self.in_formatted_str
-        self.in_formatted_str = False
-        r = self.generic_visit(node)
-        self.in_formatted_str = prev
-        return r
+    def leave_FunctionDef(self, node: FunctionDef):
+        self.leave_function(node)
+
+    enter_AsyncFunctionDef = enter_FunctionDef
+    leave_AsyncFunctionDef = leave_FunctionDef
 
-    def visit_Constant(self, node: Constant) -> Any:
+    def rewrite_Constant(self, node: Constant) -> Any:
         val = node.value
+        in_formatted_str = self.context.fstring_literal
+        no_lzma = self.context.fstring_depth > 0  # can't use unicode chars in fstrings since these would lead to escapes
+        if (self.pool_mode or self.hot) and type(val) in (str, bytes):
+            idx = self.pool.setdefault((type(val), val), len(self.pool))
+            t = mark_loop_invariant(Subscript(  # -> pool[idx]
+                value=Name(self.pool_name, Load()),
+                slice=Constant(idx),
+                ctx=Load()
+            ))
+            if in_formatted_str:
+                t = FormattedValue(
+                    value=t,
+                    conversion=-1
+                )
+            return t
         do_decode = False
         if isinstance(val, str):
             encoded = base64.b64encode(val.encode("utf8"))
             do_decode = True
-            if self.no_lzma:  # can't use unicode chars in fstrings since these would lead to escapes
+            if no_lzma:
                 compressed = encoded
             else:
                 compressed = zlib.compress(encoded, 9)
         elif type(val) == bytes:
             encoded = base64.b64encode(val)
-            if self.no_lzma:
+            if no_lzma:
                 compressed = encoded
             else:
                 compressed = zlib.compress(encoded, 9)
@@ -822,7 +1273,7 @@ class EncodeStrings(Transformer, NodeTransformer):
                             Constant(compressed)
                         ],
                         keywords=[]
-                    ) if not self.no_lzma else Constant(compressed)
+                    ) if not no_lzma else Constant(compressed)
                 ],
                 keywords=[]
             )
@@ -836,17 +1287,59 @@ class EncodeStrings(Transformer, NodeTransformer):
                     args=[],
                     keywords=[]
                 )
-            if self.in_formatted_str:
+            mark_loop_invariant(t)
+            if in_formatted_str:
                 t = FormattedValue(
                     value=t,
                     conversion=-1
                 )
             return t
         else:
-            return self.generic_visit(node)
+            return node
 
-    def transform(self, ast: AST, current_file_name, all_asts, all_file_names) -> AST:
-        return self.visit(ast)
+    def pool_loader(self) -> list[stmt]:
+        """
+        Creates the string pool. All strings are compressed together into one blob, which is only decompressed when the
+        first string is used. The pool is a dict, which decodes missing strings out of the blob and remembers them
+        :return: The statements creating the pool
+        """
+        raw = bytearray()
+        offsets = [0]
+        is_bytes = set()
+        for (t, v), idx in self.pool.items():
+            raw.extend(v if t == bytes else v.encode("utf8"))
+            offsets.append(len(raw))
+            if t == bytes:
+                is_bytes.add(idx)
+        blob = zlib.compress(bytes(raw), 9)
+        pool_type = rnd_name()
+        decompressed = rnd_name()
+        offsets_name = rnd_name()
+        return parse(
+            f"class {pool_type}(dict):\n"
+            f"    def __missing__(self, i):\n"
+            f"        global {decompressed}\n"
+            f"        if {decompressed} is None:\n"
+            f"            {decompressed} = __import__('zlib').decompress({blob!r})\n"
+            f"        v = {decompressed}[{offsets_name}[i]:{offsets_name}[i + 1]]\n"
+            f"        if i not in {is_bytes!r}:\n"
+            f"            v = v.decode('utf8')\n"
+            f"        self[i] = v\n"
+            f"        return v\n"
+            f"{decompressed} = None\n"
+            f"{offsets_name} = {tuple(offsets)!r}\n"
+            f"{self.pool_name} = {pool_type}()\n"
+        ).body
+
+    def begin(self, ast: AST, current_file_name):
+        self.pool_mode = self.config["mode"].value == "pool"
+        self.pool = {}
+        self.pool_name = rnd_name()
+
+    def finish(self, ast: AST) -> AST:
+        if len(self.pool) > 0:
+            ast.body = with_prelude(ast.body, self.pool_loader())
+        return ast
 
 
 def collect_fstring_consts(node: JoinedStr) -> str:
@@ -859,7 +1352,7 @@ def collect_fstring_consts(node: JoinedStr) -> str:
     return s
 
 
-class FstringsToFormatSequence(Transformer, NodeTransformer):
+class FstringsToFormatSequence(FusibleTransformer):
     conversion_method_dict = {
         's': "str",
         'r': "repr",
@@ -869,7 +1362,12 @@ class FstringsToFormatSequence(Transformer, NodeTransformer):
     def __init__(self):
         super().__init__("fstrToFormatSeq", "Converts F-Strings to their str.format equivalent")
 
-    def visit_JoinedStr(self, node: JoinedStr) -> Any:
+    def enter_FunctionDef(self, node: FunctionDef) -> Any:
+        return self.enter_function(node)
+
+    enter_AsyncFunctionDef = enter_FunctionDef
+
+    def replace_JoinedStr(self, node: JoinedStr) -> Any:
         converted_format = ""
         collected_args = []
         for value in node.values:
@@ -890,15 +1388,72 @@ class FstringsToFormatSequence(Transformer, NodeTransformer):
             elif isinstance(value, Constant):
                 converted_format += str(value.value)
         return Call(
-            func=Attribute(
+            func=mark_loop_invariant(Attribute(  # the bound format method, the call itself depends on the args
                 value=Constant(converted_format),
                 attr="format",
                 ctx=Load()
-            ),
+            )),
             args=collected_args,
             keywords=[]
         )
-        # return self.generic_visit(node)
+
+
+class LoopHoister(Transformer, NodeTransformer):
+    def __init__(self):
+        self.can_hoist = True  # can the current scope hold temporaries? not the case in class bodies and lambdas
+        self.loop_depth = 0
+        self.hoisted: list[stmt] | None = None  # assignments to put before the current outermost statement
+        self.hoisted_names: dict[str, str] = {}  # dump of the hoisted expression -> temporary holding it
+        super().__init__("loopHoister", "Moves loop invariant expressions generated by the other transformers (decoded "
+                                        "ints and strings, collected constants) out of loops and comprehensions into "
+                                        "temporaries, so they're only evaluated once instead of on every iteration. "
+                                        "Should run last, after all transformers generating these expressions")
+
+    def visit(self, node: AST) -> Any:
+        if self.loop_depth > 0 and self.hoisted is not None and is_loop_invariant(node):
+            key = dump(node)
+            name = self.hoisted_names.get(key)
+            if name is None:
+                name = rnd_name()
+                self.hoisted_names[key] = name
+                self.hoisted.append(Assign(
+                    targets=[Name(name, Store())],
+                    value=node
+                ))
+            return Name(name, Load())
+        if isinstance(node, stmt) and self.loop_depth == 0 and self.can_hoist:
+            # outermost statement that isn't in a loop, anything hoisted out of loops inside of it goes before it
+            prev = self.hoisted, self.hoisted_names
+            self.hoisted, self.hoisted_names = [], {}
+            r = super().visit(node)
+            hoisted = self.hoisted
+            self.hoisted, self.hoisted_names = prev
+            return [*hoisted, r] if len(hoisted) > 0 else r
+        return super().visit(node)
+
+    def _visit_scope(self, node: FunctionDef | AsyncFunctionDef | Lambda | ClassDef) -> Any:
+        prev = self.can_hoist, self.loop_depth, self.hoisted, self.hoisted_names
+        self.can_hoist = isinstance(node, (FunctionDef, AsyncFunctionDef))
+        self.loop_depth = 0
+        self.hoisted, self.hoisted_names = None, {}
+        r = self.generic_visit(node)
+        self.can_hoist, self.loop_depth, self.hoisted, self.hoisted_names = prev
+        return r
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_Lambda = visit_ClassDef = _visit_scope
+
+    def _visit_loop(self, node: For | AsyncFor | While | ListComp | SetComp | DictComp | GeneratorExp) -> Any:
+        # comprehensions are their own scope, but they can still see temporaries of the enclosing function
+        self.loop_depth += 1
+        r = self.generic_visit(node)
+        self.loop_depth -= 1
+        return r
+
+    visit_For = visit_AsyncFor = visit_While = _visit_loop
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_loop
 
     def transform(self, ast: AST, current_file_name, all_asts, all_file_names) -> AST:
+        self.can_hoist = True
+        self.loop_depth = 0
+        self.hoisted, self.hoisted_names = None, {}
         return self.visit(ast)
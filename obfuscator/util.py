@@ -1,8 +1,11 @@
 import ast
+import marshal
 import opcode
-import os.path
 import random
+import sys
 from ast import *
+from types import CodeType
+from typing import Any
 
 _SINGLE_QUOTES = ("'", '"')
 _MULTI_QUOTES = ('"""', "'''")
@@ -57,7 +60,47 @@ class NonEscapingUnparser(getattr(ast, "_Unparser")):
         return escaped_string, possible_quotes
 
 
-def randomize_cache(bc: list[int]):
+rng = random.Random()  # all randomness of the obfuscator goes through this, see seed_rng
+
+
+def seed_rng(seed: str, file: str, step: str):
+    """
+    Seeds the rng for a step of obfuscating a file. With a seed, every file gets its own stream for each step, so what
+    a step generates only depends on the seed, the file and the step. Not on which files this process did before, or
+    which process it is
+    :param seed: The seed from the config, empty to seed randomly
+    :param file: The path of the file, relative to the project
+    :param step: The step, like the transformers running in it
+    """
+    if seed == "":
+        rng.seed()
+    else:
+        rng.seed(f"{seed}\0{file}\0{step}")
+
+
+_cache_bytes: bytes | None = None  # see _cache_bytes_table
+
+
+def _cache_bytes_table() -> bytes:
+    """
+    :return: The amount of cache bytes after each opcode (0-255), for the running python version. Built on first use
+    """
+    global _cache_bytes
+    if _cache_bytes is None:
+        entries = getattr(opcode, "_inline_cache_entries", None)
+        table = [0] * 256
+        if isinstance(entries, dict):  # 3.13+, keyed by opcode name
+            for name, n in entries.items():
+                op = opcode.opmap.get(name)
+                if op is not None and op < 256:
+                    table[op] = n
+        elif entries is not None:  # 3.11 and 3.12, a list by opcode
+            table[:len(entries)] = list(entries)[:256]
+        _cache_bytes = bytes(2 * x for x in table)
+    return _cache_bytes
+
+
+def randomize_cache(bc: bytearray):
     """
     Randomizes empty "cache" slots after instructions. Assume the following bytecode:
 
@@ -78,19 +121,53 @@ def randomize_cache(bc: list[int]):
     Some instructions have designated "cache" slots after them, which are filled by the python interpreter to cache
     information. These slots are not used otherwise, and can be anything, going into the interpreter. We set these slots
     to random bytes, to confuse the reader.
-    :param bc: The bytecode
+    :param bc: The bytecode, modified in place
     :return: Nothing
     """
+    cache_bytes = _cache_bytes_table()
+    rnd = rng.randbytes(len(bc))  # more than enough for all slots, in one go
     reader = 0
-    while reader < len(bc):
-        current = bc[reader]
+    end = len(bc)
+    while reader < end:
+        n = cache_bytes[bc[reader]]
         reader += 2  # skip insn and arg, now at first cache
-        cache = opcode._inline_cache_entries[current]
-        # print(f"opcode {current} ({opcode.opname[current]}), {cache} cache slots")
-        cache_bytes = cache * 2
-        for off in range(cache_bytes):
-            bc[reader + off] = random.randint(0, 255)
-        reader += cache_bytes
+        if n > 0:
+            bc[reader:reader + n] = rnd[reader:reader + n]
+            reader += n
+
+
+def dump_code(code: CodeType) -> bytes:
+    """
+    Marshals a code object to the same bytes in any process. marshal writes an object it sees again as a reference to
+    the first one, but only if it's the same object, and only flags it for that if something else references it too.
+    Both depend on what the process did before, like whether equal strings got interned, so the output of a worker
+    differs from doing the same in the main process. Every string is interned here, and everything kept referenced
+    while dumping
+    :return: The marshalled code object, loadable like any other
+    """
+    held = []
+    done = {}
+
+    def canonical(v: Any) -> Any:
+        if id(v) in done:
+            return done[id(v)]
+        if type(v) is str:
+            r = sys.intern(v)
+        elif type(v) is tuple:
+            r = tuple(canonical(x) for x in v)
+        elif isinstance(v, CodeType):
+            r = v.replace(co_consts=canonical(v.co_consts), co_names=canonical(v.co_names),
+                          co_varnames=canonical(v.co_varnames), co_freevars=canonical(v.co_freevars),
+                          co_cellvars=canonical(v.co_cellvars), co_filename=canonical(v.co_filename),
+                          co_name=canonical(v.co_name), co_qualname=canonical(v.co_qualname))
+            held.extend([r.co_code, r.co_linetable, r.co_exceptiontable])  # made on demand, or only held by it
+        else:
+            r = v
+        done[id(v)] = r
+        held.extend([v, r])  # keeps ids unique while this runs
+        return r
+
+    return marshal.dumps(canonical(code))
 
 
 def ast_import_full(name: str) -> Call:
@@ -109,53 +186,144 @@ def ast_import_from(name: str, *names) -> ImportFrom:
     )
 
 
-def get_file_from_import(from_file: str, name: str):
-    if name.startswith(".."):
-        pname = os.path.normpath(os.path.join(os.path.dirname(from_file), ".."))
-        from_file = os.path.join(pname, os.path.basename(from_file))
-        name = name[2:]
-    elif name.startswith("."):
-        name = name[1:]
-    if "." in name:
-        paths = name.split(".")
-        name = os.path.join(*paths)
-    abspath_name = os.path.join(os.path.dirname(from_file), name) if len(name) > 0 else os.path.dirname(from_file)
-    if os.path.exists(abspath_name):
-        if os.path.isdir(abspath_name):  # is it a package? get __init__.py
-            return os.path.join(os.path.dirname(from_file), name, "__init__.py")
-    elif os.path.exists(abspath_name+".py"):
-        return os.path.join(os.path.dirname(from_file), name + ".py")
-
-
-def _walk_deptree(current_file: str, start: AST, lst: dict[str, list[str]]):
-    if current_file in lst:
-        return  # already visited
-    for node in ast.walk(start):
-        if isinstance(node, Import):
-            discovered_files = list(filter(lambda x: x is not None, [get_file_from_import(current_file, x.name) for x in node.names]))
-            if current_file not in lst:
-                lst[current_file] = []
-
-            discovered_files = list(filter(lambda x: x not in lst[current_file], discovered_files))
-            lst[current_file].extend(discovered_files)
-            for x in discovered_files:
-                with open(x, "r", encoding="utf8") as f:
-                    _walk_deptree(x, ast.parse(f.read()), lst)
-        if isinstance(node, ImportFrom):
-            modu = node.module
-            discovered_file = get_file_from_import(current_file, modu)
-            if discovered_file is not None:
-                if current_file not in lst:
-                    lst[current_file] = []
-                if discovered_file in lst[current_file]:
-                    continue
-                lst[current_file].append(discovered_file)
-                with open(discovered_file, "r", encoding="utf8") as f:
-                    _walk_deptree(discovered_file, ast.parse(f.read()), lst)
-
-
-def get_dependency_tree(start: str):
-    resolved_files = {}
-    with open(start, "r", encoding="utf8") as f:
-        _walk_deptree(os.path.abspath(start), ast.parse(f.read()), resolved_files)
-    return resolved_files
+def mark_loop_invariant(node: expr) -> expr:
+    """
+    Marks an expression generated by a transformer as loop invariant: it always evaluates to the same value, and has no
+    side effects. The loop hoister moves marked expressions out of loops
+    :param node: The expression
+    :return: The same expression
+    """
+    node.loop_invariant = True
+    return node
+
+
+def is_loop_invariant(node: AST) -> bool:
+    return getattr(node, "loop_invariant", False)
+
+
+def with_prelude(body: list[stmt], prelude: list[stmt]) -> list[stmt]:
+    """
+    Inserts statements at the start of a module body, after the docstring and __future__ imports, which have to stay
+    at the top
+    :param body:    The module body
+    :param prelude: The statements to insert
+    :return: The new module body
+    """
+    i = 0
+    if len(body) > 0 and isinstance(body[0], Expr) and isinstance(body[0].value, Constant) \
+            and isinstance(body[0].value.value, str):
+        i = 1
+    while i < len(body) and isinstance(body[i], ImportFrom) and body[i].module == "__future__":
+        i += 1
+    return [*body[:i], *prelude, *body[i:]]
+
+
+def import_key(module: str | None, level: int = 0, name: str | None = None) -> str:
+    """
+    The key an import is known by in the import map of a file: the module as written, with the dots of relative
+    imports in front, e.g. "a.b", ".b" or "..". With a name, the key of the submodule "from module import name" would
+    import, e.g. "a.b.c" or ".c"
+    """
+    parts = [x for x in (module, name) if x]
+    return "." * level + ".".join(parts)
+
+
+class ScopeBindings(NodeVisitor):
+    """
+    Collects which names each scope of a module binds, so a name loaded in there can be told apart from a global
+    """
+
+    def __init__(self):
+        self.scope_names: dict[AST, set[str]] = {}  # function, lambda, class or comprehension -> names bound in it
+        self._stack: list[tuple[AST, set[str], set[str]]] = []  # (scope, bound names, names declared global)
+
+    def bind(self, name: str, skip_comprehensions: bool = False):
+        i = len(self._stack) - 1
+        if skip_comprehensions:
+            while i >= 0 and isinstance(self._stack[i][0], (ListComp, SetComp, DictComp, GeneratorExp)):
+                i -= 1
+        if i >= 0 and name not in self._stack[i][2]:
+            self._stack[i][1].add(name)
+
+    def _push(self, node: AST):
+        s = set()
+        self.scope_names[node] = s
+        self._stack.append((node, s, set()))
+
+    def _visit_function(self, node: FunctionDef | AsyncFunctionDef | Lambda):
+        if not isinstance(node, Lambda):
+            for x in node.decorator_list:
+                self.visit(x)
+        args = node.args
+        for x in [*args.defaults, *args.kw_defaults]:
+            if x is not None:
+                self.visit(x)
+        if not isinstance(node, Lambda):
+            self.bind(node.name)
+        self._push(node)
+        for x in [*args.posonlyargs, *args.args, *args.kwonlyargs, args.vararg, args.kwarg]:
+            if x is not None:
+                self.bind(x.arg)
+        if isinstance(node, Lambda):
+            self.visit(node.body)
+        else:
+            for x in node.body:
+                self.visit(x)
+        self._stack.pop()
+
+    def visit_FunctionDef(self, node: FunctionDef) -> Any:
+        self._visit_function(node)
+
+    def visit_AsyncFunctionDef(self, node: AsyncFunctionDef) -> Any:
+        self._visit_function(node)
+
+    def visit_Lambda(self, node: Lambda) -> Any:
+        self._visit_function(node)
+
+    def visit_ClassDef(self, node: ClassDef) -> Any:
+        for x in [*node.decorator_list, *node.bases, *node.keywords]:
+            self.visit(x)
+        self._push(node)
+        for x in node.body:
+            self.visit(x)
+        self._stack.pop()
+        self.bind(node.name)
+
+    def _visit_comprehension(self, node: AST):
+        self._push(node)
+        self.generic_visit(node)
+        self._stack.pop()
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_comprehension
+
+    def visit_Global(self, node: Global) -> Any:
+        if len(self._stack) > 0:
+            self._stack[-1][2].update(node.names)
+
+    def visit_Name(self, node: Name) -> Any:
+        if not isinstance(node.ctx, Load):
+            self.bind(node.id)
+
+    def visit_NamedExpr(self, node: NamedExpr) -> Any:
+        self.visit(node.value)
+        self.bind(node.target.id, skip_comprehensions=True)
+
+    def _visit_import(self, node: Import | ImportFrom):
+        for x in node.names:
+            if x.name != "*":
+                self.bind(x.asname if x.asname is not None else x.name.split(".")[0])
+
+    visit_Import = visit_ImportFrom = _visit_import
+
+    def visit_ExceptHandler(self, node: ExceptHandler) -> Any:
+        if node.name is not None:
+            self.bind(node.name)
+        self.generic_visit(node)
+
+    def _visit_capture(self, node: MatchAs | MatchStar | MatchMapping):
+        name = node.rest if isinstance(node, MatchMapping) else node.name
+        if name is not None:
+            self.bind(name)
+        self.generic_visit(node)
+
+    visit_MatchAs = visit_MatchStar = visit_MatchMapping = _visit_capture
@@ -0,0 +1,122 @@
+"""
+Stress tests obfuscating in parallel against obfuscating serially. A generated project is obfuscated in transitive mode
+with every transformer, with different amounts of workers, and every output has to run and print exactly what the
+original prints. With a seed, the outputs of every amount of workers also have to be the same, byte for byte.
+
+Run with: python -m unittest discover tests
+"""
+import filecmp
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import tomlkit
+
+OBFUSCATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "obfuscator")
+MODULES = 8
+WORKERS = [1, 2, 4]
+SEEDS = ["determinism", "another seed"]
+
+
+def generate_project(root: str, modules: int):
+    for i in range(modules):
+        imports = list(range(max(0, i - 2), i))
+        out = [f"import mod_{j}" for j in imports]
+        out.extend([
+            "class Model:",
+            "    def __init__(self, name, size):",
+            "        self.name = name",
+            "        self.size = size",
+            "    def describe(self, extra):",
+            f"        return f'{{self.name}} ({{self.size}}): ' + ', '.join(str(x * {i + 1}) for x in extra)",
+            "def build(n):",
+            "    total = 0",
+            "    for x in range(n):",
+            f"        if x % {i % 3 + 2}:",
+            f"            total += len(Model('model {i}', x).describe(range(x)))",
+            "    return total",
+            "def chain(n):",
+            "    return build(n)" + "".join(f" + mod_{j}.chain(n)" for j in imports),
+        ])
+        with open(os.path.join(root, f"mod_{i}.py"), "w", encoding="utf8") as f:
+            f.write("\n".join(out) + "\n")
+    with open(os.path.join(root, "main.py"), "w", encoding="utf8") as f:
+        # positional arguments only, the renamer renames parameters but not keyword arguments
+        f.write("\n".join([
+            *(f"import mod_{i}" for i in range(modules)),
+            *(f"print(mod_{i}.build({i + 3}))" for i in range(modules)),
+            f"print(mod_{modules - 1}.chain(4))",
+        ]) + "\n")
+
+
+def output_files(directory: str) -> list[str]:
+    return sorted(x for x in os.listdir(directory) if x.endswith(".py"))  # not __pycache__ from running them
+
+
+def run_program(directory: str) -> str:
+    p = subprocess.run([sys.executable, "main.py"], cwd=directory, capture_output=True, text=True)
+    if p.returncode != 0:
+        raise AssertionError(f"{directory} failed to run:\n{p.stderr}")
+    return p.stdout
+
+
+class ParallelDeterminismTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = self._tmp.name
+        generate_project(self.root, MODULES)
+        self.expected = run_program(self.root)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def obfuscate(self, workers: int, **general) -> str:
+        """
+        Obfuscates the project with every transformer
+        :param general: More values for the general segment of the config
+        :return: The output directory
+        """
+        config = os.path.join(self.root, "config.toml")
+        if not os.path.exists(config):
+            subprocess.run([sys.executable, OBFUSCATOR], cwd=self.root, capture_output=True)  # creates the example
+        with open(config, "r", encoding="utf8") as f:
+            doc = tomlkit.loads(f.read())
+        out = os.path.join(self.root, "out_" + "_".join(str(x) for x in [workers, *general.values()]))
+        doc["general"]["input_file"] = os.path.join(self.root, "main.py")
+        doc["general"]["output_file"] = out
+        doc["general"]["transitive"] = True
+        doc["general"]["workers"] = workers
+        doc["general"]["incremental"] = False  # every run obfuscates everything
+        for k, v in general.items():
+            doc["general"][k] = v
+        for seg in doc.values():
+            if "enabled" in seg:
+                seg["enabled"] = True
+        with open(config, "w", encoding="utf8") as f:
+            f.write(tomlkit.dumps(doc))
+        p = subprocess.run([sys.executable, OBFUSCATOR], cwd=self.root, capture_output=True, text=True)
+        self.assertEqual(p.returncode, 0, p.stdout + p.stderr)
+        return out
+
+    def test_any_amount_of_workers_runs_the_same(self):
+        for workers in WORKERS:
+            with self.subTest(workers=workers):
+                self.assertEqual(run_program(self.obfuscate(workers)), self.expected)
+
+    def test_seeded_output_is_identical_for_any_amount_of_workers(self):
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                outputs = [self.obfuscate(workers, seed=seed) for workers in WORKERS]
+                names = output_files(outputs[0])
+                self.assertEqual(len(names), MODULES + 1)
+                for workers, out in zip(WORKERS[1:], outputs[1:]):
+                    self.assertEqual(output_files(out), names)
+                    _, mismatch, errors = filecmp.cmpfiles(outputs[0], out, names, shallow=False)
+                    self.assertEqual(mismatch + errors, [], f"1 and {workers} workers wrote different files")
+                self.assertEqual(run_program(outputs[0]), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()